@@ -1,30 +1,44 @@
 import os
 import json
 import subprocess
-import threading
 import time
-import tempfile
-import zipfile
-import io
 import hashlib
 import secrets
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, Response, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response, session, g
 from functools import wraps
+from werkzeug.utils import secure_filename
 import logging
+from logging.handlers import RotatingFileHandler
 import glob
 from crontab import CronTab
-from backup import BackupEngine, BackupStatus
+from backup import BackupEngine, BackupStatus, DEFAULT_BACKUP_WORKERS, format_bytes
+from volume_index import VolumeIndex, DEFAULT_SCAN_INTERVAL, DEFAULT_SCAN_WORKERS
+from snapshot_catalog import DEFAULT_SYNC_INTERVAL, parse_time_filter
+from events import format_sse, HEARTBEAT_INTERVAL
+from diagnostics import LogFilter, stream_bundle, read_lines
+from log_store import LOG_LEVELS
+from config_store import CONFIG_PATH, load_config, merge_config
+from job_queue import JobQueue
+from job_registry import JobLimitReached, job_limits
+from maintenance import prune_schedule
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from tracing import chrome_trace, otel_trace
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 
+# Size at which app.log is rotated, and rotated files kept
+APP_LOG_MAX_BYTES = 10 * 1024 * 1024
+APP_LOG_BACKUPS = 3
+
 # Configure logging
+# app.log is rotated so it cannot fill /data; operation history lives in the log store
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('/data/app.log'),
+        RotatingFileHandler('/data/app.log', maxBytes=APP_LOG_MAX_BYTES, backupCount=APP_LOG_BACKUPS),
         logging.StreamHandler()
     ]
 )
@@ -34,7 +48,6 @@ logger = logging.getLogger(__name__)
 backup_engine = BackupEngine()
 
 # Configuration paths
-CONFIG_PATH = '/data/config.json'
 DATA_DIR = '/data'
 VOLUMES_DIR = '/volumes'
 RCLONE_CONFIG_PATH = '/data/rclone.conf'
@@ -91,6 +104,48 @@ def verify_secret_answer(answer, answer_hash):
     """Verify secret answer against hash"""
     return hashlib.sha256(answer.lower().encode()).hexdigest() == answer_hash
 
+@app.template_filter('age')
+def format_age(value):
+    """Format a unix timestamp as a short relative age"""
+    try:
+        seconds = max(0, int(time.time() - float(value)))
+    except (TypeError, ValueError):
+        return 'never'
+    if seconds < 60:
+        return f"{seconds}s ago"
+    if seconds < 3600:
+        return f"{seconds // 60}m ago"
+    if seconds < 86400:
+        return f"{seconds // 3600}h ago"
+    return f"{seconds // 86400}d ago"
+
+@app.template_filter('bytes')
+def format_size(value):
+    """Format a byte count for display"""
+    return format_bytes(value) if value is not None else '-'
+
+@app.template_filter('datetime')
+def format_timestamp(value):
+    """Format a unix timestamp for display"""
+    try:
+        return datetime.fromtimestamp(float(value)).strftime('%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return value
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_latency(response):
+    """Observe the request's latency under its route pattern, so paths with ids share one series"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        backup_engine.metrics.http_duration.observe(time.monotonic() - started, method=request.method,
+                                                    route=route, status=response.status_code)
+    return response
+
 def login_required(f):
     """Decorator to require login for routes"""
     @wraps(f)
@@ -100,28 +155,6 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def load_config():
-    """Load configuration from JSON file"""
-    if os.path.exists(CONFIG_PATH):
-        try:
-            with open(CONFIG_PATH, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Error loading config: {e}")
-            return {}
-    return {}
-
-def save_config(config):
-    """Save configuration to JSON file"""
-    try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"Error saving config: {e}")
-        return False
-
 def get_cron_schedule():
     """Get current backup schedule from crontab"""
     try:
@@ -170,25 +203,134 @@ def update_cron_schedule(schedule):
         logger.error(f"Error updating cron schedule: {e}")
         return False
 
+def update_prune_schedule(config):
+    """Install, change or remove the crontab entry that queues scheduled prunes"""
+    try:
+        schedule = prune_schedule(config)
+        cron = CronTab(user=True)
+        current = [job for job in cron.find_comment('prune-job')]
+        if schedule is None and not current:
+            return True
+        if len(current) == 1 and schedule is not None and str(current[0].slices) == schedule:
+            return True
+        
+        cron.remove_all(comment='prune-job')
+        if schedule is not None:
+            job = cron.new(command='cd /app && /usr/local/bin/python /app/cron_prune.py >> /data/cron.log 2>&1',
+                           comment='prune-job')
+            job.setall(schedule)
+        cron.write()
+        return True
+    except Exception as e:
+        logger.error(f"Error updating prune schedule: {e}")
+        return False
+
+def create_volume_index():
+    """Create the background volume size index from configuration"""
+    config = load_config()
+    try:
+        interval = int(config.get('volume_scan_interval', DEFAULT_SCAN_INTERVAL))
+        workers = int(config.get('volume_scan_workers', DEFAULT_SCAN_WORKERS))
+    except (TypeError, ValueError):
+        interval, workers = DEFAULT_SCAN_INTERVAL, DEFAULT_SCAN_WORKERS
+    index = VolumeIndex(VOLUMES_DIR, interval=interval, workers=workers)
+    index.start()
+    return index
+
+volume_index = create_volume_index()
+
+def start_catalog_sync():
+    """Keep the local snapshot catalog in sync with the repository"""
+    try:
+        interval = int(load_config().get('catalog_sync_interval', DEFAULT_SYNC_INTERVAL))
+    except (TypeError, ValueError):
+        interval = DEFAULT_SYNC_INTERVAL
+    backup_engine.start_catalog_sync(interval)
+
+start_catalog_sync()
+
+def create_job_queue():
+    """Run backups, restores and prunes from the job spool in this process's engine, within their limits"""
+    queue = JobQueue({
+        'backup': lambda params, job: backup_engine.run_backup(params['volumes'], job=job),
+        'restore': lambda params, job: backup_engine.run_restore(
+            params['snapshot_id'], params['target_path'], params.get('verify'), params.get('include'),
+            params.get('workers'), job=job),
+        'prune': lambda params, job: backup_engine.run_prune(job=job)
+    }, backup_engine.admit_job, backup_engine.abandon_job, on_change=backup_engine._publish_status)
+    backup_engine.queue = queue
+    queue.start()
+    return queue
+
+job_queue = create_job_queue()
+update_prune_schedule(load_config())
+
+def queue_response(job, created, label):
+    """Describe the outcome of submitting a job"""
+    if not created:
+        return jsonify({'status': 'success', 'job_id': job['id'], 'queued': True,
+                        'message': f'An identical {label.lower()} is already queued'})
+    
+    position = job_queue.position(job['id'])
+    if position is None or backup_engine.jobs.can_start(job['type']):
+        message = f'{label} started'
+    else:
+        message = f'{label} queued at position {position}'
+    return jsonify({'status': 'success', 'job_id': job['id'], 'queued': position is not None,
+                    'position': position, 'message': message})
+
+def get_snapshot_filters(args):
+    """Read snapshot catalog filters and paging from query arguments"""
+    filters = {
+        'tag': args.get('tag') or None,
+        'path': args.get('path') or None,
+        'host': args.get('host') or None,
+        'since': parse_time_filter(args.get('since')),
+        'until': parse_time_filter(args.get('until'), end_of_day=True)
+    }
+    page = args.get('page', 1, type=int)
+    per_page = args.get('per_page', 50, type=int)
+    return filters, page, per_page
+
+def get_log_filters(args):
+    """Read log store filters and paging from query arguments"""
+    level = args.get('level') or None
+    if level and level.upper() not in LOG_LEVELS:
+        raise ValueError(f'Unknown log level: {level}')
+    filters = {
+        'since': parse_time_filter(args.get('since')),
+        'until': parse_time_filter(args.get('until'), end_of_day=True),
+        'level': level,
+        'text': args.get('q') or None,
+        'job_id': args.get('job') or None
+    }
+    page = args.get('page', 1, type=int)
+    per_page = args.get('per_page', 100, type=int)
+    return filters, page, per_page
+
 def discover_volumes():
-    """Discover all mounted Docker volumes"""
+    """Discover all mounted Docker volumes, with sizes from the background index"""
     volumes = []
     if os.path.exists(VOLUMES_DIR):
-        for item in os.listdir(VOLUMES_DIR):
+        for item in sorted(os.listdir(VOLUMES_DIR)):
             volume_path = os.path.join(VOLUMES_DIR, item)
             if os.path.isdir(volume_path):
-                # Get volume size
-                try:
-                    result = subprocess.run(['du', '-sh', volume_path], 
-                                          capture_output=True, text=True)
-                    size = result.stdout.split()[0] if result.returncode == 0 else 'Unknown'
-                except:
-                    size = 'Unknown'
+                entry = volume_index.get(item)
+                if entry:
+                    size = format_bytes(entry['size'])
+                else:
+                    size = 'Scanning...' if volume_index.is_scanning(item) else 'Unknown'
                 
                 volumes.append({
                     'name': item,
                     'path': volume_path,
-                    'size': size
+                    'size': size,
+                    'size_bytes': entry['size'] if entry else None,
+                    'file_count': entry['file_count'] if entry else None,
+                    'newest_mtime': entry['newest_mtime'] if entry else None,
+                    'growth': entry['growth'] if entry else None,
+                    'scanned_at': entry['scanned_at'] if entry else None,
+                    'scanning': volume_index.is_scanning(item)
                 })
     return volumes
 
@@ -306,13 +448,20 @@ def dashboard():
         if now.hour >= 2:
             next_backup += timedelta(days=1)
     
+    try:
+        trends = backup_engine.job_trends()
+    except Exception as e:
+        logger.error(f"Error reading backup trends: {e}")
+        trends = []
+    
     return render_template('dashboard.html', 
                          volumes=volumes, 
                          config=config,
                          status=status,
                          schedule=schedule,
                          last_backup=last_backup,
-                         next_backup=next_backup)
+                         next_backup=next_backup,
+                         trends=trends)
 
 @app.route('/volumes')
 @login_required
@@ -335,11 +484,7 @@ def select_volumes():
         data = request.get_json()
         selected_volumes = data.get('volumes', [])
         
-        config = load_config()
-        config['selected_volumes'] = selected_volumes
-        config['updated_at'] = datetime.now().isoformat()
-        
-        if save_config(config):
+        if merge_config({'selected_volumes': selected_volumes, 'updated_at': datetime.now().isoformat()}):
             return jsonify({'status': 'success', 'message': 'Volume selection updated'})
         else:
             return jsonify({'status': 'error', 'message': 'Failed to save configuration'})
@@ -347,18 +492,107 @@ def select_volumes():
         logger.error(f"Error updating volume selection: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/api/volumes/rescan', methods=['POST'])
+@login_required
+def rescan_volumes():
+    """Trigger a background rescan of volume sizes"""
+    volume_index.request_refresh()
+    return jsonify({'status': 'success', 'message': 'Volume rescan started'})
+
 @app.route('/backup')
 @login_required
 def backup_page():
     """Backup management page"""
-    snapshots = backup_engine.list_snapshots()
+    try:
+        filters, page, per_page = get_snapshot_filters(request.args)
+    except ValueError:
+        flash('Invalid date filter', 'error')
+        filters, page, per_page = {}, 1, 50
+    
+    snapshots, total = backup_engine.list_snapshots(page=page, per_page=per_page, **filters)
     status = backup_engine.get_status()
     logs = backup_engine.get_recent_logs()
     
     return render_template('backup.html', 
                          snapshots=snapshots, 
                          status=status,
-                         logs=logs)
+                         logs=logs,
+                         total=total,
+                         page=page,
+                         per_page=per_page,
+                         pages=max(1, (total + per_page - 1) // per_page),
+                         filters=request.args,
+                         facets=backup_engine.catalog.facets(),
+                         synced_at=backup_engine.catalog.synced_at())
+
+@app.route('/api/snapshots')
+@login_required
+def api_snapshots():
+    """Query the local snapshot catalog"""
+    try:
+        filters, page, per_page = get_snapshot_filters(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f'Invalid filter: {e}'}), 400
+    
+    snapshots, total = backup_engine.list_snapshots(page=page, per_page=per_page, **filters)
+    return jsonify({
+        'snapshots': snapshots,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'synced_at': backup_engine.catalog.synced_at()
+    })
+
+@app.route('/api/snapshots/<snapshot_id>/tree')
+@login_required
+def browse_snapshot(snapshot_id):
+    """List one directory of a snapshot; 202 while the snapshot is still being indexed"""
+    try:
+        listing = backup_engine.browse_snapshot(
+            snapshot_id, request.args.get('path'),
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', 500, type=int))
+    except (LookupError, FileNotFoundError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Error browsing snapshot {snapshot_id}: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return jsonify(listing), 200 if listing['status'] == 'ready' else 202
+
+@app.route('/api/snapshots/<snapshot_id>/diff')
+@login_required
+def diff_snapshot(snapshot_id):
+    """Changes since the previous snapshot (or ?against=), rolled up below ?path=; 202 while diffing"""
+    try:
+        diff = backup_engine.diff_snapshots(
+            snapshot_id, request.args.get('against'), request.args.get('path'),
+            limit=request.args.get('limit', type=int))
+    except LookupError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Error diffing snapshot {snapshot_id}: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return jsonify(diff), 200 if diff['status'] in ('ready', 'none') else 202
+
+@app.route('/api/search')
+@login_required
+def search_files():
+    """Find files across snapshots by substring or glob (?q=), with their versions"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'status': 'error', 'message': 'Query required'}), 400
+    try:
+        return jsonify(backup_engine.search_files(query, request.args.get('limit', type=int)))
+    except Exception as e:
+        logger.error(f"Error searching files: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/snapshots/sync', methods=['POST'])
+@login_required
+def sync_snapshots():
+    """Trigger a background sync of the snapshot catalog"""
+    backup_engine.request_catalog_sync()
+    return jsonify({'status': 'success', 'message': 'Snapshot catalog sync started'})
 
 @app.route('/api/backup/start', methods=['POST'])
 @login_required
@@ -371,12 +605,8 @@ def start_backup():
         if not selected_volumes:
             return jsonify({'status': 'error', 'message': 'No volumes selected for backup'})
         
-        # Start backup in background thread
-        thread = threading.Thread(target=backup_engine.run_backup, args=(selected_volumes,))
-        thread.daemon = True
-        thread.start()
-        
-        return jsonify({'status': 'success', 'message': 'Backup started'})
+        job, created = job_queue.submit('backup', {'volumes': sorted(selected_volumes)})
+        return queue_response(job, created, 'Backup')
     except Exception as e:
         logger.error(f"Error starting backup: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
@@ -389,17 +619,29 @@ def start_restore():
         data = request.get_json()
         snapshot_id = data.get('snapshot_id')
         target_path = data.get('target_path', '/data/restore')
+        verify = data.get('verify')
+        include = data.get('include') or None
+        workers = data.get('workers')
         
         if not snapshot_id:
             return jsonify({'status': 'error', 'message': 'Snapshot ID required'})
+        if include is not None and (not isinstance(include, list)
+                                    or not all(isinstance(path, str) and path.startswith('/') for path in include)):
+            return jsonify({'status': 'error', 'message': 'include must be a list of absolute paths'})
+        if workers is not None and (not isinstance(workers, int) or isinstance(workers, bool) or workers < 1):
+            return jsonify({'status': 'error', 'message': 'workers must be a positive integer'})
         
-        # Start restore in background thread
-        thread = threading.Thread(target=backup_engine.run_restore, 
-                                args=(snapshot_id, target_path))
-        thread.daemon = True
-        thread.start()
-        
-        return jsonify({'status': 'success', 'message': 'Restore started'})
+        params = {
+            'snapshot_id': snapshot_id,
+            'target_path': target_path,
+            'verify': verify
+        }
+        if include:
+            params['include'] = sorted(set(include))
+        if workers:
+            params['workers'] = workers
+        job, created = job_queue.submit('restore', params)
+        return queue_response(job, created, 'Restore')
     except Exception as e:
         logger.error(f"Error starting restore: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
@@ -410,11 +652,209 @@ def get_status():
     """Get current backup/restore status"""
     return jsonify(backup_engine.get_status())
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, served from in-memory counters
+    
+    Readable from a logged-in session, or by scrapers sending metrics_token as
+    a bearer token. Without a token configured, scrapers are refused.
+    """
+    token = load_config().get('metrics_token')
+    authorized = session.get('logged_in') or (
+        token and secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'))
+    if not authorized:
+        return Response('Unauthorized\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    return Response(backup_engine.metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/repository/verify', methods=['POST'])
+@login_required
+def verify_repository():
+    """Check the repository again, ignoring the cached marker"""
+    if not backup_engine.start_repository_check(force=True):
+        return jsonify({'status': 'error', 'message': 'A repository check is already running'})
+    return jsonify({'status': 'success', 'message': 'Repository check started'})
+
+@app.route('/api/jobs')
+@login_required
+def list_jobs():
+    """Running and recently finished jobs, newest first, filtered by ?operation= and ?status="""
+    return jsonify({
+        'jobs': backup_engine.list_jobs(request.args.get('operation') or None,
+                                        request.args.get('status') or None,
+                                        request.args.get('limit', 50, type=int)),
+        'limits': job_limits(load_config())
+    })
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def get_job(job_id):
+    """One job with its parameters, per-volume progress, log lines and result"""
+    job = backup_engine.get_job(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Unknown job: {job_id}'}), 404
+    return jsonify(job)
+
+TRACE_FORMATS = {'chrome': chrome_trace, 'otel': otel_trace}
+
+def trace_response(job_ids):
+    """Export job traces in the format of ?format= (chrome or otel) as a JSON download"""
+    trace_format = request.args.get('format', 'chrome')
+    if trace_format not in TRACE_FORMATS:
+        return jsonify({'status': 'error', 'message': f'Unknown trace format: {trace_format}'}), 400
+    traces = []
+    for job_id in job_ids:
+        trace = backup_engine.get_trace(job_id)
+        if trace is None:
+            return jsonify({'status': 'error', 'message': f'No trace for job: {job_id}'}), 404
+        traces.append(trace)
+    
+    response = jsonify(TRACE_FORMATS[trace_format](traces))
+    name = job_ids[0] if len(job_ids) == 1 else f'{len(job_ids)}-jobs'
+    response.headers['Content-Disposition'] = f'attachment; filename="trace-{name}-{trace_format}.json"'
+    return response
+
+@app.route('/api/jobs/<job_id>/trace')
+@login_required
+def get_job_trace(job_id):
+    """Phase-level trace of one job"""
+    return trace_response([job_id])
+
+@app.route('/api/traces')
+@login_required
+def get_traces():
+    """Traces of several jobs in one file, e.g. ?jobs=<id>,<id>, to compare them side by side"""
+    job_ids = [job_id for job_id in request.args.get('jobs', '').split(',') if job_id]
+    if not job_ids:
+        return jsonify({'status': 'error', 'message': 'No jobs given'}), 400
+    return trace_response(job_ids)
+
+@app.route('/api/history')
+@login_required
+def job_history():
+    """Finished jobs from the persistent history, newest first
+    
+    Optional query arguments: operation, volume, status, since/until (date or
+    timestamp), page and per_page.
+    """
+    try:
+        jobs, total = backup_engine.history.query(
+            operation=request.args.get('operation') or None,
+            volume=request.args.get('volume') or None,
+            status=request.args.get('status') or None,
+            since=parse_time_filter(request.args.get('since')),
+            until=parse_time_filter(request.args.get('until'), end_of_day=True),
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', 50, type=int)
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'jobs': jobs, 'total': total})
+
+@app.route('/api/history/trends')
+@login_required
+def job_history_trends():
+    """Each volume's latest backup against its median, with regressions flagged"""
+    try:
+        return jsonify({'trends': backup_engine.job_trends(request.args.get('days', type=int))})
+    except Exception as e:
+        logger.error(f"Error reading backup trends: {e}")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route('/api/prune/start', methods=['POST'])
+@login_required
+def start_prune():
+    """Queue a prune of unreferenced repository data"""
+    try:
+        job, created = job_queue.submit('prune', {})
+        return queue_response(job, created, 'Prune')
+    except Exception as e:
+        logger.error(f"Error queueing prune: {e}")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route('/api/prune/history')
+@login_required
+def get_prune_history():
+    """Recent prune runs with bytes freed and duration"""
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify({'runs': backup_engine.prune_history.recent(limit)})
+
+@app.route('/api/queue')
+@login_required
+def get_queue():
+    """Pending and running jobs with queue depth and wait times"""
+    return jsonify(job_queue.stats(include_waits=True))
+
 @app.route('/api/logs')
 @login_required
 def get_logs():
-    """Get recent logs"""
-    return jsonify(backup_engine.get_recent_logs())
+    """Search the log history, or poll for entries after a sequence number with ?after=
+    
+    History queries take since/until, level (minimum), q (text), job and
+    page/per_page. Polls take level and return the cursor to pass as
+    `after` next time.
+    """
+    try:
+        filters, page, per_page = get_log_filters(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f'Invalid filter: {e}'}), 400
+    
+    after = request.args.get('after', type=int)
+    if after is not None:
+        logs, cursor, missed = backup_engine.get_logs_since(
+            after, level=filters['level'], limit=request.args.get('limit', 500, type=int))
+        return jsonify({'logs': logs, 'cursor': cursor, 'missed': missed})
+    
+    logs, total, counts = backup_engine.query_logs(page=page, per_page=per_page, **filters)
+    return jsonify({
+        'logs': logs,
+        'total': total,
+        'counts': counts,
+        'page': page,
+        'per_page': per_page,
+        'cursor': backup_engine.logs.cursor
+    })
+
+@app.route('/api/events')
+@login_required
+def event_stream():
+    """Server-Sent Events stream of status deltas and new log lines"""
+    broker = backup_engine.events
+    try:
+        cursor = int(request.headers.get('Last-Event-ID') or request.args.get('cursor') or 0)
+    except ValueError:
+        cursor = 0
+    
+    def generate():
+        yield 'retry: 3000\n\n'
+        
+        # Replay log lines missed while disconnected, then send a full status
+        after = broker.cursor
+        if cursor:
+            events, _ = broker.since(cursor)
+            for seq, event_type, data in events:
+                if event_type == 'log' and seq <= after:
+                    yield format_sse(event_type, data, seq)
+        yield format_sse('status', backup_engine.get_status(), after)
+        
+        while True:
+            events, missed = broker.wait(after, timeout=HEARTBEAT_INTERVAL)
+            if not events:
+                yield ': heartbeat\n\n'
+                continue
+            
+            if missed:
+                # Some deltas fell out of the buffer; resend the whole status
+                yield format_sse('status', backup_engine.get_status())
+            
+            for seq, event_type, data in events:
+                yield format_sse(event_type, data, seq)
+                after = seq
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/config')
 @login_required
@@ -431,23 +871,20 @@ def config_page():
     }
     
     return render_template('config.html', config=config, env_vars=env_vars, 
-                         schedule=schedule, rclone_config=rclone_config)
+                         schedule=schedule, rclone_config=rclone_config,
+                         default_backup_workers=DEFAULT_BACKUP_WORKERS)
 
 @app.route('/api/config/update', methods=['POST'])
 @login_required
 def update_config():
     """Update configuration"""
     try:
-        data = request.get_json()
-        config = load_config()
-        
-        # Update configuration
-        for key, value in data.items():
-            config[key] = value
+        changes = dict(request.get_json())
+        changes['updated_at'] = datetime.now().isoformat()
         
-        config['updated_at'] = datetime.now().isoformat()
-        
-        if save_config(config):
+        if merge_config(changes):
+            if any(key.startswith('prune_') or key.endswith('retention') for key in changes):
+                update_prune_schedule(load_config())
             return jsonify({'status': 'success', 'message': 'Configuration updated'})
         else:
             return jsonify({'status': 'error', 'message': 'Failed to save configuration'})
@@ -533,88 +970,87 @@ def test_rclone():
 @app.route('/download/logs')
 @login_required
 def download_logs():
-    """Download application logs as a zip file"""
+    """Stream application logs and configuration as a zip file
+    
+    Optional query arguments: since/until (date or timestamp), level (minimum
+    level) and compression (deflated, bzip2 or stored).
+    """
     try:
-        # Create a temporary zip file
-        memory_file = io.BytesIO()
-        
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Add application log
-            if os.path.exists('/data/app.log'):
-                zf.write('/data/app.log', 'app.log')
-            
-            # Add cron log
-            if os.path.exists('/data/cron.log'):
-                zf.write('/data/cron.log', 'cron.log')
-            
-            # Add configuration
-            if os.path.exists(CONFIG_PATH):
-                zf.write(CONFIG_PATH, 'config.json')
-            
-            # Add recent logs from backup engine
-            logs = backup_engine.get_recent_logs(limit=1000)
-            if logs:
-                logs_content = '\n'.join([
-                    f"[{log['timestamp']}] {log['level']}: {log['message']}"
-                    for log in logs
-                ])
-                zf.writestr('backup_engine.log', logs_content)
-        
-        memory_file.seek(0)
-        
-        return send_file(
-            io.BytesIO(memory_file.read()),
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'backup-logs-{datetime.now().strftime("%Y%m%d-%H%M%S")}.zip'
+        log_filter = LogFilter(
+            since=parse_time_filter(request.args.get('since')),
+            until=parse_time_filter(request.args.get('until'), end_of_day=True),
+            level=request.args.get('level') or None
         )
-    except Exception as e:
-        logger.error(f"Error creating log download: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        members = [
+            (f'app.log.{index}', log_filter.lines(read_lines(f'/data/app.log.{index}')))
+            for index in range(APP_LOG_BACKUPS, 0, -1)
+            if os.path.exists(f'/data/app.log.{index}')
+        ]
+        members += [
+            ('app.log', log_filter.lines(read_lines('/data/app.log'))),
+            ('cron.log', log_filter.lines(read_lines('/data/cron.log'))),
+            ('backup_engine.log', log_filter.entries(backup_engine.get_recent_logs(limit=1000)))
+        ]
+        if os.path.exists(CONFIG_PATH):
+            members.append(('config.json', read_lines(CONFIG_PATH)))
+        
+        chunks = stream_bundle(members, compression=request.args.get('compression', 'deflated'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    filename = f'backup-logs-{datetime.now().strftime("%Y%m%d-%H%M%S")}.zip'
+    return Response(chunks, mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/download/backup/<snapshot_id>')
 @login_required
 def download_backup(snapshot_id):
-    """Download a backup snapshot as a tar.gz file"""
+    """Stream a backup snapshot, or a directory or file inside it, as tar, tar.gz or zip"""
     try:
-        # Create temporary directory for extraction
-        with tempfile.TemporaryDirectory() as temp_dir:
-            extract_path = os.path.join(temp_dir, 'backup')
-            os.makedirs(extract_path)
-            
-            # Restore backup to temporary location
-            env = backup_engine._get_env_vars()
-            env['RCLONE_CONFIG'] = RCLONE_CONFIG_PATH
-            
-            result = subprocess.run([
-                'restic', 'restore', snapshot_id, '--target', extract_path
-            ], env=env, capture_output=True, text=True, timeout=300)
-            
-            if result.returncode != 0:
-                return jsonify({'status': 'error', 'message': f'Failed to extract backup: {result.stderr}'}), 500
-            
-            # Create tar.gz archive
-            archive_path = os.path.join(temp_dir, f'backup-{snapshot_id}.tar.gz')
-            subprocess.run([
-                'tar', '-czf', archive_path, '-C', extract_path, '.'
-            ], check=True)
-            
-            return send_file(
-                archive_path,
-                mimetype='application/gzip',
-                as_attachment=True,
-                download_name=f'backup-{snapshot_id}.tar.gz'
-            )
+        chunks, mimetype, filename = backup_engine.export_snapshot(
+            snapshot_id,
+            path=request.args.get('path', '/'),
+            archive_format=request.args.get('format', 'tar.gz')
+        )
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+    except JobLimitReached as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 429
     except Exception as e:
         logger.error(f"Error creating backup download: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
+    
+    return Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{secure_filename(filename) or "download"}"',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/logs')
 @login_required
 def logs_page():
     """Logs viewing page"""
-    logs = backup_engine.get_recent_logs(limit=100)
-    return render_template('logs.html', logs=logs)
+    try:
+        filters, page, per_page = get_log_filters(request.args)
+    except ValueError as e:
+        flash(f'Invalid filter: {e}', 'error')
+        filters, page, per_page = {}, 1, 100
+    
+    cursor = backup_engine.logs.cursor
+    logs, total, counts = backup_engine.query_logs(page=page, per_page=per_page, **filters)
+    
+    return render_template('logs.html',
+                         logs=list(reversed(logs)),
+                         cursor=cursor,
+                         total=total,
+                         counts=counts,
+                         page=page,
+                         pages=max(1, (total + per_page - 1) // per_page),
+                         filters=request.args,
+                         live=page == 1 and not filters.get('until'))
 
 @app.route('/api/status/detailed')
 @login_required
@@ -626,11 +1062,10 @@ def get_detailed_status():
     try:
         # Get disk usage
         data_usage = subprocess.run(['du', '-sh', '/data'], capture_output=True, text=True)
-        volumes_usage = subprocess.run(['du', '-sh', '/volumes'], capture_output=True, text=True)
         
         status['system'] = {
             'data_usage': data_usage.stdout.split()[0] if data_usage.returncode == 0 else 'Unknown',
-            'volumes_usage': volumes_usage.stdout.split()[0] if volumes_usage.returncode == 0 else 'Unknown',
+            'volumes_usage': format_bytes(volume_index.total_size()),
             'uptime': subprocess.run(['uptime', '-p'], capture_output=True, text=True).stdout.strip()
         }
     except:
@@ -4,78 +4,551 @@ import subprocess
 import threading
 import time
 import re
+import zlib
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 import logging
+from volume_index import load_volume_index
+from snapshot_catalog import SnapshotCatalog, DEFAULT_SYNC_INTERVAL
+from events import EventBroker, status_delta
+from config_store import load_config, merge_config
+from change_manifest import ChangeManifest, fingerprint_volume, is_unchanged, DEFAULT_MAX_SKIP_DAYS
+from log_store import (LogBuffer, LogStore, DEFAULT_LOG_CAPACITY, DEFAULT_LOG_RETENTION_DAYS,
+                       DEFAULT_LOG_MAX_SIZE_MB)
+from restic_cache import ResticCache, DEFAULT_CACHE_MAX_SIZE_MB
+from resource_governor import ResourceGovernor
+from tree_index import TreeIndex, DEFAULT_MAX_TREES
+from file_search import FileSearchIndex, series_key
+from snapshot_diff import SnapshotDiffCache, DEFAULT_MAX_DIFFS
+from restore_shards import plan_shards, shard_args, DEFAULT_RESTORE_WORKERS
+from maintenance import (PruneHistory, retention_policy, forget_args, summarize_forget, parse_prune_output,
+                         DEFAULT_PRUNE_MAX_UNUSED)
+from job_registry import JobRegistry, JobLimitReached, job_limits, DEFAULT_JOB_LIMITS
+from job_history import (JobHistory, volume_record, protected_at, DEFAULT_HISTORY_DAYS, DEFAULT_TREND_DAYS,
+                         DEFAULT_REGRESSION_FACTOR)
+from metrics import BackupMetrics
+from tracing import JobTrace, ResticPhases, BackupPhases, PRUNE_MARKERS, JOB_TRACK
 
 logger = logging.getLogger(__name__)
 
+# Concurrent restic processes when backup_workers is not configured
+DEFAULT_BACKUP_WORKERS = min(4, os.cpu_count() or 1)
+
+# Status lines per second requested from restic's --json output
+PROGRESS_FPS = 2
+
+# Seconds of samples used for the moving-average transfer rate
+RATE_WINDOW = 30
+
+# How long restic forget waits for a lock taken outside the job registry, e.g. by a catalog sync
+FORGET_RETRY_LOCK = '5m'
+
+# Repositories already verified or initialized, keyed by repository URL
+REPOSITORY_MARKER_PATH = '/data/repository.json'
+
+# Entries fetched per tree index page while planning restore shards
+SHARD_PLAN_PAGE_SIZE = 5000
+
+# Snapshot download formats: restic archive type, gzip the stream, mimetype, file suffix
+EXPORT_FORMATS = {
+    'tar': ('tar', False, 'application/x-tar', '.tar'),
+    'tar.gz': ('tar', True, 'application/gzip', '.tar.gz'),
+    'zip': ('zip', False, 'application/zip', '.zip')
+}
+
+# Bytes read from restic dump before each write to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Log lines kept with each job
+JOB_LOG_CAPACITY = 200
+
+# Seconds a successful job stays the headline of the status after finishing
+STATUS_LINGER = 5
+
+# Job types the status headline follows; checks and downloads are only listed under `jobs`
+HEADLINE_OPERATIONS = ('backup', 'restore', 'prune')
+
+class RestorePhase(Enum):
+    FETCHING_INDEX = "fetching_index"
+    DOWNLOADING_PACKS = "downloading_packs"
+    WRITING_FILES = "writing_files"
+    VERIFYING = "verifying"
+
+RESTORE_PHASE_MESSAGES = {
+    RestorePhase.FETCHING_INDEX: "Fetching repository index...",
+    RestorePhase.DOWNLOADING_PACKS: "Downloading packs from remote storage...",
+    RestorePhase.WRITING_FILES: "Writing files...",
+    RestorePhase.VERIFYING: "Verifying restored files..."
+}
+
 class BackupStatus(Enum):
     IDLE = "idle"
     RUNNING = "running"
     SUCCESS = "success"
     ERROR = "error"
 
-class BackupEngine:
-    def __init__(self):
-        self.status = BackupStatus.IDLE
-        self.current_operation = None
+class RepositoryStatus(Enum):
+    UNCONFIGURED = "unconfigured"
+    VERIFYING = "verifying"
+    READY = "ready"
+    UNREACHABLE = "unreachable"
+
+def parse_restic_json(line):
+    """Parse one line of restic --json output, or None for plain text"""
+    if not line.startswith('{'):
+        return None
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+def restore_phase(event):
+    """Phase a `restic restore --json` status message shows: packs are downloaded before files are written"""
+    return RestorePhase.WRITING_FILES if event.get('bytes_restored') else RestorePhase.DOWNLOADING_PACKS
+
+def restic_command(cmd):
+    """The restic subcommand of a command line, past any nice/ionice prefix"""
+    if 'restic' not in cmd:
+        return 'unknown'
+    index = cmd.index('restic') + 1
+    return cmd[index] if index < len(cmd) else 'unknown'
+
+def format_bytes(size):
+    """Human readable byte count"""
+    size = float(size or 0)
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(size) < 1024 or unit == 'TiB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{int(size)} B"
+        size /= 1024
+
+class TransferProgress:
+    """Byte-level progress of a restic run, fed from its JSON status messages"""
+    
+    def __init__(self, total_bytes=0, total_files=0):
+        self.bytes_done = 0
+        self.total_bytes = total_bytes
+        self.files_done = 0
+        self.total_files = total_files
+        self.current_files = []
+        self.samples = deque()
+    
+    def update(self, bytes_done=None, total_bytes=None, files_done=None, total_files=None,
+               current_files=None, now=None):
+        """Record a status message and add a sample to the rate window"""
+        now = now or time.time()
+        if bytes_done is not None:
+            self.bytes_done = bytes_done
+        if total_bytes:
+            self.total_bytes = max(self.total_bytes, total_bytes)
+        if files_done is not None:
+            self.files_done = files_done
+        if total_files:
+            self.total_files = max(self.total_files, total_files)
+        if current_files is not None:
+            self.current_files = current_files
+        
+        self.samples.append((now, self.bytes_done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+    
+    def update_restore(self, event, now=None):
+        """Record a status or summary message of `restic restore --json` (restic 0.17 and later)
+        
+        restic's totals honour include/exclude filters, so they replace totals sized up front.
+        Fields restic leaves out while they are zero count as zero.
+        """
+        if event.get('total_bytes'):
+            self.total_bytes = event['total_bytes']
+        if event.get('total_files'):
+            self.total_files = event['total_files']
+        self.update(bytes_done=event.get('bytes_restored', 0), files_done=event.get('files_restored', 0), now=now)
+    
+    @property
+    def rate(self):
+        """Bytes per second averaged over the sample window"""
+        if len(self.samples) < 2:
+            return None
+        (start, start_bytes), (end, end_bytes) = self.samples[0], self.samples[-1]
+        if end <= start:
+            return None
+        return max(0.0, (end_bytes - start_bytes) / (end - start))
+    
+    @property
+    def percent(self):
+        if not self.total_bytes:
+            return 0
+        return min(100.0, 100.0 * self.bytes_done / self.total_bytes)
+    
+    @property
+    def eta(self):
+        """Seconds remaining at the current rate"""
+        rate = self.rate
+        if not rate or not self.total_bytes:
+            return None
+        return max(0.0, (self.total_bytes - self.bytes_done) / rate)
+    
+    def as_dict(self):
+        return {
+            'bytes_done': self.bytes_done,
+            'total_bytes': self.total_bytes,
+            'files_done': self.files_done,
+            'total_files': self.total_files,
+            'current_files': list(self.current_files),
+            'throughput': self.rate,
+            'eta': self.eta
+        }
+
+class Job:
+    """One backup, restore, prune, check or export with its own progress, logs and result
+    
+    Fields are guarded by the engine's lock.
+    """
+    
+    def __init__(self, job_id, operation, params=None, source=None):
+        self.id = job_id
+        self.operation = operation
+        self.params = params or {}
+        self.source = source
+        self.status = BackupStatus.RUNNING
         self.progress = 0
         self.message = ""
-        self.logs = []
+        self.phase = None
+        self.start_time = time.time()
+        self.end_time = None
+        self.volume_status = {}
+        self.volume_transfers = {}
+        self.transfer = None
+        self.result = None
+        self.logs = deque(maxlen=JOB_LOG_CAPACITY)
+        self.trace = JobTrace()
+    
+    def volume_state(self, volume):
+        """Merge a volume's state with its live transfer figures"""
+        state = dict(self.volume_status[volume])
+        transfer = self.volume_transfers.get(volume)
+        if transfer is not None:
+            live = transfer.as_dict()
+            if state['status'] != 'running':
+                # Keep the final average throughput once the volume is done
+                live['throughput'] = state.get('throughput')
+                live['eta'] = None
+            state.update(live)
+        return state
+    
+    def transfer_totals(self):
+        """Roll the per-volume transfers up into overall byte counts, rate and ETA"""
+        totals = {'bytes_done': 0, 'total_bytes': 0, 'files_done': 0, 'total_files': 0,
+                  'throughput': 0.0, 'eta': None}
+        
+        for volume, state in self.volume_status.items():
+            transfer = self.volume_transfers.get(volume)
+            if transfer is None:
+                continue
+            total = max(transfer.total_bytes, state.get('size') or 0)
+            totals['total_bytes'] += total
+            totals['total_files'] += transfer.total_files
+            if state['status'] in ('success', 'error', 'skipped'):
+                totals['bytes_done'] += total
+                totals['files_done'] += transfer.total_files
+            else:
+                totals['bytes_done'] += transfer.bytes_done
+                totals['files_done'] += transfer.files_done
+                if state['status'] == 'running':
+                    totals['throughput'] += transfer.rate or 0.0
+        
+        if totals['throughput'] > 0 and totals['total_bytes']:
+            remaining = max(0, totals['total_bytes'] - totals['bytes_done'])
+            totals['eta'] = remaining / totals['throughput']
+        return totals
+    
+    def as_dict(self, detail=False):
+        """Progress and outcome; `detail` adds parameters, per-volume state and the job's log lines"""
+        job = {
+            'id': self.id,
+            'operation': self.operation,
+            'source': self.source,
+            'status': self.status.value,
+            'progress': self.progress,
+            'message': self.message,
+            'phase': self.phase.value if self.phase else None,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': (self.end_time or time.time()) - self.start_time,
+            'estimated_completion': None,
+            'result': self.result
+        }
+        
+        if self.volume_transfers:
+            job.update(self.transfer_totals())
+        elif self.transfer is not None:
+            job.update(self.transfer.as_dict())
+        
+        if self.status == BackupStatus.RUNNING:
+            if job.get('eta') is not None:
+                job['estimated_completion'] = time.time() + job['eta']
+            elif self.progress > 5:
+                # Only estimate after some progress
+                elapsed = time.time() - self.start_time
+                job['estimated_completion'] = self.start_time + elapsed * (100 / self.progress)
+        
+        if detail:
+            job['params'] = self.params
+            job['volumes'] = [self.volume_state(name) for name in self.volume_status]
+            job['logs'] = list(self.logs)
+        return job
+
+class BackupEngine:
+    def __init__(self):
+        self.logs = LogBuffer()
+        self.log_store = None
+        self.queue = None
+        self.jobs = JobRegistry(limits=lambda: job_limits(self._load_config()))
+        self.metrics = BackupMetrics()
+        self.metrics.on_collect(self._collect_metrics)
         self.lock = threading.Lock()
+        self.catalog = SnapshotCatalog()
+        self.change_manifest = ChangeManifest()
+        self.prune_history = PruneHistory()
+        self._catalog_sync_lock = threading.Lock()
+        self._catalog_wakeup = threading.Event()
+        self.events = EventBroker()
+        self.governor = ResourceGovernor(self._load_config, on_change=self._publish_status)
+        self._published_status = {}
+        self._publish_lock = threading.Lock()
+        
+        config = self._load_config()
+        self.logs.resize(config.get('log_capacity', DEFAULT_LOG_CAPACITY))
+        self.log_store = LogStore(
+            retention_days=config.get('log_retention_days', DEFAULT_LOG_RETENTION_DAYS),
+            max_size_mb=config.get('log_max_size_mb', DEFAULT_LOG_MAX_SIZE_MB)
+        )
+        self.history = JobHistory(retention_days=config.get('job_history_days', DEFAULT_HISTORY_DAYS))
+        self.tree_index = TreeIndex(max_trees=config.get('tree_index_max_snapshots', DEFAULT_MAX_TREES))
+        self.file_search = FileSearchIndex()
+        self.diff_cache = SnapshotDiffCache(max_diffs=config.get('diff_cache_max_pairs', DEFAULT_MAX_DIFFS))
+        self._search_lock = threading.Lock()
+        # Catalogued snapshots not in the search index yet, counted by each indexing pass
+        self.search_pending = None
+        self.restic_cache = ResticCache(
+            max_size_mb=config.get('restic_cache_max_size_mb', DEFAULT_CACHE_MAX_SIZE_MB)
+        )
+        self.repository_id = None
+        self._cache_warmup_started = False
+        self._seed_metrics()
         
-        # Ensure restic repository is initialized
-        self._init_repository()
+        # Verify the repository in the background so startup never waits on the remote
+        self.repository_status = RepositoryStatus.VERIFYING
+        self.repository_message = ""
+        self._repository_lock = threading.Lock()
+        self.start_repository_check()
     
-    def _init_repository(self):
-        """Initialize restic repository if it doesn't exist"""
+    def start_repository_check(self, force=False):
+        """Check (and if needed initialize) the repository as a check job in a background thread
+        
+        Returns False if a check is already running.
+        """
         try:
+            job = self._start_job('check', params={'force': force})
+        except JobLimitReached as e:
+            logger.info(f"Repository check not started: {e}")
+            return False
+        threading.Thread(target=self.run_check, args=(job,), name='repository-check', daemon=True).start()
+        return True
+    
+    def run_check(self, job):
+        """Run a repository check for a registered check job"""
+        with self.lock:
+            job.message = "Checking repository..."
+        with job.trace.span('ensure repository'):
+            ready = self.ensure_repository(force=job.params.get('force', False))
+        with self.lock:
+            message = self.repository_message
+            result = {'repository': self.repository_status.value}
+        self._finish_job(job, BackupStatus.SUCCESS if ready else BackupStatus.ERROR, message, result)
+    
+    def ensure_repository(self, force=False):
+        """Make sure the repository exists, initializing it if needed
+        
+        A repository URL that was verified before is trusted from the marker
+        in /data without contacting the remote, unless `force` is set.
+        Returns whether the repository is ready.
+        """
+        with self._repository_lock:
             env = self._get_env_vars()
             if not env.get('RESTIC_PASSWORD'):
-                logger.warning("RESTIC_PASSWORD not set")
-                return
+                self._set_repository_status(RepositoryStatus.UNCONFIGURED, "RESTIC_PASSWORD not set")
+                return False
+            
+            url = env['RESTIC_REPOSITORY']
+            if not force:
+                if self.repository_status == RepositoryStatus.READY:
+                    return True
+                marker = self._load_repository_markers().get(url)
+                if marker:
+                    self.repository_id = marker.get('id')
+                    self._set_repository_status(RepositoryStatus.READY, f"Verified {marker.get('verified_at')}")
+                    self._start_cache_warmup()
+                    return True
             
-            # Check if repository exists
-            result = subprocess.run([
-                'restic', 'snapshots'
-            ], env=env, capture_output=True, text=True, timeout=30)
-            
-            if result.returncode != 0:
-                # Repository doesn't exist, initialize it
-                logger.info("Initializing restic repository")
-                result = subprocess.run([
-                    'restic', 'init'
-                ], env=env, capture_output=True, text=True, timeout=60)
+            self._set_repository_status(RepositoryStatus.VERIFYING, f"Checking {url}")
+            try:
+                # Reading the config file is the cheapest request that proves the repository exists
+                result = self._run_restic(['restic', 'cat', 'config'], env, timeout=60)
+                initialized = False
                 
-                if result.returncode == 0:
+                if result.returncode != 0:
+                    if 'Is there a repository' not in result.stderr and 'does not exist' not in result.stderr:
+                        self._set_repository_status(RepositoryStatus.UNREACHABLE, result.stderr.strip())
+                        return False
+                    
+                    logger.info("Initializing restic repository")
+                    result = self._run_restic(['restic', 'init'], env, timeout=120)
+                    if result.returncode != 0:
+                        self._set_repository_status(RepositoryStatus.UNREACHABLE,
+                                                    f"Failed to initialize repository: {result.stderr.strip()}")
+                        return False
                     logger.info("Repository initialized successfully")
-                else:
-                    logger.error(f"Failed to initialize repository: {result.stderr}")
+                    initialized = True
+                    # The new repository's ID names its cache directory, which must survive cache trimming
+                    result = self._run_restic(['restic', 'cat', 'config'], env, timeout=60)
+                if result.returncode == 0:
+                    self.repository_id = self._parse_repository_id(result.stdout)
+            except Exception as e:
+                self._set_repository_status(RepositoryStatus.UNREACHABLE, str(e))
+                return False
+            
+            verified_at = datetime.now().isoformat()
+            self._save_repository_marker(url, {'verified_at': verified_at, 'initialized': initialized,
+                                               'id': self.repository_id})
+            self._set_repository_status(RepositoryStatus.READY, f"Verified {verified_at}")
+            self._start_cache_warmup()
+            return True
+    
+    def _parse_repository_id(self, output):
+        """Repository ID from `restic cat config` output, which names its cache directory"""
+        try:
+            return json.loads(output).get('id')
+        except (ValueError, AttributeError):
+            return None
+    
+    def _start_cache_warmup(self):
+        """Warm the restic cache once per process, in the background"""
+        if self._cache_warmup_started or not self._load_config().get('restic_cache_warmup', True):
+            return
+        self._cache_warmup_started = True
+        threading.Thread(target=self.warm_cache, name='cache-warmup', daemon=True).start()
+    
+    def warm_cache(self):
+        """Load the repository index and snapshots into the restic cache
+        
+        Before warming, the index and snapshot files in the repository are
+        compared with those already cached; that is the hit/miss figure on
+        the status API and shows how much a restart kept.
+        """
+        env = self._get_env_vars()
+        try:
+            if self.repository_id is None:
+                result = self._run_restic(['restic', 'cat', 'config'], env, timeout=60)
+                if result.returncode == 0:
+                    self.repository_id = self._parse_repository_id(result.stdout)
+            if self.repository_id is None:
+                logger.warning("Repository ID unknown, skipping restic cache warm-up")
+                return
+            
+            repository_files = {}
+            for file_type in ('index', 'snapshots'):
+                # restic's list types are named like the cache directories they land in
+                result = self._run_restic(['restic', 'list', file_type, '--no-lock'], env, timeout=300)
+                if result.returncode != 0:
+                    raise Exception(result.stderr.strip())
+                repository_files[file_type] = result.stdout.split()
+            hits, misses = self.restic_cache.measure_coverage(self.repository_id, repository_files)
             
+            if misses and repository_files['snapshots']:
+                # Listing the root of the latest snapshot loads every index and snapshot file
+                started = time.time()
+                result = self._run_restic(['restic', 'ls', 'latest', '/', '--no-lock'], env, timeout=1800)
+                if result.returncode != 0:
+                    raise Exception(result.stderr.strip())
+                logger.info(f"Warmed restic cache: {misses} file(s) fetched, {hits} already cached, "
+                            f"in {time.time() - started:.1f}s")
+            else:
+                logger.info(f"restic cache already warm: {hits} file(s) cached")
+            self.restic_cache.mark_warmed()
+        except Exception as e:
+            logger.warning(f"restic cache warm-up failed: {e}")
+        finally:
+            self._trim_cache()
+    
+    def _trim_cache(self):
+        """Keep the restic cache within its size limit"""
+        try:
+            freed = self.restic_cache.enforce_limit(self.repository_id)
+            if freed:
+                logger.info(f"Evicted {format_bytes(freed)} from the restic cache")
+        except Exception as e:
+            logger.error(f"Error trimming restic cache: {e}")
+        self._publish_status()
+    
+    def _set_repository_status(self, status, message):
+        with self.lock:
+            changed = self.repository_status != status
+            self.repository_status = status
+            self.repository_message = message
+        if changed and status == RepositoryStatus.UNREACHABLE:
+            logger.error(f"Repository unreachable: {message}")
+        self._publish_status()
+    
+    def _load_repository_markers(self):
+        try:
+            with open(REPOSITORY_MARKER_PATH, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Error loading repository marker: {e}")
+            return {}
+    
+    def _save_repository_marker(self, url, marker):
+        """Record a verified repository atomically"""
+        try:
+            markers = self._load_repository_markers()
+            markers[url] = marker
+            tmp_path = f"{REPOSITORY_MARKER_PATH}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(markers, f, indent=2)
+            os.replace(tmp_path, REPOSITORY_MARKER_PATH)
         except Exception as e:
-            logger.error(f"Error initializing repository: {e}")
+            logger.error(f"Error saving repository marker: {e}")
     
     def _get_env_vars(self):
         """Get environment variables for restic/rclone"""
         env = os.environ.copy()
         env['RCLONE_CONFIG'] = '/data/rclone.conf'
         env['RESTIC_REPOSITORY'] = f"rclone:{env.get('RCLONE_REMOTE', 'onedrive')}:{env.get('RCLONE_FOLDER', 'backup')}"
+        env.setdefault('RESTIC_PROGRESS_FPS', str(PROGRESS_FPS))
+        env['RESTIC_CACHE_DIR'] = self.restic_cache.path
         return env
     
-    def _log_message(self, level, message):
-        """Add a log message"""
+    def _log_message(self, level, message, job=None):
+        """Add a log message, tagged with the job it belongs to"""
         log_entry = {
             'timestamp': datetime.now().isoformat(),
             'level': level,
-            'message': message
+            'message': message,
+            'job_id': job.id if job else None
         }
         
-        with self.lock:
-            self.logs.append(log_entry)
-            # Keep only last 1000 log entries
-            if len(self.logs) > 1000:
-                self.logs = self.logs[-1000:]
+        self.logs.append(log_entry)
+        if job is not None:
+            job.logs.append(log_entry)
+        if self.log_store is not None:
+            self.log_store.add(log_entry)
+        self.events.publish('log', log_entry)
         
         # Also log to Python logger
         if level == 'ERROR':
@@ -86,102 +559,735 @@ class BackupEngine:
             logger.info(message)
     
     def get_status(self):
-        """Get current status"""
+        """Get current status
+        
+        The top-level fields describe the newest running backup, restore or
+        prune, or the last one to finish: a success for STATUS_LINGER seconds,
+        a failure until the next one starts. `jobs` lists every running job.
+        """
+        headline = self.jobs.headline(HEADLINE_OPERATIONS)
+        active = self.jobs.active()
         with self.lock:
             status = {
-                'status': self.status.value,
-                'operation': self.current_operation,
-                'progress': self.progress,
-                'message': self.message,
-                'start_time': getattr(self, 'start_time', None),
-                'estimated_completion': getattr(self, 'estimated_completion', None)
+                'status': BackupStatus.IDLE.value,
+                'operation': None,
+                'progress': 0,
+                'message': "",
+                'start_time': None,
+                'estimated_completion': None,
+                'volumes': [],
+                'phase': None,
+                'job_id': None,
+                'jobs': [{key: job[key] for key in ('id', 'operation', 'source', 'progress', 'message', 'start_time')}
+                         for job in (job.as_dict() for job in active)],
+                'repository': self.repository_status.value,
+                'repository_message': self.repository_message,
+                'cache': self.restic_cache.stats()
             }
             
-            # Calculate estimated completion time
-            if self.status == BackupStatus.RUNNING and hasattr(self, 'start_time') and self.progress > 0:
-                elapsed = time.time() - self.start_time
-                if self.progress > 5:  # Only estimate after some progress
-                    total_estimated = elapsed * (100 / self.progress)
-                    remaining = total_estimated - elapsed
-                    status['estimated_completion'] = time.time() + remaining
-            
-            return status
+            if headline is not None:
+                job = headline.as_dict()
+                recent = headline.end_time is None or time.time() - headline.end_time < STATUS_LINGER
+                if recent:
+                    status.update({key: value for key, value in job.items()
+                                   if key not in ('id', 'source', 'end_time', 'duration', 'result')})
+                    status['job_id'] = headline.id
+                    status['volumes'] = [headline.volume_state(name) for name in headline.volume_status]
+                elif headline.status == BackupStatus.ERROR:
+                    # A failure stays visible until the next job starts
+                    status['status'] = job['status']
+                    status['message'] = job['message']
+                    status['volumes'] = [headline.volume_state(name) for name in headline.volume_status]
+        
+        if self.queue is not None:
+            status['queue'] = self.queue.stats()
+        status['resources'] = self.governor.status()
+        return status
     
-    def get_recent_logs(self, limit=50):
-        """Get recent log entries"""
+    def _publish_status(self):
+        """Push the status fields that changed since the last push to stream clients"""
+        with self._publish_lock:
+            status = self.get_status()
+            delta = status_delta(self._published_status, status)
+            self._published_status = status
+            if delta:
+                self.events.publish('status_delta', delta)
+    
+    def _start_job(self, operation, job_id=None, params=None, source=None):
+        """Register a new job, raising JobLimitReached if its type is at its concurrency limit"""
+        job_id = job_id or f"{operation}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4]}"
+        job = Job(job_id, operation, params, source)
+        self.jobs.add(job)
+        self._publish_status()
+        return job
+    
+    def _finish_job(self, job, status, message, result=None):
+        """Record a job's outcome and move it to the finished jobs"""
         with self.lock:
-            return self.logs[-limit:] if self.logs else []
+            job.status = status
+            job.message = message
+            job.end_time = time.time()
+            job.phase = None
+            if status == BackupStatus.SUCCESS:
+                job.progress = 100
+            if result is not None:
+                job.result = result
+        self.jobs.finish(job)
+        self._record_metrics(job)
+        self._record_history(job)
+        self._publish_status()
+        
+        # Let stream clients see the success drop off the headline
+        timer = threading.Timer(STATUS_LINGER, self._publish_status)
+        timer.daemon = True
+        timer.start()
     
-    def list_snapshots(self):
-        """List all backup snapshots"""
+    def _record_metrics(self, job):
+        """Add a finished job's duration and transferred bytes to the metrics"""
+        with self.lock:
+            operation = job.operation
+            status = job.status.value
+            duration = (job.end_time or time.time()) - job.start_time
+            volumes = [volume_record(state) for state in job.volume_status.values()]
+            result = job.result or {}
         try:
-            env = self._get_env_vars()
-            result = subprocess.run([
-                'restic', 'snapshots', '--json'
-            ], env=env, capture_output=True, text=True, timeout=60)
-            
-            if result.returncode == 0:
-                snapshots = json.loads(result.stdout)
-                # Format snapshots for display
-                formatted_snapshots = []
-                for snapshot in snapshots:
-                    formatted_snapshots.append({
-                        'id': snapshot.get('short_id', snapshot.get('id', 'Unknown')),
-                        'time': snapshot.get('time', 'Unknown'),
-                        'hostname': snapshot.get('hostname', 'Unknown'),
-                        'paths': snapshot.get('paths', []),
-                        'tags': snapshot.get('tags', [])
-                    })
-                return formatted_snapshots
-            else:
-                self._log_message('ERROR', f"Failed to list snapshots: {result.stderr}")
-                return []
+            self.metrics.job_duration.observe(duration, operation=operation, status=status)
+            processed = sum(volume['bytes_processed'] or 0 for volume in volumes) if volumes else result.get('bytes')
+            if processed:
+                self.metrics.bytes_processed.inc(processed, operation=operation)
+            if operation != 'backup':
+                return
+            for volume in volumes:
+                self.metrics.volume_bytes_processed.inc(volume['bytes_processed'] or 0, volume=volume['volume'])
+                self.metrics.volume_bytes_added.inc(volume['bytes_added'] or 0, volume=volume['volume'])
+                finished = protected_at(volume)
+                if finished is not None:
+                    self.metrics.last_success.set(finished, volume=volume['volume'])
         except Exception as e:
-            self._log_message('ERROR', f"Error listing snapshots: {e}")
-            return []
+            logger.error(f"Error recording metrics of job {job.id}: {e}")
     
-    def run_backup(self, selected_volumes):
-        """Run backup for selected volumes"""
+    def _seed_metrics(self):
+        """Fill gauges that outlive a restart from the history, prune runs and snapshot catalog"""
+        try:
+            for volume, finished in self.history.last_success('backup').items():
+                self.metrics.last_success.set(finished, volume=volume)
+            runs = self.prune_history.recent(1)
+            if runs and runs[0].get('status') == 'success':
+                self._update_repository_size(runs[0].get('summary') or {})
+            self._update_catalog_metrics()
+        except Exception as e:
+            logger.error(f"Error loading metrics: {e}")
+    
+    def _update_repository_size(self, summary):
+        remaining = summary.get('remaining', {}).get('bytes')
+        if remaining is not None:
+            self.metrics.repository_size.set(remaining)
+    
+    def _update_catalog_metrics(self):
+        """Refresh snapshot counts after a catalog sync, so scrapes never query the catalog"""
+        self.metrics.snapshots.replace({(volume,): count for volume, count in self.catalog.volume_counts().items()})
+        synced_at = self.catalog.synced_at()
+        if synced_at is not None:
+            self.metrics.catalog_synced.set(synced_at)
+    
+    def _collect_metrics(self):
+        running = {operation: 0 for operation in DEFAULT_JOB_LIMITS}
+        for job in self.jobs.active():
+            running[job.operation] = running.get(job.operation, 0) + 1
+        self.metrics.jobs_running.replace({(operation,): count for operation, count in running.items()})
+    
+    def _run_restic(self, cmd, env, timeout, job=None, track=JOB_TRACK):
+        """Run a short restic command to completion, recording its runtime"""
+        started = time.monotonic()
+        try:
+            result = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._observe_restic(cmd, started, None, job, track)
+            raise
+        self._observe_restic(cmd, started, result.returncode, job, track)
+        return result
+    
+    def _observe_restic(self, cmd, started, returncode, job=None, track=JOB_TRACK):
+        """Record the runtime of a restic process, and add it to the job's trace
+        
+        A return code of None counts as a failure.
+        """
+        command = restic_command(cmd)
+        elapsed = time.monotonic() - started
+        self.metrics.restic_duration.observe(elapsed, command=command)
+        if returncode != 0:
+            self.metrics.restic_failures.inc(command=command)
+        if job is not None:
+            end = time.time()
+            job.trace.add(f"restic {command}", end - elapsed, end, track, exit_code=returncode)
+    
+    def _record_history(self, job):
+        """Store a finished job in the history and warn about volumes whose backup regressed"""
         with self.lock:
-            if self.status == BackupStatus.RUNNING:
-                self._log_message('WARNING', "Backup already running")
+            record = dict(job.as_dict(), params=job.params)
+            volumes = [volume_record(state) for state in job.volume_status.values()]
+        try:
+            self.history.record(record, volumes, job.trace.spans())
+            if job.operation != 'backup' or not volumes:
                 return
-            
-            self.status = BackupStatus.RUNNING
-            self.current_operation = "backup"
-            self.progress = 0
-            self.message = "Preparing backup..."
-            self.start_time = time.time()
+            for trend in self.job_trends():
+                if trend['volume'] in job.volume_status:
+                    for regression in trend['regressions']:
+                        self._log_message('WARNING', regression, job)
+        except Exception as e:
+            logger.error(f"Error recording job {job.id} in the history: {e}")
+    
+    def job_trends(self, days=None):
+        """Latest backup of each volume against its median over the trend window"""
+        config = self._load_config()
+        try:
+            days = int(days or config.get('history_trend_days', DEFAULT_TREND_DAYS))
+            factor = float(config.get('history_regression_factor', DEFAULT_REGRESSION_FACTOR))
+        except (TypeError, ValueError):
+            days, factor = DEFAULT_TREND_DAYS, DEFAULT_REGRESSION_FACTOR
+        return self.history.trends(days, factor)
+    
+    def get_job(self, job_id):
+        """One job with its parameters, per-volume state and log lines, or None
+        
+        Jobs that dropped out of memory are read back from the history,
+        without their log lines.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return self.history.get(job_id)
+        with self.lock:
+            return job.as_dict(detail=True)
+    
+    def get_trace(self, job_id):
+        """A job's trace spans with its id, operation, status and start and end time, or None
+        
+        Phases of a running job end now and are marked open.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return self.history.get_trace(job_id)
+        now = time.time()
+        with self.lock:
+            trace = {
+                'id': job.id,
+                'operation': job.operation,
+                'status': job.status.value,
+                'start_time': job.start_time,
+                'end_time': job.end_time or now
+            }
+        trace['spans'] = job.trace.spans(now)
+        return trace
+    
+    def list_jobs(self, operation=None, status=None, limit=None):
+        """Running and recently finished jobs, newest first"""
+        jobs = self.jobs.list(operation, status, limit)
+        with self.lock:
+            return [job.as_dict() for job in jobs]
+    
+    def admit_job(self, queued):
+        """Register a spooled job under its queue ID, raising JobLimitReached while it cannot start"""
+        return self._start_job(queued['type'], queued['id'], queued['params'], queued.get('source'))
+    
+    def abandon_job(self, job, message):
+        """Fail a job that is still running after its handler returned, so it gives up its slot"""
+        with self.lock:
+            running = job.status == BackupStatus.RUNNING
+        if running:
+            self._finish_job(job, BackupStatus.ERROR, message)
+    
+    def get_recent_logs(self, limit=50, level=None):
+        """Get recent log entries"""
+        return self.logs.recent(limit, level)
+    
+    def get_logs_since(self, after, level=None, limit=None):
+        """Log entries newer than a sequence number, with the next cursor"""
+        return self.logs.since(after, level, limit)
+    
+    def query_logs(self, since=None, until=None, level=None, text=None, job_id=None, page=1, per_page=100):
+        """Search the persistent log history, newest first"""
+        self.log_store.flush()
+        return self.log_store.query(since=since, until=until, level=level, text=text,
+                                    job_id=job_id, page=page, per_page=per_page)
+    
+    def list_snapshots(self, tag=None, path=None, host=None, since=None, until=None, page=1, per_page=50):
+        """List backup snapshots from the local catalog"""
+        try:
+            return self.catalog.query(tag=tag, path=path, host=host, since=since, until=until,
+                                      page=page, per_page=per_page)
+        except Exception as e:
+            self._log_message('ERROR', f"Error listing snapshots: {e}")
+            return [], 0
+    
+    def sync_snapshots(self):
+        """Refresh the local snapshot catalog from the repository"""
+        with self._catalog_sync_lock:
+            try:
+                env = self._get_env_vars()
+                result = self._run_restic(['restic', 'snapshots', '--json'], env, timeout=300)
+                
+                if result.returncode != 0:
+                    self._log_message('ERROR', f"Failed to list snapshots: {result.stderr}")
+                    return False
+                
+                added, removed = self.catalog.sync(json.loads(result.stdout) or [])
+                if added or removed:
+                    self._log_message('INFO', f"Snapshot catalog synced: {added} added, {removed} removed")
+                if removed:
+                    self.tree_index.retain(self.catalog.ids())
+                    self.diff_cache.retain(self.catalog.ids())
+                self._update_catalog_metrics()
+                self.start_search_indexing()
+                return True
+            except Exception as e:
+                self._log_message('ERROR', f"Error syncing snapshot catalog: {e}")
+                return False
+    
+    def start_catalog_sync(self, interval=DEFAULT_SYNC_INTERVAL):
+        """Sync the snapshot catalog now and then every interval seconds in the background"""
+        def sync_loop():
+            while True:
+                self.sync_snapshots()
+                self._catalog_wakeup.wait(interval)
+                self._catalog_wakeup.clear()
+        
+        thread = threading.Thread(target=sync_loop, name='catalog-sync', daemon=True)
+        thread.start()
+    
+    def request_catalog_sync(self):
+        """Wake the background catalog sync"""
+        self._catalog_wakeup.set()
+    
+    def browse_snapshot(self, snapshot_id, path=None, page=1, per_page=500):
+        """List one directory of a snapshot from the tree index
+        
+        The first request for a snapshot starts indexing it in the background
+        and reports 'indexing'; after that directories are listed from SQLite
+        without running restic.
+        """
+        snapshot = self.catalog.get(snapshot_id)
+        if snapshot is None:
+            raise LookupError(f"Unknown snapshot: {snapshot_id}")
+        
+        state = self.ensure_tree_index(snapshot['full_id'])
+        if state['status'] != 'ready':
+            return {'status': state['status'], 'snapshot': snapshot['id'], 'error': state.get('error')}
+        
+        # Open single-path snapshots (one per volume) at the volume's directory
+        default = not path
+        if default:
+            path = snapshot['paths'][0] if len(snapshot['paths']) == 1 else '/'
+        path = '/' + path.strip('/')
+        listing = self.tree_index.list_dir(snapshot['full_id'], path, page, per_page)
+        if listing is None and default:
+            path = '/'
+            listing = self.tree_index.list_dir(snapshot['full_id'], path, page, per_page)
+        if listing is None:
+            raise FileNotFoundError(f"{path} is not a directory in snapshot {snapshot['id']}")
+        entries, total = listing
+        return {
+            'status': 'ready',
+            'snapshot': snapshot['id'],
+            'path': path,
+            'parent': os.path.dirname(path) if path != '/' else None,
+            'entries': entries,
+            'total': total,
+            'page': page,
+            'per_page': per_page
+        }
+    
+    def ensure_tree_index(self, full_id, wait=False):
+        """Make sure a snapshot's tree is indexed, building it if needed
+        
+        Without `wait` the build runs in the background and the returned state
+        is 'indexing' until it is done.
+        """
+        state = self.tree_index.state(full_id)
+        if state is not None and state['status'] == 'ready':
+            return state
+        
+        if self.tree_index.claim(full_id):
+            if not wait:
+                threading.Thread(target=self._build_tree_index, args=(full_id,),
+                                 name='tree-index', daemon=True).start()
+                return {'status': 'indexing', 'error': state.get('error') if state else None}
+            try:
+                self._build_tree_index(full_id)
+            except Exception:
+                pass
+        elif wait:
+            while self.tree_index.state(full_id) == {'status': 'building'}:
+                time.sleep(0.5)
+        
+        state = self.tree_index.state(full_id)
+        if state is None or state['status'] == 'building':
+            return {'status': 'indexing', 'error': None}
+        return state
+    
+    def _build_tree_index(self, full_id):
+        """Index a snapshot's tree from `restic ls --json`; the caller has claimed it"""
+        started = time.time()
+        try:
+            entries = self.tree_index.build(full_id, self._list_snapshot_nodes(full_id))
+            self._log_message('INFO', f"Indexed snapshot {full_id[:8]}: {entries} entries "
+                                      f"in {time.time() - started:.1f}s")
+        except Exception as e:
+            self._log_message('ERROR', f"Failed to index snapshot {full_id[:8]}: {e}")
+            raise
+    
+    def _list_snapshot_nodes(self, full_id):
+        """Yield every node of a snapshot from `restic ls --json`, raising if restic fails
+        
+        Listings run with --no-lock, so they neither wait for nor block a prune or forget.
+        """
+        cmd = ['restic', 'ls', '--json', '--no-lock', full_id]
+        for node in self._stream_restic_json(cmd):
+            if node.get('struct_type') == 'node':
+                yield node
+    
+    def _stream_restic_json(self, cmd):
+        """Yield the JSON objects a restic command prints, raising if it fails
+        
+        restic is killed if the consumer stops early.
+        """
+        started = time.monotonic()
+        process = subprocess.Popen(cmd, env=self._get_env_vars(),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        errors = []
+        
+        def read_errors():
+            for line in process.stderr:
+                errors.append(line.strip())
+        
+        error_reader = threading.Thread(target=read_errors, daemon=True)
+        error_reader.start()
+        try:
+            for line in process.stdout:
+                data = parse_restic_json(line)
+                if data:
+                    yield data
+            if process.wait() != 0:
+                error_reader.join(timeout=5)
+                raise RuntimeError(' '.join(errors[-3:]) or
+                                   f"restic {cmd[1]} exited with return code {process.returncode}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            self._observe_restic(cmd, started, process.returncode)
+    
+    def start_search_indexing(self):
+        """Bring the file search index up to date in the background"""
+        threading.Thread(target=self.update_search_index, name='search-index', daemon=True).start()
+    
+    def update_search_index(self):
+        """Add catalogued snapshots the search index has not seen yet, oldest first
+        
+        Listings run with --no-lock so indexing never blocks a prune. When a
+        listing fails, the rest of its series waits for the next pass, which
+        retries it after the next catalog sync; indexing a newer snapshot
+        first would leave the failed one out for good.
+        """
+        if not self._load_config().get('search_index_enabled', True):
+            return
+        if not self._search_lock.acquire(blocking=False):
+            return
+        try:
+            catalog_ids = self.catalog.ids()
+            self.file_search.retain(catalog_ids)
+            pending = [self.catalog.get(snapshot_id) for snapshot_id in catalog_ids - self.file_search.indexed_ids()]
+            pending.sort(key=lambda snapshot: snapshot['time_unix'])
+            self.search_pending = len(pending)
+            failed_series = set()
+            for snapshot in pending:
+                if series_key(snapshot) in failed_series:
+                    continue
+                latest = self.file_search.series_latest(snapshot)
+                if latest is not None and latest > snapshot['time_unix']:
+                    # Version runs follow snapshot order; a snapshot older than the indexed ones cannot be folded in
+                    continue
+                started = time.time()
+                try:
+                    entries = self.file_search.add_snapshot(snapshot, self._list_snapshot_nodes(snapshot['full_id']))
+                    self.search_pending -= 1
+                    logger.info(f"Search index: added snapshot {snapshot['id']} ({entries} entries) "
+                                f"in {time.time() - started:.1f}s")
+                except Exception as e:
+                    failed_series.add(series_key(snapshot))
+                    logger.error(f"Search index: failed to add snapshot {snapshot['id']}: {e}")
+        finally:
+            self._search_lock.release()
+    
+    def search_files(self, query, limit=None):
+        """Search paths across all indexed snapshots"""
+        result = self.file_search.search(query, **({'limit': limit} if limit else {}))
+        result.update(self.file_search.stats())
+        if self.search_pending is None:
+            self.search_pending = len(self.catalog.ids() - self.file_search.indexed_ids())
+        result['pending'] = self.search_pending
+        return result
+    
+    def diff_snapshots(self, snapshot_id, against=None, path=None, limit=None):
+        """What changed between two snapshots, rolled up below one directory
+        
+        Without `against` a snapshot is compared with the one it follows. The
+        first request for a pair diffs it in the background and reports
+        'computing'; after that it is served from the diff cache.
+        """
+        snapshot = self.catalog.get(snapshot_id)
+        if snapshot is None:
+            raise LookupError(f"Unknown snapshot: {snapshot_id}")
+        base = self.catalog.get(against) if against else self.catalog.previous(snapshot)
+        if base is None:
+            if against:
+                raise LookupError(f"Unknown snapshot: {against}")
+            return {'status': 'none', 'snapshot': snapshot['id'], 'against': None,
+                    'message': 'First snapshot of this volume, nothing to compare with'}
+        
+        state = self.ensure_snapshot_diff(base['full_id'], snapshot['full_id'])
+        if state['status'] != 'ready':
+            return {'status': state['status'], 'snapshot': snapshot['id'], 'against': base['id'],
+                    'error': state.get('error')}
+        
+        if not path:
+            path = snapshot['paths'][0] if len(snapshot['paths']) == 1 else '/'
+        rollup = self.diff_cache.rollup(base['full_id'], snapshot['full_id'], path,
+                                        **({'limit': limit} if limit else {}))
+        if rollup is None:
+            # Evicted between the state check and the rollup
+            return {'status': 'computing', 'snapshot': snapshot['id'], 'against': base['id'], 'error': None}
+        summary = {key: state[key] for key in ('added_files', 'removed_files', 'modified_files', 'added_bytes',
+                                                'removed_bytes', 'modified_bytes', 'data_added', 'data_removed',
+                                                'computed_at', 'duration')}
+        return dict(rollup, status='ready', snapshot=snapshot['id'], against=base['id'],
+                    against_time=base['time'], summary=summary)
+    
+    def ensure_snapshot_diff(self, old_id, new_id):
+        """Make sure a snapshot pair is diffed, starting it in the background if needed"""
+        state = self.diff_cache.state(old_id, new_id)
+        if state is not None and state['status'] == 'ready':
+            return state
+        if self.diff_cache.claim(old_id, new_id):
+            threading.Thread(target=self._compute_snapshot_diff, args=(old_id, new_id),
+                             name='snapshot-diff', daemon=True).start()
+            return {'status': 'computing', 'error': state.get('error') if state else None}
+        return {'status': 'computing', 'error': None}
+    
+    def _compute_snapshot_diff(self, old_id, new_id):
+        """Diff a snapshot pair with `restic diff --json`; the caller has claimed it
+        
+        File sizes come from the tree index of both snapshots, which is built
+        first if needed. restic runs with --no-lock so a diff never blocks a
+        prune.
+        """
+        started = time.time()
+        sized = all(self.ensure_tree_index(full_id, wait=True)['status'] == 'ready' for full_id in (old_id, new_id))
+        if not sized:
+            self._log_message('WARNING', f"Diffing {old_id[:8]}..{new_id[:8]} without file sizes, "
+                                         f"a snapshot could not be indexed")
+        statistics = {}
+        
+        def changes():
+            for message in self._stream_restic_json(['restic', 'diff', '--json', '--no-lock', old_id, new_id]):
+                if message.get('message_type') == 'change' and message.get('path'):
+                    yield message['path'], message.get('modifier', '')
+                elif message.get('message_type') == 'statistics':
+                    statistics.update(message)
+        
+        def sizes(paths):
+            old_sizes = self.tree_index.sizes(old_id, paths)
+            new_sizes = self.tree_index.sizes(new_id, paths)
+            return {path: (old_sizes.get(path), new_sizes.get(path)) for path in paths}
+        
+        try:
+            self.diff_cache.store(old_id, new_id, changes(), statistics, sizes if sized else None)
+            self._log_message('INFO', f"Diffed snapshots {old_id[:8]}..{new_id[:8]} "
+                                      f"in {time.time() - started:.1f}s")
+        except Exception as e:
+            self._log_message('ERROR', f"Failed to diff snapshots {old_id[:8]}..{new_id[:8]}: {e}")
+    
+    def run_backup(self, selected_volumes, job=None):
+        """Run backup for selected volumes, one snapshot per volume
+        
+        `job` is a job the queue already admitted; without one a backup job is
+        registered here, unless the backup limit is reached.
+        """
+        if job is None:
+            try:
+                job = self._start_job('backup', params={'volumes': selected_volumes})
+            except JobLimitReached as e:
+                self._log_message('WARNING', f"Backup not started: {e}")
+                return None
+        
+        with self.lock:
+            job.message = "Preparing backup..."
+        self._publish_status()
         
         try:
-            self._log_message('INFO', f"Starting backup for volumes: {', '.join(selected_volumes)}")
+            self._log_message('INFO', f"Starting backup for volumes: {', '.join(selected_volumes)}", job)
+            self._require_repository()
             
-            # Prepare paths to backup
-            backup_paths = []
+            # Prepare volumes to backup
+            volumes = []
             for volume in selected_volumes:
                 volume_path = f"/volumes/{volume}"
                 if os.path.exists(volume_path):
-                    backup_paths.append(volume_path)
+                    volumes.append(volume)
                 else:
-                    self._log_message('WARNING', f"Volume path not found: {volume_path}")
+                    self._log_message('WARNING', f"Volume path not found: {volume_path}", job)
             
-            if not backup_paths:
+            if not volumes:
                 raise Exception("No valid volume paths found for backup")
             
-            # Update progress
+            # Largest volumes first so the longest job starts immediately
+            with job.trace.span('size volumes'):
+                sizes = self._get_volume_sizes(volumes)
+            volumes.sort(key=lambda name: sizes.get(name, 0), reverse=True)
+            workers = self._get_backup_workers(len(volumes))
+            
+            with self.lock:
+                for volume in volumes:
+                    job.volume_status[volume] = {
+                        'name': volume,
+                        'path': f"/volumes/{volume}",
+                        'status': 'pending',
+                        'progress': 0,
+                        'message': "Waiting for a worker...",
+                        'size': sizes.get(volume, 0),
+                        'throughput': None,
+                        'snapshot_id': None,
+                        'start_time': None,
+                        'end_time': None,
+                        'error': None,
+                        'summary': None,
+                        'files_scanned': None,
+                        'time_saved': None
+                    }
+                    job.volume_transfers[volume] = TransferProgress(total_bytes=sizes.get(volume, 0))
+                job.message = f"Backing up {len(volumes)} volumes with {workers} workers..."
+            
+            self._log_message('INFO', f"Backup order: {', '.join(volumes)} ({workers} workers)", job)
+            
+            date_tag = f"backup-{datetime.now().strftime('%Y-%m-%d')}"
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restic-backup') as pool:
+                list(pool.map(lambda volume: self._backup_volume(job, volume, date_tag), volumes))
+            
             with self.lock:
-                self.progress = 25
-                self.message = "Running backup..."
+                failed = [name for name, state in job.volume_status.items() if state['status'] == 'error']
+                skipped = [state for state in job.volume_status.values() if state['status'] == 'skipped']
+                scanned = sum(state['files_scanned'] or 0 for state in job.volume_status.values())
+                job.result = {
+                    'snapshots': {name: state['snapshot_id'] for name, state in job.volume_status.items()
+                                  if state['status'] == 'success'},
+                    'skipped': [state['name'] for state in skipped],
+                    'failed': failed
+                }
+            
+            message = "Backup completed successfully"
+            if scanned:
+                saved = sum(state['time_saved'] or 0 for state in skipped)
+                self._log_message('INFO', f"Change detection checked {scanned} entries: "
+                                          f"{len(skipped)} of {len(volumes)} volumes unchanged, about {saved:.0f}s saved",
+                                  job)
+                if skipped:
+                    message += (f" ({len(skipped)} unchanged volume{'s' if len(skipped) != 1 else ''} skipped, "
+                                f"about {saved:.0f}s saved)")
             
-            # Run restic backup
+            # Retention only applies to volumes whose backup went through
+            with job.trace.span('retention'):
+                self._apply_retention(job, [volume for volume in volumes if volume not in failed])
+            
+            if failed:
+                raise Exception(f"{len(failed)} of {len(volumes)} volumes failed: {', '.join(failed)}")
+            
+            self._log_message('INFO', message, job)
+            
+            # Update last backup time in config
+            self._update_last_backup_time(job)
+            self._finish_job(job, BackupStatus.SUCCESS, message)
+        
+        except Exception as e:
+            self._log_message('ERROR', f"Backup failed: {e}", job)
+            self._finish_job(job, BackupStatus.ERROR, str(e))
+        
+        finally:
+            # New snapshots should show up without waiting for the next timed sync
+            self.sync_snapshots()
+            self._trim_cache()
+        return job
+    
+    def _apply_retention(self, job, volumes):
+        """Forget snapshots of each volume that its retention policy no longer keeps
+        
+        Only snapshot records are removed here; the data they referenced is
+        freed by the separately scheduled prune. restic forget needs an
+        exclusive lock, so it waits until no restore or export is running.
+        """
+        config = self._load_config()
+        env = self._get_env_vars()
+        policies = [(volume, retention_policy(volume, config)) for volume in volumes]
+        policies = [(volume, policy) for volume, policy in policies if policy]
+        if not policies:
+            return
+        
+        with self.lock:
+            job.message = "Waiting for other jobs to release the repository..."
+        self._publish_status()
+        with self.jobs.exclusive(job):
+            for volume, policy in policies:
+                with self.lock:
+                    job.message = f"Applying retention policy to {volume}..."
+                self._publish_status()
+                try:
+                    cmd = (['restic', 'forget', '--json', '--retry-lock', FORGET_RETRY_LOCK,
+                            '--tag', f"volume:{volume}"] + forget_args(policy))
+                    result = self._run_restic(cmd, env, timeout=600, job=job, track=volume)
+                    if result.returncode != 0:
+                        self._log_message('ERROR', f"[{volume}] Retention failed: {result.stderr.strip()}", job)
+                        continue
+                    kept, removed = summarize_forget(result.stdout)
+                    self._log_message('INFO', f"[{volume}] Retention kept {len(kept)} snapshots, "
+                                              f"forgot {len(removed)}", job)
+                except Exception as e:
+                    self._log_message('ERROR', f"[{volume}] Retention failed: {e}", job)
+    
+    def run_prune(self, job=None):
+        """Remove data no snapshot references any more, within the configured cost bounds"""
+        if job is None:
+            try:
+                job = self._start_job('prune')
+            except JobLimitReached as e:
+                self._log_message('WARNING', f"Prune not started: {e}")
+                return None
+        
+        with self.lock:
+            job.message = "Pruning repository..."
+        self._publish_status()
+        
+        start = time.time()
+        config = self._load_config()
+        run = {
+            'started_at': datetime.now().isoformat(),
+            'job_id': job.id,
+            'max_unused': str(config.get('prune_max_unused', DEFAULT_PRUNE_MAX_UNUSED)),
+            'max_repack_size': config.get('prune_max_repack_size'),
+            'status': 'error',
+            'bytes_freed': 0,
+            'duration': None,
+            'summary': {},
+            'error': None
+        }
+        try:
+            self._require_repository()
             env = self._get_env_vars()
-            cmd = ['restic', 'backup'] + backup_paths + [
-                '--tag', 'docker-volumes',
-                '--tag', f"backup-{datetime.now().strftime('%Y-%m-%d')}"
-            ]
+            cmd = ['restic', 'prune', '--max-unused', run['max_unused']]
+            if run['max_repack_size']:
+                cmd += ['--max-repack-size', str(run['max_repack_size'])]
+            cmd, profile = self.governor.command(cmd)
             
-            self._log_message('INFO', f"Running command: {' '.join(cmd)}")
+            self._log_message('INFO', f"Running command ({profile} profile): {' '.join(cmd)}", job)
             
+            started = time.monotonic()
             process = subprocess.Popen(
                 cmd,
                 env=env,
@@ -191,88 +1297,334 @@ class BackupEngine:
                 bufsize=1,
                 universal_newlines=True
             )
+            self.governor.track(process.pid, "prune")
+            phases = ResticPhases(job.trace, markers=PRUNE_MARKERS)
+            output = []
+            try:
+                for line in process.stdout:
+                    line = line.rstrip()
+                    # Progress bars ("[0:05] 40.00% ...") are not worth keeping
+                    if not line or line.startswith('['):
+                        continue
+                    phases.line(line)
+                    output.append(line)
+                    self._log_message('INFO', f"Restic: {line}", job)
+                process.wait()
+            finally:
+                self.governor.untrack(process.pid)
+                phases.finish()
+                self._observe_restic(cmd, started, process.poll(), job)
             
-            # Read output in real-time
-            for line in process.stdout:
-                line = line.strip()
-                if line:
-                    self._log_message('INFO', f"Restic: {line}")
-                    
-                    # Update progress based on output patterns
-                    if "processed" in line.lower():
-                        # Try to extract file count for better progress estimation
-                        match = re.search(r'(\d+)\s+files', line)
-                        if match:
-                            files_processed = int(match.group(1))
-                            # Rough progress estimation based on file count
-                            progress_increment = min(5, max(1, files_processed // 100))
-                            with self.lock:
-                                self.progress = min(85, self.progress + progress_increment)
-                                self.message = f"Processing files... ({files_processed} files)"
-                    elif "backed up" in line.lower() or "snapshot" in line.lower():
-                        with self.lock:
-                            self.progress = min(95, self.progress + 10)
-                            self.message = "Finalizing backup..."
-                    elif "uploading" in line.lower():
-                        with self.lock:
-                            self.message = "Uploading to remote storage..."
+            if process.returncode != 0:
+                raise Exception(f"restic prune exited with return code {process.returncode}")
             
-            process.wait()
+            run['summary'] = parse_prune_output(output)
+            run['bytes_freed'] = run['summary'].get('total_prune', {}).get('bytes', 0)
+            run['status'] = 'success'
+            message = f"Prune freed {format_bytes(run['bytes_freed'])} in {time.time() - start:.1f}s"
+            self._log_message('INFO', message, job)
+        
+        except Exception as e:
+            run['error'] = str(e)
+            message = str(e)
+            self._log_message('ERROR', f"Prune failed: {e}", job)
+        
+        finally:
+            run['duration'] = time.time() - start
+            self.prune_history.record(run)
+            self._update_repository_size(run['summary'])
+            self._finish_job(job, BackupStatus.SUCCESS if run['status'] == 'success' else BackupStatus.ERROR,
+                             message, {'bytes_freed': run['bytes_freed'], 'summary': run['summary']})
+            self.sync_snapshots()
+            self._trim_cache()
+        return job
+    
+    def _backup_volume(self, job, volume, date_tag):
+        """Back up a single volume as its own snapshot"""
+        volume_path = f"/volumes/{volume}"
+        start = time.time()
+        with self.lock:
+            transfer = job.volume_transfers[volume]
+        self._update_volume_status(job, volume, status='running', message="Scanning files...",
+                                   start_time=start)
+        
+        try:
+            fingerprint = None
+            config = self._load_config()
+            if self._change_policy(volume, config) == 'skip':
+                self._update_volume_status(job, volume, message="Checking for changes...")
+                with job.trace.span('check for changes', volume):
+                    fingerprint = fingerprint_volume(volume_path)
+                self._update_volume_status(job, volume, files_scanned=fingerprint['entries'])
+                entry = self.change_manifest.get(volume)
+                if is_unchanged(entry, fingerprint, config.get('change_max_skip_days', DEFAULT_MAX_SKIP_DAYS)):
+                    self._skip_unchanged_volume(job, volume, entry, fingerprint)
+                    return
             
-            if process.returncode == 0:
-                with self.lock:
-                    self.status = BackupStatus.SUCCESS
-                    self.progress = 100
-                    self.message = "Backup completed successfully"
-                
-                self._log_message('INFO', "Backup completed successfully")
-                
-                # Update last backup time in config
-                self._update_last_backup_time()
+            env = self._get_env_vars()
+            cmd, profile = self.governor.command(['restic', 'backup', volume_path, '--json',
+                                                  '--tag', 'docker-volumes',
+                                                  '--tag', date_tag,
+                                                  '--tag', f"volume:{volume}"])
+            
+            self._log_message('INFO', f"[{volume}] Running command ({profile} profile): {' '.join(cmd)}", job)
+            
+            started = time.monotonic()
+            process = subprocess.Popen(
+                cmd,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                universal_newlines=True
+            )
+            self.governor.track(process.pid, f"backup of {volume}")
+            phases = BackupPhases(job.trace, volume)
+            try:
+                summary = None
                 
-            else:
-                raise Exception(f"Backup failed with return code {process.returncode}")
+                # Read output in real-time; parsing happens outside the lock
+                for line in process.stdout:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    
+                    event = parse_restic_json(line)
+                    if event is None:
+                        phases.line(line)
+                        self._log_message('INFO', f"[{volume}] Restic: {line}", job)
+                        continue
+                    
+                    phases.event(event)
+                    message_type = event.get('message_type')
+                    if message_type == 'status':
+                        files_done = event.get('files_done', 0)
+                        total_files = event.get('total_files', 0)
+                        with self.lock:
+                            transfer.update(bytes_done=event.get('bytes_done', 0),
+                                            total_bytes=event.get('total_bytes', 0),
+                                            files_done=files_done,
+                                            total_files=total_files,
+                                            current_files=event.get('current_files', []))
+                        self._update_volume_status(
+                            job, volume, message=f"Processing files... ({files_done}/{total_files} files)")
+                    elif message_type == 'summary':
+                        summary = event
+                    elif message_type == 'error':
+                        error = event.get('error', {})
+                        message = error.get('message', error) if isinstance(error, dict) else error
+                        self._log_message('WARNING', f"[{volume}] Restic error during {event.get('during', 'backup')}"
+                                                     f" of {event.get('item', 'unknown item')}: {message}", job)
+                    elif message_type == 'exit_error':
+                        self._log_message('ERROR', f"[{volume}] Restic: {event.get('message', line)}", job)
                 
-        except Exception as e:
+                process.wait()
+            finally:
+                self.governor.untrack(process.pid)
+                phases.finish()
+                self._observe_restic(cmd, started, process.poll(), job, volume)
+            
+            if process.returncode != 0:
+                raise Exception(f"restic exited with return code {process.returncode}")
+            
+            end = time.time()
+            summary = summary or {}
+            processed = summary.get('total_bytes_processed', transfer.total_bytes)
+            duration = summary.get('total_duration') or (end - start)
             with self.lock:
-                self.status = BackupStatus.ERROR
-                self.message = str(e)
-            self._log_message('ERROR', f"Backup failed: {e}")
+                transfer.update(bytes_done=processed, total_bytes=processed,
+                                files_done=summary.get('total_files_processed', transfer.files_done),
+                                total_files=summary.get('total_files_processed'),
+                                current_files=[])
+            
+            if fingerprint is not None:
+                # The fingerprint from before the run, so changes made during it are caught next time
+                self.change_manifest.record(volume, fingerprint, summary.get('snapshot_id'), end - start)
+            
+            self._update_volume_status(job, volume, status='success', progress=100,
+                                       message="Backup completed",
+                                       snapshot_id=summary.get('snapshot_id'),
+                                       throughput=processed / duration if duration else None,
+                                       summary=summary, end_time=end)
+            self._log_message('INFO', f"[{volume}] Snapshot {summary.get('snapshot_id', 'unknown')} saved: "
+                                      f"{summary.get('files_new', 0)} new, "
+                                      f"{summary.get('files_changed', 0)} changed, "
+                                      f"{summary.get('files_unmodified', 0)} unmodified files, "
+                                      f"{format_bytes(summary.get('data_added', 0))} added "
+                                      f"in {end - start:.1f}s", job)
+        
+        except Exception as e:
+            self._update_volume_status(job, volume, status='error', progress=100,
+                                       message=str(e), error=str(e), end_time=time.time())
+            self._log_message('ERROR', f"[{volume}] Backup failed: {e}", job)
         
         finally:
-            # Reset operation after a delay
-            threading.Timer(5.0, self._reset_operation).start()
+            with self.lock:
+                status = job.volume_status[volume]['status']
+            job.trace.add('backup', start, time.time(), volume, status=status)
     
-    def run_restore(self, snapshot_id, target_path):
-        """Run restore for a specific snapshot"""
+    def _change_policy(self, volume, config):
+        """Change detection policy of a volume: 'skip' unchanged volumes or 'off'"""
+        overrides = config.get('volume_change_detection') or {}
+        return overrides.get(volume, config.get('change_detection', 'off'))
+    
+    def _skip_unchanged_volume(self, job, volume, entry, fingerprint):
+        """Mark a volume whose fingerprint matches its last backup as skipped"""
+        saved = max(0.0, (entry.get('backup_duration') or 0) - fingerprint['duration'])
+        since = datetime.fromtimestamp(entry['backed_up_at']).strftime('%Y-%m-%d %H:%M')
+        self._update_volume_status(job, volume, status='skipped', progress=100,
+                                   message=f"Unchanged since {since}, skipped",
+                                   snapshot_id=entry.get('snapshot_id'),
+                                   time_saved=saved, end_time=time.time())
+        self._log_message('INFO', f"[{volume}] Unchanged since snapshot {entry.get('snapshot_id')} ({since}); "
+                                  f"skipped after checking {fingerprint['entries']} entries in "
+                                  f"{fingerprint['duration']:.1f}s, about {saved:.0f}s saved", job)
+    
+    def _update_volume_status(self, job, volume, **fields):
+        """Update one volume's state and roll progress up into the overall status"""
         with self.lock:
-            if self.status == BackupStatus.RUNNING:
-                self._log_message('WARNING', "Operation already running")
+            state = job.volume_status.get(volume)
+            if state is None:
                 return
+            state.update(fields)
+            
+            transfer = job.volume_transfers.get(volume)
+            if transfer is not None and state['status'] == 'running':
+                state['progress'] = int(transfer.percent)
             
-            self.status = BackupStatus.RUNNING
-            self.current_operation = "restore"
-            self.progress = 0
-            self.message = "Preparing restore..."
-            self.start_time = time.time()
+            states = list(job.volume_status.values())
+            totals = job.transfer_totals()
+            if totals['total_bytes'] > 0:
+                progress = 100.0 * totals['bytes_done'] / totals['total_bytes']
+            else:
+                progress = sum(s['progress'] for s in states) / len(states)
+            job.progress = min(99, int(progress))
+            
+            done = sum(1 for s in states if s['status'] in ('success', 'error', 'skipped'))
+            running = [s['name'] for s in states if s['status'] == 'running']
+            unit = 'shards' if job.operation == 'restore' else 'volumes'
+            job.message = f"{done}/{len(states)} {unit} done"
+            if totals['throughput']:
+                job.message += f" at {totals['throughput'] / 1048576:.1f} MB/s"
+            if running:
+                job.message += f", running: {', '.join(running)}"
+        
+        self._publish_status()
+    
+    def _require_repository(self):
+        """Wait for the repository check, retrying once if it found the remote unreachable"""
+        if self.ensure_repository():
+            return
+        if self.repository_status == RepositoryStatus.UNREACHABLE and self.ensure_repository(force=True):
+            return
+        raise Exception(f"Repository is {self.repository_status.value}: {self.repository_message}")
+    
+    def _get_volume_sizes(self, volumes):
+        """Get volume sizes in bytes, used to schedule the largest volumes first"""
+        index = load_volume_index()
+        sizes = {volume: index[volume]['size'] for volume in volumes if volume in index}
+        
+        def volume_size(volume):
+            try:
+                result = subprocess.run(['du', '-sk', f"/volumes/{volume}"],
+                                        capture_output=True, text=True)
+                if result.returncode == 0:
+                    return int(result.stdout.split()[0]) * 1024
+            except Exception:
+                pass
+            return 0
+        
+        # Only volumes the background index has not scanned yet need a du pass
+        missing = [volume for volume in volumes if volume not in sizes]
+        if missing:
+            with ThreadPoolExecutor(max_workers=self._get_backup_workers(len(missing))) as pool:
+                sizes.update(zip(missing, pool.map(volume_size, missing)))
+        return sizes
+    
+    def _get_backup_workers(self, volume_count):
+        """Number of concurrent restic backup processes"""
+        config = self._load_config()
+        try:
+            workers = int(config.get('backup_workers', DEFAULT_BACKUP_WORKERS))
+        except (TypeError, ValueError):
+            workers = DEFAULT_BACKUP_WORKERS
+        return max(1, min(workers, volume_count))
+    
+    def _load_config(self):
+        """Load configuration from the shared config store"""
+        return load_config()
+    
+    def run_restore(self, snapshot_id, target_path, verify=None, include=None, workers=None, job=None):
+        """Run restore for a specific snapshot, optionally only the paths in `include`
+        
+        With more than one worker a full restore is split into shards that
+        are restored by concurrent restic processes. `job` is a job the queue
+        already admitted; without one a restore job is registered here.
+        """
+        if job is None:
+            try:
+                job = self._start_job('restore', params={'snapshot_id': snapshot_id, 'target_path': target_path})
+            except JobLimitReached as e:
+                self._log_message('WARNING', f"Restore not started: {e}")
+                return None
+        
+        with self.lock:
+            job.message = "Preparing restore..."
+            job.transfer = TransferProgress()
+            job.phase = RestorePhase.FETCHING_INDEX
+        self._publish_status()
+        
+        if verify is None:
+            verify = bool(self._load_config().get('restore_verify', False))
         
         try:
-            self._log_message('INFO', f"Starting restore of snapshot {snapshot_id} to {target_path}")
+            self._log_message('INFO', f"Starting restore of snapshot {snapshot_id} to {target_path}"
+                                      + (f" ({len(include)} selected paths)" if include else ""), job)
+            self._require_repository()
             
             # Ensure target directory exists
             os.makedirs(target_path, exist_ok=True)
             
-            # Update progress
+            env = self._get_env_vars()
+            
+            workers = self._get_restore_workers(workers)
+            shards = None
+            if workers > 1 and not include:
+                with job.trace.span('plan shards'):
+                    shards = self._plan_restore_shards(job, snapshot_id, workers)
+            if shards:
+                self._run_sharded_restore(job, snapshot_id, shards, target_path, verify, workers)
+                return job
+            
+            # Size the restore up front so progress is measured in bytes
+            with self.lock:
+                job.message = "Reading snapshot metadata..."
+            self._publish_status()
+            # A partial restore is sized by restic's own totals once it starts
+            stats = self._get_snapshot_stats(job, snapshot_id, env) if not include else None
+            if stats:
+                with self.lock:
+                    job.transfer.total_bytes = stats.get('total_size', 0)
+                    job.transfer.total_files = stats.get('total_file_count', 0)
+                self._log_message('INFO', f"Snapshot {snapshot_id} holds {stats.get('total_file_count', 0)} files, "
+                                          f"{format_bytes(stats.get('total_size', 0))}", job)
+            
             with self.lock:
-                self.progress = 25
-                self.message = "Running restore..."
+                job.message = "Fetching repository index..."
+            self._publish_status()
             
             # Run restic restore
-            env = self._get_env_vars()
-            cmd = ['restic', 'restore', snapshot_id, '--target', target_path]
+            cmd = ['restic', 'restore', snapshot_id, '--target', target_path, '--json']
+            if verify:
+                cmd.append('--verify')
+            for path in include or []:
+                cmd += ['--include', path]
+            cmd, profile = self.governor.command(cmd)
             
-            self._log_message('INFO', f"Running command: {' '.join(cmd)}")
+            self._log_message('INFO', f"Running command ({profile} profile): {' '.join(cmd)}", job)
             
+            started = time.monotonic()
             process = subprocess.Popen(
                 cmd,
                 env=env,
@@ -282,76 +1634,413 @@ class BackupEngine:
                 bufsize=1,
                 universal_newlines=True
             )
-            
-            # Read output in real-time
-            for line in process.stdout:
-                line = line.strip()
-                if line:
-                    self._log_message('INFO', f"Restic: {line}")
+            self.governor.track(process.pid, f"restore of {snapshot_id}")
+            phases = ResticPhases(job.trace, initial=RestorePhase.FETCHING_INDEX.value)
+            try:
+                summary = None
+                
+                # Read output in real-time; parsing happens outside the lock
+                for line in process.stdout:
+                    line = line.strip()
+                    if not line:
+                        continue
                     
-                    # Update progress based on output patterns
-                    if "restored" in line.lower():
-                        match = re.search(r'(\d+)\s+files', line)
-                        if match:
-                            files_restored = int(match.group(1))
-                            progress_increment = min(5, max(1, files_restored // 50))
-                            with self.lock:
-                                self.progress = min(90, self.progress + progress_increment)
-                                self.message = f"Restoring files... ({files_restored} files)"
-                    elif "downloading" in line.lower():
-                        with self.lock:
-                            self.message = "Downloading from remote storage..."
-            
-            process.wait()
-            
-            if process.returncode == 0:
-                with self.lock:
-                    self.status = BackupStatus.SUCCESS
-                    self.progress = 100
-                    self.message = f"Restore completed successfully to {target_path}"
+                    event = parse_restic_json(line)
+                    if event is None:
+                        self._log_message('INFO', f"Restic: {line}", job)
+                        continue
+                    
+                    message_type = event.get('message_type')
+                    if message_type == 'status':
+                        phase = restore_phase(event)
+                        phases.enter(phase.value)
+                        self._update_restore_progress(job, phase, event)
+                    elif message_type == 'summary':
+                        summary = event
+                        # restic verifies the restored files after printing its summary
+                        phase = RestorePhase.VERIFYING if verify else RestorePhase.WRITING_FILES
+                        phases.enter(phase.value)
+                        self._update_restore_progress(job, phase, event)
+                    elif message_type in ('error', 'exit_error'):
+                        error = event.get('error', event.get('message', line))
+                        message = error.get('message', error) if isinstance(error, dict) else error
+                        self._log_message('WARNING', f"Restic: {message}", job)
                 
-                self._log_message('INFO', f"Restore completed successfully to {target_path}")
-            else:
+                process.wait()
+            finally:
+                self.governor.untrack(process.pid)
+                phases.finish()
+                self._observe_restic(cmd, started, process.poll(), job)
+            
+            if process.returncode != 0:
                 raise Exception(f"Restore failed with return code {process.returncode}")
-                
+            
+            summary = summary or {}
+            elapsed = time.time() - job.start_time
+            restored = summary.get('bytes_restored', 0)
+            self._log_message('INFO', f"Restore completed successfully to {target_path}: "
+                                      f"{summary.get('files_restored', 0)} files, {format_bytes(restored)} "
+                                      f"in {elapsed:.1f}s ({format_bytes(restored / elapsed if elapsed else 0)}/s)", job)
+            self._finish_job(job, BackupStatus.SUCCESS, f"Restore completed successfully to {target_path}",
+                             {'target_path': target_path, 'files': summary.get('files_restored', 0),
+                              'bytes': restored})
+        
         except Exception as e:
-            with self.lock:
-                self.status = BackupStatus.ERROR
-                self.message = str(e)
-            self._log_message('ERROR', f"Restore failed: {e}")
+            self._log_message('ERROR', f"Restore failed: {e}", job)
+            self._finish_job(job, BackupStatus.ERROR, str(e))
         
         finally:
-            # Reset operation after a delay
-            threading.Timer(5.0, self._reset_operation).start()
+            # Restores pull data packs into the cache
+            self._trim_cache()
+        return job
     
-    def _update_last_backup_time(self):
-        """Update the last backup time in configuration"""
+    def _get_restore_workers(self, requested=None):
+        """Number of concurrent restic restore processes"""
         try:
-            config_path = '/data/config.json'
-            config = {}
+            workers = int(requested or self._load_config().get('restore_workers', DEFAULT_RESTORE_WORKERS))
+        except (TypeError, ValueError):
+            workers = DEFAULT_RESTORE_WORKERS
+        return max(1, workers)
+    
+    def _plan_restore_shards(self, job, snapshot_id, workers):
+        """Split a snapshot into restore shards from its tree index; None restores it in one piece"""
+        snapshot = self.catalog.get(snapshot_id)
+        if snapshot is None:
+            self._log_message('WARNING', f"Snapshot {snapshot_id} is not in the catalog, "
+                                         f"restoring with a single process", job)
+            return None
+        
+        with self.lock:
+            job.message = "Indexing snapshot tree..."
+        self._publish_status()
+        full_id = snapshot['full_id']
+        state = self.ensure_tree_index(full_id, wait=True)
+        if state['status'] != 'ready':
+            self._log_message('WARNING', f"Snapshot {snapshot_id} could not be indexed, "
+                                         f"restoring with a single process", job)
+            return None
+        
+        def list_dir(path):
+            entries = []
+            page = 1
+            while True:
+                listing = self.tree_index.list_dir(full_id, path, page, SHARD_PLAN_PAGE_SIZE)
+                if listing is None:
+                    return entries
+                entries += listing[0]
+                if page * SHARD_PLAN_PAGE_SIZE >= listing[1]:
+                    return entries
+                page += 1
+        
+        shards = plan_shards(list_dir, '/', state['total_size'], workers)
+        if len(shards) < 2:
+            self._log_message('INFO', f"Snapshot {snapshot_id} has no directories to split, "
+                                      f"restoring with a single process", job)
+            return None
+        self._log_message('INFO', f"Restore of {snapshot_id} split into {len(shards)} shards: "
+                                  + ', '.join(format_bytes(shard['size']) for shard in shards), job)
+        return shards
+    
+    def _run_sharded_restore(self, job, snapshot_id, shards, target_path, verify, workers):
+        """Restore shards concurrently into one target, then check nothing is missing"""
+        workers = min(workers, len(shards))
+        # Read the file list up front; the tree index may evict this tree while the shards run
+        expected = list(self.tree_index.files(self.catalog.get(snapshot_id)['full_id']))
+        with self.lock:
+            for index, shard in enumerate(shards):
+                name = f"shard-{index + 1}"
+                job.volume_status[name] = {
+                    'name': name,
+                    'path': ', '.join(shard['include']) or "everything else",
+                    'status': 'pending',
+                    'progress': 0,
+                    'message': "Waiting for a worker...",
+                    'size': shard['size'],
+                    'throughput': None,
+                    'start_time': None,
+                    'end_time': None,
+                    'error': None,
+                    'summary': None
+                }
+                job.volume_transfers[name] = TransferProgress(total_bytes=shard['size'])
+                shard['name'] = name
+            job.phase = RestorePhase.DOWNLOADING_PACKS
+            job.message = f"Restoring {len(shards)} shards with {workers} workers..."
+        self._publish_status()
+        
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restic-restore') as pool:
+            list(pool.map(lambda shard: self._restore_shard(job, shard, snapshot_id, target_path, verify), shards))
+        
+        with self.lock:
+            failed = [name for name, state in job.volume_status.items() if state['status'] == 'error']
+            totals = job.transfer_totals()
+        if failed:
+            raise Exception(f"Restore failed for {', '.join(failed)}")
+        
+        with self.lock:
+            job.phase = RestorePhase.VERIFYING
+            job.message = "Checking restored files against the snapshot..."
+        self._publish_status()
+        with job.trace.span('check restored files'):
+            checked = self._check_restore_complete(job, expected, target_path)
+        
+        elapsed = time.time() - job.start_time
+        self._log_message('INFO', f"Restore completed successfully to {target_path}: {checked} files, "
+                                  f"{format_bytes(totals['bytes_done'])} in {elapsed:.1f}s with {workers} workers "
+                                  f"({format_bytes(totals['bytes_done'] / elapsed if elapsed else 0)}/s)", job)
+        self._finish_job(job, BackupStatus.SUCCESS, f"Restore completed successfully to {target_path}",
+                         {'target_path': target_path, 'files': checked, 'bytes': totals['bytes_done'],
+                          'shards': len(shards)})
+    
+    def _restore_shard(self, job, shard, snapshot_id, target_path, verify):
+        """Restore one shard of a snapshot with its own restic process"""
+        name = shard['name']
+        start = time.time()
+        with self.lock:
+            transfer = job.volume_transfers[name]
+        self._update_volume_status(job, name, status='running', message="Fetching repository index...",
+                                   start_time=start)
+        
+        try:
+            cmd = ['restic', 'restore', snapshot_id, '--target', target_path, '--json']
+            if verify:
+                cmd.append('--verify')
+            cmd, profile = self.governor.command(cmd + shard_args(shard))
+            self._log_message('INFO', f"[{name}] Running command ({profile} profile): {' '.join(cmd)}", job)
             
-            if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    config = json.load(f)
+            started = time.monotonic()
+            process = subprocess.Popen(
+                cmd,
+                env=self._get_env_vars(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                universal_newlines=True
+            )
+            self.governor.track(process.pid, f"restore of {snapshot_id} ({name})")
+            phases = ResticPhases(job.trace, name, initial=RestorePhase.FETCHING_INDEX.value)
+            try:
+                summary = None
+                
+                # Read output in real-time; parsing happens outside the lock
+                for line in process.stdout:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    
+                    event = parse_restic_json(line)
+                    if event is None:
+                        self._log_message('INFO', f"[{name}] Restic: {line}", job)
+                        continue
+                    
+                    message_type = event.get('message_type')
+                    if message_type in ('status', 'summary'):
+                        with self.lock:
+                            transfer.update_restore(event)
+                            files = f"{transfer.files_done}/{transfer.total_files} files"
+                        if message_type == 'summary':
+                            summary = event
+                        phase = restore_phase(event)
+                        phases.enter(phase.value)
+                        self._update_volume_status(job, name, message=f"{RESTORE_PHASE_MESSAGES[phase]} ({files})")
+                    elif message_type in ('error', 'exit_error'):
+                        error = event.get('error', event.get('message', line))
+                        message = error.get('message', error) if isinstance(error, dict) else error
+                        self._log_message('WARNING', f"[{name}] Restic: {message}", job)
+                
+                process.wait()
+            finally:
+                self.governor.untrack(process.pid)
+                phases.finish()
+                self._observe_restic(cmd, started, process.poll(), job, name)
             
-            config['last_backup'] = datetime.now().isoformat()
+            if process.returncode != 0:
+                raise Exception(f"restic exited with return code {process.returncode}")
             
-            with open(config_path, 'w') as f:
-                json.dump(config, f, indent=2)
-                
+            end = time.time()
+            summary = summary or {}
+            restored = summary.get('bytes_restored', transfer.bytes_done)
+            throughput = restored / (end - start) if end > start else None
+            self._update_volume_status(job, name, status='success', progress=100, message="Restore completed",
+                                       throughput=throughput, summary=summary, end_time=end)
+            self._log_message('INFO', f"[{name}] Restored {summary.get('files_restored', 0)} files, "
+                                      f"{format_bytes(restored)} in {end - start:.1f}s "
+                                      f"({format_bytes(throughput or 0)}/s)", job)
+        
+        except Exception as e:
+            self._update_volume_status(job, name, status='error', progress=100,
+                                       message=str(e), error=str(e), end_time=time.time())
+            self._log_message('ERROR', f"[{name}] Restore failed: {e}", job)
+        
+        finally:
+            with self.lock:
+                status = job.volume_status[name]['status']
+            job.trace.add('restore', start, time.time(), name, status=status)
+    
+    def _check_restore_complete(self, job, expected, target_path):
+        """Compare the restored files with the (path, size) list read from the snapshot's tree index
+        
+        Raises if any file is missing or has the wrong size, or if there is
+        nothing to compare with; returns the number of files checked.
+        """
+        if not expected:
+            raise Exception("Restore cannot be checked: the snapshot's tree index lists no files")
+        missing = []
+        mismatched = []
+        checked = 0
+        for path, size in expected:
+            checked += 1
+            try:
+                restored = os.lstat(os.path.join(target_path, path.lstrip('/')))
+            except OSError:
+                missing.append(path)
+                continue
+            if size is not None and restored.st_size != size:
+                mismatched.append(path)
+        
+        if missing or mismatched:
+            raise Exception(f"Restore incomplete: {len(missing)} missing and {len(mismatched)} mismatched "
+                            f"of {checked} files (e.g. {', '.join((missing + mismatched)[:5])})")
+        self._log_message('INFO', f"All {checked} files of the snapshot are present in {target_path}", job)
+        return checked
+    
+    def _update_restore_progress(self, job, phase, event):
+        """Apply a restic restore status or summary message"""
+        with self.lock:
+            job.transfer.update_restore(event)
+            job.phase = phase
+            job.progress = min(99, int(job.transfer.percent))
+            job.message = (f"{RESTORE_PHASE_MESSAGES[phase]} "
+                           f"({job.transfer.files_done}/{job.transfer.total_files} files)")
+        
+        self._publish_status()
+    
+    def _get_snapshot_stats(self, job, snapshot_id, env):
+        """Get restore size and file count of a snapshot"""
+        try:
+            result = self._run_restic(['restic', 'stats', snapshot_id, '--json', '--mode', 'restore-size'], env,
+                                      timeout=600, job=job)
+            
+            if result.returncode == 0:
+                return json.loads(result.stdout)
+            self._log_message('WARNING', f"Failed to read snapshot size: {result.stderr.strip()}", job)
         except Exception as e:
-            self._log_message('ERROR', f"Failed to update last backup time: {e}")
+            self._log_message('WARNING', f"Failed to read snapshot size: {e}", job)
+        return None
     
-    def _reset_operation(self):
-        """Reset operation status"""
+    def export_snapshot(self, snapshot_id, path='/', archive_format='tar.gz'):
+        """Stream a snapshot, or a directory or file inside it, with restic dump
+        
+        Returns a chunk iterator, the mimetype and the download name. Nothing
+        touches the disk and only one chunk is held in memory at a time.
+        Closing the iterator early (the client went away) kills restic.
+        Single files are sent as-is rather than wrapped in an archive.
+        """
+        if archive_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported archive format: {archive_format}")
+        if not re.fullmatch(r'[0-9a-fA-F]{4,64}|latest', snapshot_id):
+            raise ValueError(f"Invalid snapshot ID: {snapshot_id}")
+        
+        env = self._get_env_vars()
+        path = '/' + (path or '').strip('/')
+        name = f"backup-{snapshot_id}"
+        node_type = 'dir'
+        if path != '/':
+            node = self._get_snapshot_node(snapshot_id, path, env)
+            if node is None:
+                raise FileNotFoundError(f"{path} not found in snapshot {snapshot_id}")
+            node_type = node.get('type')
+            name += '-' + path.strip('/').replace('/', '_')
+        
+        if node_type == 'file':
+            cmd = ['restic', 'dump', snapshot_id, path]
+            compress = False
+            mimetype = 'application/octet-stream'
+            filename = os.path.basename(path)
+        else:
+            archive, compress, mimetype, suffix = EXPORT_FORMATS[archive_format]
+            cmd = ['restic', 'dump', '--archive', archive, snapshot_id, path]
+            filename = name + suffix
+        
+        job = self._start_job('export', params={'snapshot_id': snapshot_id, 'path': path, 'format': archive_format})
+        try:
+            started = time.monotonic()
+            process = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception as e:
+            self._finish_job(job, BackupStatus.ERROR, str(e))
+            raise
+        errors = deque(maxlen=20)
+        
+        def read_errors():
+            for line in process.stderr:
+                errors.append(line.decode(errors='replace').strip())
+        
+        error_reader = threading.Thread(target=read_errors, daemon=True)
+        error_reader.start()
+        
+        # Wait for the first bytes so a bad snapshot or path still becomes an error response
+        first_chunk = process.stdout.read1(EXPORT_CHUNK_SIZE)
+        if not first_chunk and process.wait() != 0:
+            error_reader.join(timeout=5)
+            self._observe_restic(cmd, started, process.returncode, job)
+            message = f"restic dump failed: {' '.join(errors)}"
+            self._finish_job(job, BackupStatus.ERROR, message)
+            raise RuntimeError(message)
+        
         with self.lock:
-            if self.status != BackupStatus.RUNNING:
-                self.current_operation = None
-                self.progress = 0
-                if hasattr(self, 'start_time'):
-                    delattr(self, 'start_time')
-                if hasattr(self, 'estimated_completion'):
-                    delattr(self, 'estimated_completion')
-                if self.status == BackupStatus.SUCCESS:
-                    self.status = BackupStatus.IDLE
-                    self.message = ""
\ No newline at end of file
+            job.message = f"Streaming {filename}..."
+        self._log_message('INFO', f"Streaming {path} from snapshot {snapshot_id} as {filename}", job)
+        
+        def chunks():
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+            sent = 0
+            status, message = BackupStatus.ERROR, "Download cancelled"
+            try:
+                chunk = first_chunk
+                while chunk:
+                    sent += len(chunk)
+                    data = compressor.compress(chunk) if compressor else chunk
+                    if data:
+                        yield data
+                    chunk = process.stdout.read1(EXPORT_CHUNK_SIZE)
+                if compressor:
+                    yield compressor.flush()
+                
+                if process.wait() != 0:
+                    error_reader.join(timeout=5)
+                    message = f"Download of snapshot {snapshot_id} is incomplete: {' '.join(errors)}"
+                    self._log_message('ERROR', message, job)
+                else:
+                    status, message = BackupStatus.SUCCESS, f"Streamed {format_bytes(sent)} from snapshot {snapshot_id}"
+                    self._log_message('INFO', message, job)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    message = f"Download of snapshot {snapshot_id} cancelled after {format_bytes(sent)}"
+                    self._log_message('WARNING', message, job)
+                process.wait()
+                process.stdout.close()
+                self._observe_restic(cmd, started, process.returncode, job)
+                self._finish_job(job, status, message, {'filename': filename, 'bytes': sent})
+        
+        return chunks(), mimetype, filename
+    
+    def _get_snapshot_node(self, snapshot_id, path, env):
+        """Look up a path in a snapshot by listing only its parent directory"""
+        parent = os.path.dirname(path)
+        result = self._run_restic(['restic', 'ls', snapshot_id, parent, '--json'], env, timeout=300)
+        
+        if result.returncode != 0:
+            raise RuntimeError(f"Failed to list snapshot: {result.stderr.strip()}")
+        
+        for line in result.stdout.splitlines():
+            node = parse_restic_json(line)
+            if node and node.get('struct_type') != 'snapshot' and node.get('path') == path:
+                return node
+        return None
+    
+    def _update_last_backup_time(self, job):
+        """Update the last backup time in configuration"""
+        if not merge_config({'last_backup': datetime.now().isoformat()}):
+            self._log_message('ERROR', "Failed to update last backup time", job)
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_PATH = '/data/change_manifest.json'
+
+# Days after which an unchanged volume is backed up anyway when change_max_skip_days is not configured
+DEFAULT_MAX_SKIP_DAYS = 7
+
+def _item_hash(*parts):
+    data = '\0'.join(str(part) for part in parts).encode('utf-8', errors='surrogateescape')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+def fingerprint_volume(path):
+    """Cheap change fingerprint of a volume that reads no file contents
+    
+    Covers every directory's mtime and entry count, which change whenever
+    files are created, deleted or renamed, plus the size and mtime of every
+    file to catch in-place edits, such as a database writing into its data
+    files. Item hashes are summed, so the digest does not depend on
+    directory listing order.
+    """
+    started = time.time()
+    digest = 0
+    dirs = 0
+    entries = 0
+    files = 0
+    errors = 0
+    
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            stat = os.stat(current)
+            count = 0
+            with os.scandir(current) as listing:
+                for entry in listing:
+                    count += 1
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            file_stat = entry.stat(follow_symlinks=False)
+                            digest += _item_hash(entry.path, file_stat.st_size, file_stat.st_mtime_ns)
+                            files += 1
+                    except OSError:
+                        errors += 1
+            digest += _item_hash(current, stat.st_mtime_ns, count)
+            dirs += 1
+            entries += count
+        except OSError:
+            errors += 1
+    
+    return {
+        'digest': f"{digest % (1 << 64):016x}",
+        'dirs': dirs,
+        'entries': entries,
+        'files': files,
+        'errors': errors,
+        'duration': time.time() - started
+    }
+
+class ChangeManifest:
+    """Fingerprints of volumes as of their last successful backup"""
+    
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+    
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Error loading change manifest: {e}")
+            return {}
+    
+    def get(self, volume):
+        """Manifest entry of a volume, or None if it was never recorded"""
+        with self.lock:
+            return self._load().get(volume)
+    
+    def record(self, volume, fingerprint, snapshot_id, duration):
+        """Remember the fingerprint a volume had when it was backed up"""
+        with self.lock:
+            manifest = self._load()
+            manifest[volume] = {
+                'fingerprint': fingerprint,
+                'snapshot_id': snapshot_id,
+                'backed_up_at': time.time(),
+                'backup_duration': duration
+            }
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.error(f"Error saving change manifest: {e}")
+
+def is_unchanged(entry, fingerprint, max_skip_days=DEFAULT_MAX_SKIP_DAYS):
+    """Whether a volume can be skipped: same fingerprint and backed up recently enough"""
+    if not entry or fingerprint['errors']:
+        return False
+    if entry['fingerprint'].get('digest') != fingerprint['digest']:
+        return False
+    if max_skip_days and time.time() - entry['backed_up_at'] > max_skip_days * 86400:
+        return False
+    return True
@@ -0,0 +1,123 @@
+import os
+import copy
+import json
+import fcntl
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = '/data/config.json'
+
+class ConfigStore:
+    """Parsed configuration cached in memory and written atomically
+    
+    The file is only parsed again when its inode, mtime or size changes, so
+    reads cost a stat. Writes go to a temporary file that is fsynced and
+    renamed over the original while holding a lock file, so readers in any
+    process see either the old or the new configuration, never a partial one.
+    """
+    
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.lock = threading.RLock()
+        self._config = {}
+        self._signature = None
+    
+    def _stat_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    
+    def _refresh_locked(self):
+        signature = self._stat_signature()
+        if signature == self._signature:
+            return
+        if signature is None:
+            self._config = {}
+            self._signature = None
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self._config = json.load(f)
+            self._signature = signature
+        except Exception as e:
+            # Keep serving the last good configuration rather than an empty one
+            logger.error(f"Error loading config: {e}")
+    
+    def load(self):
+        """Current configuration; callers get their own copy to modify"""
+        with self.lock:
+            self._refresh_locked()
+            return copy.deepcopy(self._config)
+    
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _write_locked(self, config):
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.config.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        
+        # Make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        
+        self._config = copy.deepcopy(config)
+        self._signature = self._stat_signature()
+    
+    def save(self, config):
+        """Replace the whole configuration"""
+        with self.lock, self._file_lock():
+            self._write_locked(config)
+    
+    def update(self, changes):
+        """Merge keys into the configuration as one read-modify-write
+        
+        The file is re-read under the lock, so changes made by another
+        process in the meantime are kept.
+        """
+        with self.lock, self._file_lock():
+            self._refresh_locked()
+            config = copy.deepcopy(self._config)
+            config.update(changes)
+            self._write_locked(config)
+            return copy.deepcopy(config)
+
+_store = ConfigStore()
+
+def load_config():
+    """Load the shared configuration"""
+    return _store.load()
+
+def merge_config(changes):
+    """Merge keys into the shared configuration, returning whether it succeeded"""
+    try:
+        _store.update(changes)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving config: {e}")
+        return False
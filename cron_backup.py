@@ -1,31 +1,22 @@
 #!/usr/bin/env python3
 """
-Cron script for automated backups
+Cron script that queues automated backups with the web app
 """
 
 import os
-import json
 import sys
 from datetime import datetime
 
 # Add the app directory to the Python path
 sys.path.insert(0, '/app')
 
-from backup import BackupEngine
+from job_queue import submit_job
+from config_store import load_config
 
 def main():
     """Run automated backup if enabled"""
-    config_path = '/data/config.json'
-    
     # Load configuration
-    config = {}
-    if os.path.exists(config_path):
-        try:
-            with open(config_path, 'r') as f:
-                config = json.load(f)
-        except Exception as e:
-            print(f"Error loading config: {e}")
-            return
+    config = load_config()
     
     # Check if scheduled backups are enabled
     if not config.get('schedule_enabled', True):
@@ -43,14 +34,14 @@ def main():
         print("RESTIC_PASSWORD not set")
         return
     
-    print(f"Starting scheduled backup at {datetime.now()}")
-    print(f"Selected volumes: {', '.join(selected_volumes)}")
-    
-    # Run backup
-    backup_engine = BackupEngine()
-    backup_engine.run_backup(selected_volumes)
-    
-    print(f"Backup completed at {datetime.now()}")
+    # Hand the backup to the web app's job queue so it shows up in the UI and
+    # never overlaps with a manual backup or restore
+    job, created = submit_job('backup', {'volumes': sorted(selected_volumes)}, source='cron')
+    if created:
+        print(f"Queued scheduled backup {job['id']} at {datetime.now()}")
+        print(f"Selected volumes: {', '.join(selected_volumes)}")
+    else:
+        print(f"Scheduled backup skipped at {datetime.now()}: job {job['id']} with the same volumes is still pending")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Cron script that queues scheduled prunes with the web app
+"""
+
+import os
+import sys
+from datetime import datetime
+
+# Add the app directory to the Python path
+sys.path.insert(0, '/app')
+
+from job_queue import submit_job
+from config_store import load_config
+from maintenance import prune_schedule
+
+def main():
+    """Queue a prune if scheduled prunes are enabled"""
+    if prune_schedule(load_config()) is None:
+        print("Scheduled prunes are disabled")
+        return
+    
+    if not os.environ.get('RESTIC_PASSWORD'):
+        print("RESTIC_PASSWORD not set")
+        return
+    
+    # Prune needs an exclusive repository lock, so it goes through the same
+    # queue as backups and restores
+    job, created = submit_job('prune', {}, source='cron')
+    if created:
+        print(f"Queued scheduled prune {job['id']} at {datetime.now()}")
+    else:
+        print(f"Scheduled prune skipped at {datetime.now()}: prune job {job['id']} is still pending")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import io
+import re
+import zipfile
+import logging
+from datetime import datetime
+from log_store import LOG_LEVELS
+
+logger = logging.getLogger(__name__)
+
+# Compression methods offered for the diagnostics bundle. LZMA is left out:
+# its encoder alone needs close to 100 MB.
+BUNDLE_COMPRESSION = {
+    'deflated': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'stored': zipfile.ZIP_STORED
+}
+
+# Bytes of log lines gathered before each write into the archive
+BUNDLE_CHUNK_SIZE = 64 * 1024
+
+# Matches the app.log format: "2024-01-01 12:00:00,123 - name - LEVEL - message"
+LOG_LINE_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})\S* - \S+ - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - ')
+
+class LogFilter:
+    """Time range and minimum level applied to log lines
+    
+    Lines without a timestamp (tracebacks, cron output) follow the decision
+    made for the entry above them.
+    """
+    
+    def __init__(self, since=None, until=None, level=None):
+        if level and level.upper() not in LOG_LEVELS:
+            raise ValueError(f"Unknown log level: {level}")
+        self.since = since
+        self.until = until
+        self.min_level = LOG_LEVELS.index(level.upper()) if level else 0
+    
+    @property
+    def active(self):
+        return self.since is not None or self.until is not None or self.min_level > 0
+    
+    def matches(self, timestamp, level):
+        if self.since is not None and timestamp < self.since:
+            return False
+        if self.until is not None and timestamp >= self.until:
+            return False
+        return LOG_LEVELS.index(level) >= self.min_level if level in LOG_LEVELS else True
+    
+    def lines(self, f):
+        """Yield the lines of a text file that pass the filter, one at a time"""
+        keep = not self.active
+        for line in f:
+            match = LOG_LINE_PATTERN.match(line)
+            if match:
+                try:
+                    timestamp = datetime.fromisoformat(match.group(1)).timestamp()
+                    keep = self.matches(timestamp, match.group(2))
+                except ValueError:
+                    pass
+            if keep:
+                yield line
+    
+    def entries(self, logs):
+        """Format engine log entries that pass the filter"""
+        for log in logs:
+            try:
+                timestamp = datetime.fromisoformat(log['timestamp']).timestamp()
+            except (KeyError, ValueError):
+                timestamp = 0
+            if self.matches(timestamp, log.get('level')):
+                yield f"[{log['timestamp']}] {log['level']}: {log['message']}\n"
+
+class _StreamBuffer(io.RawIOBase):
+    """Write-only sink that zipfile writes into and the response generator drains"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_bundle(members, compression='deflated'):
+    """Generate a zip archive chunk by chunk from (name, iterable of str) members
+    
+    The archive is written in streaming mode (sizes go in data descriptors),
+    so memory use is bounded by the chunk size no matter how large the
+    members are.
+    """
+    if compression not in BUNDLE_COMPRESSION:
+        raise ValueError(f"Unsupported compression: {compression}")
+    
+    def generate():
+        buffer = _StreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', BUNDLE_COMPRESSION[compression]) as zf:
+            for name, lines in members:
+                with zf.open(name, 'w', force_zip64=True) as dest:
+                    pending = []
+                    pending_size = 0
+                    for line in lines:
+                        pending.append(line)
+                        pending_size += len(line)
+                        if pending_size >= BUNDLE_CHUNK_SIZE:
+                            dest.write(''.join(pending).encode('utf-8', errors='replace'))
+                            pending = []
+                            pending_size = 0
+                            data = buffer.drain()
+                            if data:
+                                yield data
+                    if pending:
+                        dest.write(''.join(pending).encode('utf-8', errors='replace'))
+                data = buffer.drain()
+                if data:
+                    yield data
+        yield buffer.drain()
+    
+    return generate()
+
+def read_lines(path):
+    """Iterate over the lines of a text file, closing it once exhausted"""
+    try:
+        with open(path, 'r', errors='replace') as f:
+            yield from f
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.error(f"Error reading {path} for diagnostics bundle: {e}")
@@ -0,0 +1,67 @@
+import json
+import threading
+from collections import deque
+
+# Events kept for clients that reconnect with a cursor
+DEFAULT_EVENT_CAPACITY = 1000
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+
+class EventBroker:
+    """Sequence-numbered event buffer that streaming clients block on"""
+    
+    def __init__(self, capacity=DEFAULT_EVENT_CAPACITY):
+        self.events = deque(maxlen=capacity)
+        self.seq = 0
+        self.condition = threading.Condition()
+    
+    def publish(self, event_type, data):
+        """Append an event and wake every waiting client"""
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, event_type, data))
+            self.condition.notify_all()
+            return self.seq
+    
+    @property
+    def cursor(self):
+        with self.condition:
+            return self.seq
+    
+    def since(self, after):
+        """Events newer than `after` without blocking, and whether some were dropped"""
+        with self.condition:
+            return self._since_locked(after)
+    
+    def wait(self, after, timeout=HEARTBEAT_INTERVAL):
+        """Block until there are events newer than `after` or the timeout passes
+        
+        Returns the new events and whether some were already dropped from the
+        buffer, in which case the client should resynchronise.
+        """
+        with self.condition:
+            if self.seq == after:
+                self.condition.wait(timeout)
+            return self._since_locked(after)
+    
+    def _since_locked(self, after):
+        if after > self.seq:
+            # Cursor from before a restart; everything is new to this client
+            after = 0
+        events = [event for event in self.events if event[0] > after]
+        missed = bool(events) and events[0][0] > after + 1
+        return events, missed
+
+def format_sse(event_type, data, event_id=None):
+    """Serialize one Server-Sent Events message"""
+    message = ''
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    message += f"event: {event_type}\n"
+    message += f"data: {json.dumps(data)}\n\n"
+    return message
+
+def status_delta(previous, current):
+    """Top-level status fields that changed since the previous snapshot"""
+    return {key: value for key, value in current.items() if previous.get(key) != value}
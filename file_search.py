@@ -0,0 +1,284 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from snapshot_catalog import parse_restic_time
+
+logger = logging.getLogger(__name__)
+
+SEARCH_INDEX_PATH = '/data/search.db'
+
+# Rows written per executemany call while loading a snapshot listing
+SEARCH_INSERT_BATCH = 5000
+
+# Paths returned per search
+DEFAULT_SEARCH_LIMIT = 100
+
+# Substrings shorter than this have no trigram to look up and scan every path
+MIN_TRIGRAM_QUERY = 3
+
+# Bumped when a schema change needs existing indexes migrated
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search_paths_fts USING fts5(
+    path, content = 'search_paths', content_rowid = 'id', tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS search_paths_fts_insert AFTER INSERT ON search_paths BEGIN
+    INSERT INTO search_paths_fts (rowid, path) VALUES (new.id, new.path);
+END;
+CREATE TRIGGER IF NOT EXISTS search_paths_fts_delete AFTER DELETE ON search_paths BEGIN
+    INSERT INTO search_paths_fts (search_paths_fts, rowid, path) VALUES ('delete', old.id, old.path);
+END;
+
+CREATE TABLE IF NOT EXISTS search_series (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS search_snapshots (
+    seq INTEGER PRIMARY KEY,
+    snapshot_id TEXT NOT NULL UNIQUE,
+    short_id TEXT NOT NULL,
+    series_id INTEGER NOT NULL,
+    time_unix REAL NOT NULL,
+    entries INTEGER NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS search_snapshots_series ON search_snapshots (series_id, seq);
+
+CREATE TABLE IF NOT EXISTS search_versions (
+    path_id INTEGER NOT NULL,
+    series_id INTEGER NOT NULL,
+    first_seq INTEGER NOT NULL,
+    last_seq INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    type TEXT NOT NULL,
+    PRIMARY KEY (path_id, series_id, first_seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS search_versions_open ON search_versions (series_id, last_seq);
+"""
+
+def series_key(snapshot):
+    """Snapshots of the same volume form a series: restic's default host + paths grouping"""
+    return json.dumps([snapshot.get('hostname'), sorted(snapshot.get('paths') or [])])
+
+def _like_pattern(text):
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+class FileSearchIndex:
+    """Paths of every indexed snapshot, searchable across snapshots
+    
+    Each unique path is stored once. Its history within a series is kept as
+    runs of identical size and mtime ("versions"), each spanning the
+    snapshots from its first to its last sequence number. A file that never
+    changes costs one row no matter how many snapshots contain it. Snapshots
+    must be added oldest first within a series. Paths are also kept in an
+    FTS5 trigram index, so substrings and unanchored globs are looked up
+    rather than scanned for.
+    """
+    
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self._initialized = False
+        # Indexed snapshot ids and row counts, kept until the index next changes
+        self._ids = None
+        self._stats = None
+    
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.row_factory = sqlite3.Row
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(SCHEMA)
+                if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                    # Indexes from before the trigram table get their paths added to it
+                    conn.execute("INSERT INTO search_paths_fts (search_paths_fts) VALUES ('rebuild')")
+                    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                self._initialized = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def _invalidate(self):
+        self._ids = None
+        self._stats = None
+    
+    def indexed_ids(self):
+        ids = self._ids
+        if ids is None:
+            with self._connect() as conn:
+                ids = frozenset(row['snapshot_id'] for row in conn.execute('SELECT snapshot_id FROM search_snapshots'))
+            self._ids = ids
+        return set(ids)
+    
+    def series_latest(self, snapshot):
+        """Time of the newest indexed snapshot in the same series, or None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT MAX(s.time_unix) FROM search_snapshots s JOIN search_series r '
+                               'ON r.id = s.series_id WHERE r.key = ?', (series_key(snapshot),)).fetchone()
+        return row[0]
+    
+    def add_snapshot(self, snapshot, nodes):
+        """Fold one snapshot's `restic ls --json` nodes into the index
+        
+        Unchanged files extend their open version run; changed and new files
+        start a new run. Returns the number of entries read.
+        """
+        with self.lock, self._connect() as conn:
+            key = series_key(snapshot)
+            conn.execute('INSERT OR IGNORE INTO search_series (key) VALUES (?)', (key,))
+            series_id = conn.execute('SELECT id FROM search_series WHERE key = ?', (key,)).fetchone()['id']
+            previous = conn.execute('SELECT MAX(seq) FROM search_snapshots WHERE series_id = ?',
+                                    (series_id,)).fetchone()[0]
+            
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS listing (path TEXT PRIMARY KEY, type TEXT, size INTEGER, '
+                         'mtime REAL) WITHOUT ROWID')
+            conn.execute('DELETE FROM listing')
+            entries = 0
+            batch = []
+            for node in nodes:
+                if not node.get('path'):
+                    continue
+                batch.append((node['path'], node.get('type', 'file'),
+                              node.get('size') if node.get('type') == 'file' else None,
+                              parse_restic_time(node.get('mtime')) or None))
+                entries += 1
+                if len(batch) >= SEARCH_INSERT_BATCH:
+                    conn.executemany('INSERT OR REPLACE INTO listing VALUES (?, ?, ?, ?)', batch)
+                    batch = []
+            conn.executemany('INSERT OR REPLACE INTO listing VALUES (?, ?, ?, ?)', batch)
+            
+            cursor = conn.execute(
+                'INSERT INTO search_snapshots (snapshot_id, short_id, series_id, time_unix, entries, indexed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (snapshot['full_id'], snapshot['id'], series_id, snapshot['time_unix'], entries, time.time()))
+            seq = cursor.lastrowid
+            
+            conn.execute('INSERT OR IGNORE INTO search_paths (path) SELECT path FROM listing')
+            if previous is not None:
+                # Unchanged since the previous snapshot of the series: extend the open run
+                conn.execute(
+                    'UPDATE search_versions SET last_seq = ? WHERE series_id = ? AND last_seq = ? AND EXISTS ('
+                    'SELECT 1 FROM listing l JOIN search_paths p ON p.path = l.path '
+                    'WHERE p.id = search_versions.path_id AND l.type = search_versions.type '
+                    'AND l.size IS search_versions.size AND l.mtime IS search_versions.mtime)',
+                    (seq, series_id, previous))
+            conn.execute(
+                'INSERT INTO search_versions (path_id, series_id, first_seq, last_seq, size, mtime, type) '
+                'SELECT p.id, ?, ?, ?, l.size, l.mtime, l.type FROM listing l JOIN search_paths p ON p.path = l.path '
+                'WHERE NOT EXISTS (SELECT 1 FROM search_versions v '
+                'WHERE v.path_id = p.id AND v.series_id = ? AND v.last_seq = ?)',
+                (series_id, seq, seq, series_id, seq))
+            conn.execute('DELETE FROM listing')
+            self._invalidate()
+        return entries
+    
+    def retain(self, snapshot_ids):
+        """Forget snapshots that are gone, and versions and paths no snapshot holds any more"""
+        with self.lock, self._connect() as conn:
+            stale = [(row['snapshot_id'],) for row in conn.execute('SELECT snapshot_id FROM search_snapshots')
+                     if row['snapshot_id'] not in snapshot_ids]
+            if not stale:
+                return 0
+            conn.executemany('DELETE FROM search_snapshots WHERE snapshot_id = ?', stale)
+            conn.execute('DELETE FROM search_versions WHERE NOT EXISTS (SELECT 1 FROM search_snapshots s '
+                         'WHERE s.series_id = search_versions.series_id '
+                         'AND s.seq BETWEEN search_versions.first_seq AND search_versions.last_seq)')
+            conn.execute('DELETE FROM search_paths WHERE id NOT IN (SELECT path_id FROM search_versions)')
+            self._invalidate()
+        return len(stale)
+    
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT, files_only=True):
+        """Paths matching a glob (if it contains * ? or [) or a substring, with their versions
+        
+        Versions are listed newest first, each with the first and last
+        snapshot that contains it and how many snapshots do.
+        """
+        if any(char in query for char in '*?['):
+            if query.startswith('/'):
+                # The path index serves an anchored glob up to its first wildcard
+                clause, params = 'p.path GLOB ?', [query]
+            else:
+                # A glob without a leading slash matches at any depth
+                clause, params = 'p.id IN (SELECT rowid FROM search_paths_fts WHERE path GLOB ?)', [f"*{query}"]
+        elif len(query) >= MIN_TRIGRAM_QUERY:
+            # The trigram index finds the candidates; LIKE keeps the match exactly as for short queries
+            clause = ("p.id IN (SELECT rowid FROM search_paths_fts WHERE search_paths_fts MATCH ?) "
+                      "AND p.path LIKE ? ESCAPE '\\'")
+            params = [_fts_phrase(query), _like_pattern(query)]
+        else:
+            clause, params = "p.path LIKE ? ESCAPE '\\'", [_like_pattern(query)]
+        limit = max(1, min(1000, int(limit)))
+        
+        started = time.time()
+        with self._connect() as conn:
+            type_clause = "AND EXISTS (SELECT 1 FROM search_versions v WHERE v.path_id = p.id AND v.type != 'dir')" \
+                if files_only else ''
+            paths = conn.execute(f'SELECT p.id, p.path FROM search_paths p WHERE {clause} {type_clause} '
+                                 f'ORDER BY p.path LIMIT ?', params + [limit + 1]).fetchall()
+            truncated = len(paths) > limit
+            results = []
+            for path in paths[:limit]:
+                versions = []
+                for run in conn.execute(
+                        'SELECT v.size, v.mtime, v.type, '
+                        '(SELECT COUNT(*) FROM search_snapshots s WHERE s.series_id = v.series_id '
+                        ' AND s.seq BETWEEN v.first_seq AND v.last_seq) AS snapshots, '
+                        "(SELECT s.short_id || ' ' || s.time_unix FROM search_snapshots s "
+                        ' WHERE s.series_id = v.series_id AND s.seq BETWEEN v.first_seq AND v.last_seq '
+                        ' ORDER BY s.seq LIMIT 1) AS first, '
+                        "(SELECT s.short_id || ' ' || s.time_unix FROM search_snapshots s "
+                        ' WHERE s.series_id = v.series_id AND s.seq BETWEEN v.first_seq AND v.last_seq '
+                        ' ORDER BY s.seq DESC LIMIT 1) AS last '
+                        'FROM search_versions v WHERE v.path_id = ? ORDER BY v.last_seq DESC',
+                        (path['id'],)):
+                    if not run['snapshots']:
+                        continue
+                    first_id, first_time = run['first'].split(' ')
+                    last_id, last_time = run['last'].split(' ')
+                    versions.append({
+                        'type': run['type'],
+                        'size': run['size'],
+                        'mtime': run['mtime'],
+                        'snapshots': run['snapshots'],
+                        'first_snapshot': first_id,
+                        'first_time': float(first_time),
+                        'last_snapshot': last_id,
+                        'last_time': float(last_time)
+                    })
+                if versions:
+                    results.append({'path': path['path'], 'versions': versions})
+        return {'results': results, 'truncated': truncated, 'elapsed': time.time() - started}
+    
+    def stats(self):
+        """Row counts of the index, counted again only after it changes"""
+        stats = self._stats
+        if stats is None:
+            with self._connect() as conn:
+                stats = {
+                    'snapshots': conn.execute('SELECT COUNT(*) FROM search_snapshots').fetchone()[0],
+                    'paths': conn.execute('SELECT COUNT(*) FROM search_paths').fetchone()[0],
+                    'versions': conn.execute('SELECT COUNT(*) FROM search_versions').fetchone()[0]
+                }
+            self._stats = stats
+        return dict(stats)
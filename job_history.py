@@ -0,0 +1,314 @@
+import os
+import json
+import sqlite3
+import statistics
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+JOB_HISTORY_PATH = '/data/history.db'
+
+# Days of finished jobs kept when job_history_days is not configured
+DEFAULT_HISTORY_DAYS = 365
+
+# Window the latest backup of a volume is compared against when history_trend_days is not configured
+DEFAULT_TREND_DAYS = 14
+
+# How many times its median a run must take (or add) to be flagged when history_regression_factor is not configured
+DEFAULT_REGRESSION_FACTOR = 2.0
+
+# Earlier successful runs needed before a volume's runs are compared with their median
+MIN_TREND_SAMPLES = 3
+
+# Data added below this is never flagged as churn, however small the median
+MIN_CHURN_BYTES = 64 * 1024 * 1024
+
+# Volume outcomes that leave the volume protected: backed up, or unchanged since its last backup
+PROTECTED_STATUSES = ('success', 'skipped')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    operation TEXT NOT NULL,
+    source TEXT,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL,
+    bytes_processed INTEGER,
+    bytes_added INTEGER,
+    message TEXT,
+    params TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_started ON jobs (started_at);
+CREATE INDEX IF NOT EXISTS jobs_operation ON jobs (operation, started_at);
+
+CREATE TABLE IF NOT EXISTS job_volumes (
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    volume TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at REAL,
+    duration REAL,
+    files_processed INTEGER,
+    bytes_processed INTEGER,
+    bytes_added INTEGER,
+    files_new INTEGER,
+    files_changed INTEGER,
+    files_unmodified INTEGER,
+    throughput REAL,
+    upload_rate REAL,
+    snapshot_id TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, volume)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS job_volumes_volume ON job_volumes (volume, operation, started_at);
+
+CREATE TABLE IF NOT EXISTS job_traces (
+    job_id TEXT PRIMARY KEY REFERENCES jobs (id) ON DELETE CASCADE,
+    spans TEXT NOT NULL
+);
+"""
+
+def volume_record(state):
+    """History row of one volume (or restore shard) from its job state and restic summary"""
+    summary = state.get('summary') or {}
+    start, end = state.get('start_time'), state.get('end_time')
+    duration = end - start if start and end else None
+    processed = summary.get('total_bytes_processed', summary.get('bytes_restored'))
+    # data_added_packed is what went over the wire; restic before 0.17 only reports data_added
+    added = summary.get('data_added_packed') or summary.get('data_added')
+    return {
+        'volume': state['name'],
+        'status': state['status'],
+        'started_at': start,
+        'duration': duration,
+        'files_processed': summary.get('total_files_processed', summary.get('files_restored')),
+        'bytes_processed': processed,
+        'bytes_added': added,
+        'files_new': summary.get('files_new'),
+        'files_changed': summary.get('files_changed'),
+        'files_unmodified': summary.get('files_unmodified'),
+        'throughput': processed / duration if processed is not None and duration else None,
+        'upload_rate': added / duration if added is not None and duration else None,
+        'snapshot_id': state.get('snapshot_id'),
+        'error': state.get('error')
+    }
+
+def protected_at(record):
+    """Unix time a volume record's run finished if it left the volume protected, else None"""
+    if record['status'] not in PROTECTED_STATUSES or record['started_at'] is None:
+        return None
+    return record['started_at'] + (record['duration'] or 0)
+
+class JobHistory:
+    """Persistent record of finished jobs, with per-volume figures from restic's summaries"""
+    
+    def __init__(self, path=JOB_HISTORY_PATH, retention_days=DEFAULT_HISTORY_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self._initialized = False
+    
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA foreign_keys = ON')
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def record(self, job, volumes, spans=None):
+        """Store a finished job, its per-volume records and trace spans, dropping jobs past the retention age"""
+        volumes = [volume for volume in volumes if volume['status'] != 'pending']
+        processed = [volume['bytes_processed'] for volume in volumes if volume['bytes_processed'] is not None]
+        added = [volume['bytes_added'] for volume in volumes if volume['bytes_added'] is not None]
+        result = job.get('result') or {}
+        
+        with self.lock, self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (id, operation, source, status, started_at, duration, '
+                'bytes_processed, bytes_added, message, params, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job['id'], job['operation'], job.get('source'), job['status'], job['start_time'], job['duration'],
+                 sum(processed) if processed else result.get('bytes'), sum(added) if added else None,
+                 job.get('message'), json.dumps(job.get('params') or {}), json.dumps(result)))
+            conn.executemany(
+                'INSERT OR REPLACE INTO job_volumes (job_id, volume, operation, status, started_at, duration, '
+                'files_processed, bytes_processed, bytes_added, files_new, files_changed, files_unmodified, '
+                'throughput, upload_rate, snapshot_id, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(job['id'], volume['volume'], job['operation'], volume['status'], volume['started_at'],
+                  volume['duration'], volume['files_processed'], volume['bytes_processed'], volume['bytes_added'],
+                  volume['files_new'], volume['files_changed'], volume['files_unmodified'], volume['throughput'],
+                  volume['upload_rate'], volume['snapshot_id'], volume['error']) for volume in volumes])
+            if spans:
+                conn.execute('INSERT OR REPLACE INTO job_traces (job_id, spans) VALUES (?, ?)',
+                             (job['id'], json.dumps(spans)))
+            if self.retention_days:
+                conn.execute('DELETE FROM jobs WHERE started_at < ?', (time.time() - self.retention_days * 86400,))
+    
+    def query(self, operation=None, volume=None, status=None, since=None, until=None, page=1, per_page=50):
+        """Page through finished jobs, newest first, each with its volume records"""
+        clauses = []
+        params = []
+        if operation:
+            clauses.append('operation = ?')
+            params.append(operation)
+        if status:
+            clauses.append('status = ?')
+            params.append(status)
+        if since is not None:
+            clauses.append('started_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('started_at < ?')
+            params.append(until)
+        if volume:
+            clauses.append('id IN (SELECT job_id FROM job_volumes WHERE volume = ?)')
+            params.append(volume)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        
+        page = max(1, int(page))
+        per_page = max(1, min(500, int(per_page)))
+        
+        with self._connect() as conn:
+            total = conn.execute(f'SELECT COUNT(*) FROM jobs {where}', params).fetchone()[0]
+            rows = conn.execute(f'SELECT * FROM jobs {where} ORDER BY started_at DESC LIMIT ? OFFSET ?',
+                                params + [per_page, (page - 1) * per_page]).fetchall()
+            jobs = [self._job_to_dict(row) for row in rows]
+            self._attach_volumes(conn, jobs)
+        return jobs, total
+    
+    def get(self, job_id):
+        """One finished job with its volume records, or None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            jobs = [self._job_to_dict(row)]
+            self._attach_volumes(conn, jobs)
+        return jobs[0]
+    
+    def get_trace(self, job_id):
+        """A finished job's trace: its id, operation, status, start and end time and spans, or None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT jobs.id, operation, status, started_at, duration, spans FROM jobs '
+                               'JOIN job_traces ON job_traces.job_id = jobs.id WHERE jobs.id = ?',
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'operation': row['operation'],
+            'status': row['status'],
+            'start_time': row['started_at'],
+            'end_time': row['started_at'] + (row['duration'] or 0),
+            'spans': json.loads(row['spans'])
+        }
+    
+    def last_success(self, operation='backup'):
+        """Unix time each volume's last successful run finished; a run that found it unchanged counts"""
+        placeholders = ', '.join('?' * len(PROTECTED_STATUSES))
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT volume, MAX(started_at + COALESCE(duration, 0)) AS finished FROM job_volumes "
+                f"WHERE operation = ? AND status IN ({placeholders}) GROUP BY volume",
+                (operation,) + PROTECTED_STATUSES).fetchall()
+        return {row['volume']: row['finished'] for row in rows}
+    
+    def _attach_volumes(self, conn, jobs):
+        by_id = {job['id']: job for job in jobs}
+        for job in jobs:
+            job['volumes'] = []
+        if not by_id:
+            return
+        placeholders = ', '.join('?' * len(by_id))
+        for row in conn.execute(f'SELECT * FROM job_volumes WHERE job_id IN ({placeholders}) ORDER BY volume',
+                                list(by_id)):
+            record = dict(row)
+            by_id[record.pop('job_id')]['volumes'].append(record)
+    
+    def _job_to_dict(self, row):
+        job = dict(row)
+        job['params'] = json.loads(job['params'] or '{}')
+        job['result'] = json.loads(job['result'] or 'null')
+        return job
+    
+    def trends(self, days=DEFAULT_TREND_DAYS, factor=DEFAULT_REGRESSION_FACTOR, operation='backup'):
+        """Each volume's latest run against the median of its successful runs in the window before it
+        
+        A volume is flagged when its latest run took, or added, `factor` times
+        its median or more. Volumes with fewer than MIN_TREND_SAMPLES earlier
+        runs are listed without flags.
+        """
+        since = time.time() - days * 86400
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM job_volumes WHERE operation = ? AND started_at >= ? AND status = 'success' "
+                "ORDER BY volume, started_at", (operation, since)).fetchall()
+            latest_rows = conn.execute(
+                'SELECT * FROM job_volumes WHERE operation = ? AND started_at = '
+                '(SELECT MAX(started_at) FROM job_volumes AS later '
+                ' WHERE later.volume = job_volumes.volume AND later.operation = job_volumes.operation) '
+                'ORDER BY volume', (operation,)).fetchall()
+        
+        runs = {}
+        for row in rows:
+            runs.setdefault(row['volume'], []).append(dict(row))
+        
+        trends = []
+        for latest in (dict(row) for row in latest_rows):
+            volume = latest['volume']
+            earlier = [run for run in runs.get(volume, []) if run['started_at'] < latest['started_at']]
+            trend = {
+                'volume': volume,
+                'latest': latest,
+                'samples': len(earlier),
+                'median_duration': None,
+                'median_added': None,
+                'median_throughput': None,
+                'duration_ratio': None,
+                'added_ratio': None,
+                'regressions': []
+            }
+            if latest['status'] == 'error':
+                trend['regressions'].append(f"{volume} {operation} failed: {latest['error'] or 'unknown error'}")
+            elif len(earlier) >= MIN_TREND_SAMPLES:
+                self._compare(trend, earlier, days, factor, operation)
+            trends.append(trend)
+        return trends
+    
+    def _compare(self, trend, earlier, days, factor, operation):
+        """Fill in a volume's medians and flag its latest run if it regressed"""
+        latest = trend['latest']
+        if latest['status'] != 'success':
+            return
+        
+        def median(key):
+            values = [run[key] for run in earlier if run[key] is not None]
+            return statistics.median(values) if values else None
+        
+        trend['median_duration'] = median('duration')
+        trend['median_added'] = median('bytes_added')
+        trend['median_throughput'] = median('throughput')
+        if trend['median_duration'] and latest['duration']:
+            trend['duration_ratio'] = latest['duration'] / trend['median_duration']
+            if trend['duration_ratio'] >= factor:
+                trend['regressions'].append(f"{trend['volume']} {operation} {trend['duration_ratio']:.1f}x slower than "
+                                            f"its {days}-day median")
+        if latest['bytes_added'] is not None and trend['median_added'] is not None:
+            trend['added_ratio'] = latest['bytes_added'] / max(trend['median_added'], 1)
+            if trend['added_ratio'] >= factor and latest['bytes_added'] >= MIN_CHURN_BYTES:
+                trend['regressions'].append(f"{trend['volume']} {operation} added {trend['added_ratio']:.1f}x more data "
+                                            f"than its {days}-day median")
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+from job_registry import JobLimitReached, EXCLUSIVE_JOB_TYPES
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = '/data/jobs'
+
+# Seconds between spool scans; jobs submitted in-process wake the runner at once
+SPOOL_POLL_INTERVAL = 2
+
+# Recent queue waits used for the average wait time
+WAIT_HISTORY = 20
+
+def job_key(job_type, params):
+    """Identity of a job: two pending jobs with the same key are duplicates"""
+    canonical = json.dumps({'type': job_type, 'params': params}, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+@contextmanager
+def spool_lock(spool_dir=SPOOL_DIR):
+    """Exclusive lock on the spool, shared between processes"""
+    os.makedirs(spool_dir, exist_ok=True)
+    with open(os.path.join(spool_dir, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def list_pending(spool_dir=SPOOL_DIR):
+    """Pending jobs in the spool, oldest first"""
+    jobs = []
+    try:
+        names = sorted(name for name in os.listdir(spool_dir) if name.endswith('.json'))
+    except FileNotFoundError:
+        return jobs
+    for name in names:
+        try:
+            with open(os.path.join(spool_dir, name), 'r') as f:
+                job = json.load(f)
+            job['file'] = name
+            jobs.append(job)
+        except (OSError, ValueError) as e:
+            logger.error(f"Skipping unreadable job file {name}: {e}")
+    return jobs
+
+def submit_job(job_type, params, source='web', spool_dir=SPOOL_DIR):
+    """Add a job to the spool unless an identical one is already pending
+    
+    Safe to call from any process. Returns the job and whether it was newly
+    queued; for a duplicate the already pending job is returned.
+    """
+    key = job_key(job_type, params)
+    with spool_lock(spool_dir):
+        for job in list_pending(spool_dir):
+            if job.get('key') == key:
+                return job, False
+        
+        submitted_at = time.time()
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            'type': job_type,
+            'params': params,
+            'key': key,
+            'source': source,
+            'submitted_at': submitted_at
+        }
+        name = f"{int(submitted_at * 1000):013d}-{job['id']}.json"
+        tmp_path = os.path.join(spool_dir, f".{name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(spool_dir, name))
+        job['file'] = name
+        return job, True
+
+class JobQueue:
+    """Runs spooled jobs inside the web app's engine as their concurrency limits allow
+    
+    Jobs come from the web routes and from the cron entry point through the
+    spool directory. `admit(job)` registers a spooled job with the engine,
+    raising JobLimitReached while its type is at its limit; a job that is not
+    admitted stays queued while later jobs of other types may start. A job
+    that needs the repository to itself is never overtaken. `abandon(job,
+    message)` is called once a handler returns, to fail the engine's job if
+    the handler left it running.
+    """
+    
+    def __init__(self, handlers, admit, abandon=None, spool_dir=SPOOL_DIR, on_change=None):
+        self.handlers = handlers
+        self.admit = admit
+        self.abandon = abandon
+        self.spool_dir = spool_dir
+        self.on_change = on_change
+        self.running = {}
+        self.pending = []
+        self._pending_read_at = 0
+        self.waits = deque(maxlen=WAIT_HISTORY)
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start the runner thread"""
+        if self._thread is None:
+            self._recover()
+            self._thread = threading.Thread(target=self._run, name='job-queue', daemon=True)
+            self._thread.start()
+    
+    def submit(self, job_type, params, source='web'):
+        """Queue a job from this process and wake the runner"""
+        job, created = submit_job(job_type, params, source, self.spool_dir)
+        self._set_pending(list_pending(self.spool_dir))
+        self._wakeup.set()
+        return job, created
+    
+    def stats(self, include_waits=False):
+        """Queue depth, wait times and the running jobs
+        
+        Current waits of pending jobs change by the second, so they are only
+        included when asked for; status pushes carry submission times instead.
+        """
+        now = time.time()
+        if now - self._pending_read_at > SPOOL_POLL_INTERVAL:
+            # Pick up jobs the cron job queued since the last scan
+            self._pending_read_at = now
+            pending = list_pending(self.spool_dir)
+            with self.lock:
+                self.pending = pending
+        with self.lock:
+            pending = list(self.pending)
+            running = sorted(self.running.values(), key=lambda job: job['started_at'])
+            waits = list(self.waits)
+        stats = {
+            'depth': len(pending),
+            'pending': [{'id': job['id'], 'type': job['type'], 'source': job.get('source'),
+                         'submitted_at': job['submitted_at']} for job in pending],
+            'running': [dict(job) for job in running],
+            'last_wait': waits[-1] if waits else None,
+            'average_wait': sum(waits) / len(waits) if waits else None
+        }
+        if include_waits:
+            for job in stats['pending']:
+                job['wait'] = now - job['submitted_at']
+            stats['oldest_wait'] = now - pending[0]['submitted_at'] if pending else 0
+        return stats
+    
+    def position(self, job_id):
+        """1-based position of a pending job, or None once it has started"""
+        with self.lock:
+            for index, job in enumerate(self.pending):
+                if job['id'] == job_id:
+                    return index + 1
+        return None
+    
+    def _set_pending(self, pending):
+        """Cache the pending list for status reads, announcing changes"""
+        with self.lock:
+            changed = [job['id'] for job in pending] != [job['id'] for job in self.pending]
+            self.pending = pending
+            self._pending_read_at = time.time()
+        if changed:
+            self._changed()
+    
+    def _changed(self):
+        if self.on_change:
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.error(f"Job queue change callback failed: {e}")
+    
+    def _recover(self):
+        """Drop jobs that were running when the app last stopped"""
+        running_dir = os.path.join(self.spool_dir, 'running')
+        if not os.path.isdir(running_dir):
+            return
+        for name in os.listdir(running_dir):
+            logger.warning(f"Discarding job interrupted by a restart: {name}")
+            os.unlink(os.path.join(running_dir, name))
+    
+    def _claim(self):
+        """Admit the oldest pending job that may start now and move it to running/
+        
+        Returns the spooled job and the engine's job, or None if nothing can
+        start yet.
+        """
+        with spool_lock(self.spool_dir):
+            pending = list_pending(self.spool_dir)
+            claimed = None
+            for job in pending:
+                try:
+                    # Jobs without a handler are claimed only to be discarded
+                    claimed = job, self.admit(job) if job['type'] in self.handlers else None
+                    break
+                except JobLimitReached:
+                    if job['type'] in EXCLUSIVE_JOB_TYPES:
+                        # Later jobs would keep the repository busy and starve it
+                        break
+            if claimed is None:
+                self._set_pending(pending)
+                return None
+            running_dir = os.path.join(self.spool_dir, 'running')
+            os.makedirs(running_dir, exist_ok=True)
+            os.replace(os.path.join(self.spool_dir, job['file']), os.path.join(running_dir, job['file']))
+        
+        self._set_pending([other for other in pending if other['id'] != job['id']])
+        return claimed
+    
+    def _run(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logger.error(f"Error reading job spool: {e}")
+                claimed = None
+            
+            if claimed is None:
+                self._wakeup.wait(SPOOL_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            
+            threading.Thread(target=self._execute, args=claimed, name=f"job-{claimed[0]['id']}",
+                             daemon=True).start()
+    
+    def _execute(self, job, engine_job):
+        started = time.time()
+        wait = started - job['submitted_at']
+        with self.lock:
+            self.waits.append(wait)
+            self.running[job['id']] = {'id': job['id'], 'type': job['type'], 'source': job.get('source'),
+                                       'started_at': started, 'wait': wait}
+        self._changed()
+        
+        handler = self.handlers.get(job['type'])
+        error = None
+        try:
+            if handler is None:
+                logger.error(f"No handler for job type {job['type']}")
+            else:
+                logger.info(f"Running {job['type']} job {job['id']} from {job.get('source')} "
+                            f"after waiting {wait:.0f}s")
+                handler(job['params'], engine_job)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Job {job['id']} failed: {e}")
+        finally:
+            if engine_job is not None and self.abandon is not None:
+                try:
+                    # Frees the job's slot if the handler failed before it could finish the job
+                    self.abandon(engine_job, error or "Job ended without reporting a result")
+                except Exception as e:
+                    logger.error(f"Error finishing job {job['id']}: {e}")
+            try:
+                os.unlink(os.path.join(self.spool_dir, 'running', job['file']))
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.running.pop(job['id'], None)
+            self._changed()
+            # A slot is free; jobs held back by the limit may start now
+            self._wakeup.set()
@@ -0,0 +1,145 @@
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Jobs of each type that may run at once when job_concurrency is not configured
+DEFAULT_JOB_LIMITS = {
+    'backup': 1,
+    'restore': 2,
+    'prune': 1,
+    'check': 1,
+    'export': 4
+}
+
+# Job types that need the repository to themselves; restic prune takes an exclusive lock
+EXCLUSIVE_JOB_TYPES = {'prune'}
+
+# Finished jobs kept in memory for /api/jobs
+DEFAULT_JOB_HISTORY = 100
+
+class JobLimitReached(Exception):
+    """A job could not start because its type is at its concurrency limit"""
+
+def job_limits(config):
+    """Concurrency limit per job type, with job_concurrency overriding the defaults"""
+    limits = dict(DEFAULT_JOB_LIMITS)
+    for job_type, limit in (config.get('job_concurrency') or {}).items():
+        try:
+            limits[job_type] = max(1, int(limit))
+        except (TypeError, ValueError):
+            logger.error(f"Ignoring invalid concurrency limit for {job_type}: {limit!r}")
+    return limits
+
+class JobRegistry:
+    """Running and recently finished jobs, admitted by per-type concurrency limits
+    
+    A job type without a limit may run once at a time. Exclusive types only
+    start when nothing else runs, and nothing else starts while they run.
+    A running job can also take the repository to itself for one step with
+    exclusive(). The registry only tracks membership; jobs keep their own
+    state.
+    """
+    
+    def __init__(self, limits=None, history=DEFAULT_JOB_HISTORY):
+        self.limits = limits or (lambda: DEFAULT_JOB_LIMITS)
+        self.running = {}
+        self.finished = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.exclusive_owner = None
+        self.exclusive_waiting = set()
+    
+    def can_start(self, job_type):
+        """Whether a job of this type would be admitted now"""
+        with self.lock:
+            return self._can_start_locked(job_type, self.limits())
+    
+    def _can_start_locked(self, job_type, limits):
+        if self.exclusive_owner is not None or self.exclusive_waiting:
+            return False
+        running = list(self.running.values())
+        if any(job.operation in EXCLUSIVE_JOB_TYPES for job in running):
+            return False
+        if job_type in EXCLUSIVE_JOB_TYPES and running:
+            return False
+        return sum(1 for job in running if job.operation == job_type) < limits.get(job_type, 1)
+    
+    def add(self, job):
+        """Admit a job, raising JobLimitReached if its type is at its limit"""
+        limits = self.limits()
+        with self.lock:
+            if not self._can_start_locked(job.operation, limits):
+                raise JobLimitReached(f"{job.operation.title()} limit of {limits.get(job.operation, 1)} "
+                                      f"reached or the repository is busy")
+            self.running[job.id] = job
+    
+    def finish(self, job):
+        """Move a job from running to the finished history"""
+        with self.lock:
+            if self.running.pop(job.id, None) is not None:
+                self.finished.append(job)
+            self.released.notify_all()
+    
+    @contextmanager
+    def exclusive(self, job):
+        """Run the enclosed step of a running job once no other job uses the repository
+        
+        No job is admitted from the moment the step starts waiting until it
+        ends. Jobs waiting for their own exclusive step do not hold it up;
+        they go one after another.
+        """
+        with self.lock:
+            self.exclusive_waiting.add(job.id)
+            while self.exclusive_owner is not None or any(
+                    other.id != job.id and other.id not in self.exclusive_waiting
+                    for other in self.running.values()):
+                self.released.wait()
+            self.exclusive_waiting.discard(job.id)
+            self.exclusive_owner = job.id
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.exclusive_owner = None
+                self.released.notify_all()
+    
+    def get(self, job_id):
+        with self.lock:
+            if job_id in self.running:
+                return self.running[job_id]
+            for job in self.finished:
+                if job.id == job_id:
+                    return job
+        return None
+    
+    def active(self):
+        """Running jobs, oldest first"""
+        with self.lock:
+            return sorted(self.running.values(), key=lambda job: job.start_time)
+    
+    def list(self, operation=None, status=None, limit=None):
+        """Running and finished jobs, newest first"""
+        with self.lock:
+            jobs = list(self.running.values()) + list(self.finished)
+        jobs = [job for job in jobs
+                if (operation is None or job.operation == operation)
+                and (status is None or job.status.value == status)]
+        jobs.sort(key=lambda job: job.start_time, reverse=True)
+        return jobs[:limit]
+    
+    def headline(self, operations=None):
+        """The job /api/status reports: the newest running job, else the last one to finish
+        
+        `operations` limits the choice to those job types.
+        """
+        with self.lock:
+            running = [job for job in self.running.values() if operations is None or job.operation in operations]
+            if running:
+                return max(running, key=lambda job: job.start_time)
+            for job in reversed(self.finished):
+                if operations is None or job.operation in operations:
+                    return job
+        return None
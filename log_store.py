@@ -0,0 +1,257 @@
+import os
+import atexit
+import sqlite3
+import threading
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+LOG_STORE_PATH = '/data/logs.db'
+
+# Log entries kept in memory when log_capacity is not configured
+DEFAULT_LOG_CAPACITY = 1000
+
+# Retention of the on-disk log store when log_retention_days / log_max_size_mb are not configured
+DEFAULT_LOG_RETENTION_DAYS = 90
+DEFAULT_LOG_MAX_SIZE_MB = 100
+
+# Seconds between batched writes to the log store
+LOG_FLUSH_INTERVAL = 1
+
+# Seconds between retention passes
+LOG_RETENTION_INTERVAL = 3600
+
+LOG_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    time_unix REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    level TEXT NOT NULL,
+    level_no INTEGER NOT NULL,
+    job_id TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_time ON logs (time_unix);
+CREATE INDEX IF NOT EXISTS logs_level ON logs (level_no, time_unix);
+CREATE INDEX IF NOT EXISTS logs_job ON logs (job_id, time_unix);
+"""
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+def level_at_least(level, min_level):
+    """Whether a level name is at or above a minimum level name (None allows all)"""
+    if not min_level or level not in LOG_LEVELS:
+        return True
+    return LOG_LEVELS.index(level) >= LOG_LEVELS.index(min_level.upper())
+
+class LogBuffer:
+    """Fixed-capacity ring buffer of log entries numbered with increasing sequence numbers"""
+    
+    def __init__(self, capacity=DEFAULT_LOG_CAPACITY):
+        self.entries = deque(maxlen=max(1, capacity))
+        self.seq = 0
+        self.lock = threading.Lock()
+    
+    def append(self, entry):
+        """Number an entry and add it, dropping the oldest once full"""
+        with self.lock:
+            self.seq += 1
+            entry['seq'] = self.seq
+            self.entries.append(entry)
+            return self.seq
+    
+    def resize(self, capacity):
+        """Change the capacity, keeping the newest entries"""
+        with self.lock:
+            self.entries = deque(self.entries, maxlen=max(1, capacity))
+    
+    @property
+    def cursor(self):
+        with self.lock:
+            return self.seq
+    
+    def recent(self, limit=50, level=None):
+        """The newest entries, oldest first"""
+        with self.lock:
+            result = []
+            for entry in reversed(self.entries):
+                if len(result) >= limit:
+                    break
+                if level_at_least(entry['level'], level):
+                    result.append(entry)
+        result.reverse()
+        return result
+    
+    def since(self, after, level=None, limit=None):
+        """Entries newer than sequence number `after`, oldest first
+        
+        Returns the entries, the cursor to pass as `after` next time and
+        whether entries were already dropped from the buffer.
+        """
+        with self.lock:
+            if after > self.seq:
+                # Cursor from before a restart; everything is new to this client
+                after = 0
+            first = self.entries[0]['seq'] if self.entries else self.seq + 1
+            missed = after < first - 1
+            
+            result = []
+            cursor = after
+            for entry in islice(self.entries, max(0, after - first + 1), None):
+                if limit and len(result) >= limit:
+                    break
+                cursor = entry['seq']
+                if level_at_least(entry['level'], level):
+                    result.append(entry)
+            return result, cursor, missed
+
+class LogStore:
+    """Persistent SQLite log history indexed by time, level and job id
+    
+    Entries are queued by `add` and written in batches by a background
+    thread, so logging never waits on the disk. Entries older than the
+    retention age are deleted, and the oldest entries go first once the
+    data outgrows the size limit; freed pages are reused, which keeps the
+    file itself bounded.
+    """
+    
+    def __init__(self, path=LOG_STORE_PATH, retention_days=DEFAULT_LOG_RETENTION_DAYS,
+                 max_size_mb=DEFAULT_LOG_MAX_SIZE_MB):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_size = max_size_mb * 1024 * 1024
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self._initialized = False
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_retention = 0
+    
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.row_factory = sqlite3.Row
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(LOG_STORE_SCHEMA)
+                self._initialized = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def add(self, entry):
+        """Queue an entry for the next batched write"""
+        self.pending.append(entry)
+        if self._thread is None:
+            with self.lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='log-store', daemon=True)
+                    self._thread.start()
+                    # Short-lived processes such as the cron job exit right after logging
+                    atexit.register(self.flush)
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(LOG_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.time() - self._last_retention >= LOG_RETENTION_INTERVAL:
+                    self.apply_retention()
+            except Exception as e:
+                logger.error(f"Log store write failed: {e}")
+    
+    def flush(self):
+        """Write queued entries in one transaction"""
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        if not batch:
+            return
+        
+        rows = []
+        for entry in batch:
+            try:
+                time_unix = datetime.fromisoformat(entry['timestamp']).timestamp()
+            except (KeyError, ValueError):
+                time_unix = time.time()
+            level = entry.get('level', 'INFO')
+            rows.append((time_unix, entry.get('timestamp', ''), level,
+                         LOG_LEVELS.index(level) if level in LOG_LEVELS else 1,
+                         entry.get('job_id'), entry.get('message', '')))
+        
+        with self._connect() as conn:
+            conn.executemany('INSERT INTO logs (time_unix, timestamp, level, level_no, job_id, message) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    
+    def apply_retention(self):
+        """Delete entries past the retention age, then the oldest ones while over the size limit"""
+        self._last_retention = time.time()
+        with self._connect() as conn:
+            if self.retention_days:
+                conn.execute('DELETE FROM logs WHERE time_unix < ?',
+                             (time.time() - self.retention_days * 86400,))
+            
+            if self.max_size:
+                page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+                used = (conn.execute('PRAGMA page_count').fetchone()[0]
+                        - conn.execute('PRAGMA freelist_count').fetchone()[0]) * page_size
+                if used > self.max_size:
+                    # Drop the oldest entries in proportion to the excess, plus a margin
+                    count = conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+                    excess = int(count * (1 - self.max_size / used)) + count // 10
+                    conn.execute('DELETE FROM logs WHERE id IN (SELECT id FROM logs ORDER BY id LIMIT ?)',
+                                 (excess,))
+    
+    def query(self, since=None, until=None, level=None, text=None, job_id=None, page=1, per_page=100):
+        """Page through stored entries, newest first, filtered by time range, level, text and job"""
+        clauses = []
+        params = []
+        if since is not None:
+            clauses.append('time_unix >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('time_unix < ?')
+            params.append(until)
+        if level:
+            clauses.append('level_no >= ?')
+            params.append(LOG_LEVELS.index(level.upper()))
+        if text:
+            clauses.append("message LIKE ? ESCAPE '\\'")
+            params.append('%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if job_id:
+            clauses.append('job_id = ?')
+            params.append(job_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        
+        page = max(1, int(page))
+        per_page = max(1, min(1000, int(per_page)))
+        
+        with self._connect() as conn:
+            total = conn.execute(f'SELECT COUNT(*) FROM logs {where}', params).fetchone()[0]
+            rows = conn.execute(
+                f'SELECT * FROM logs {where} ORDER BY time_unix DESC, id DESC LIMIT ? OFFSET ?',
+                params + [per_page, (page - 1) * per_page]).fetchall()
+            counts = {row['level']: row['count'] for row in conn.execute(
+                f'SELECT level, COUNT(*) AS count FROM logs {where} GROUP BY level', params)}
+        
+        return [self._row_to_dict(row) for row in rows], total, counts
+    
+    def _row_to_dict(self, row):
+        return {
+            'id': row['id'],
+            'timestamp': row['timestamp'],
+            'time_unix': row['time_unix'],
+            'level': row['level'],
+            'job_id': row['job_id'],
+            'message': row['message']
+        }
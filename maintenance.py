@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRUNE_HISTORY_PATH = '/data/prune_history.json'
+
+# Prune runs kept in the history
+PRUNE_HISTORY_LIMIT = 50
+
+# Cron expression for scheduled prunes when prune_schedule is not configured (Sundays, 04:00)
+DEFAULT_PRUNE_SCHEDULE = '0 4 * * 0'
+
+# Unused space prune may leave behind when prune_max_unused is not configured (restic's default)
+DEFAULT_PRUNE_MAX_UNUSED = '5%'
+
+# Retention keys accepted in a policy, mapped to restic forget options
+RETENTION_OPTIONS = {
+    'keep_last': '--keep-last',
+    'keep_hourly': '--keep-hourly',
+    'keep_daily': '--keep-daily',
+    'keep_weekly': '--keep-weekly',
+    'keep_monthly': '--keep-monthly',
+    'keep_yearly': '--keep-yearly',
+    'keep_within': '--keep-within'
+}
+
+SIZE_UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4}
+
+# Summary lines printed by restic prune, e.g. "total prune:  3 blobs / 1.234 MiB"
+PRUNE_LINE_PATTERN = re.compile(r'^(to repack|this removes|to delete|total prune|remaining):\s+(\d+) blobs / ([\d.]+) (\w+)')
+PRUNE_UNUSED_PATTERN = re.compile(r'^unused size after prune: ([\d.]+) (\w+)')
+
+def retention_policy(volume, config):
+    """Retention policy of a volume: its override from volume_retention, else the default"""
+    policy = config.get('volume_retention', {}).get(volume, config.get('retention', {}))
+    return {key: value for key, value in (policy or {}).items() if key in RETENTION_OPTIONS and value}
+
+def prune_schedule(config):
+    """Cron expression for scheduled prunes, or None when they are off
+    
+    Prunes are scheduled by default once any retention policy is configured,
+    as that is when forgotten snapshots start leaving unreferenced data.
+    """
+    enabled = config.get('prune_enabled', bool(config.get('retention') or config.get('volume_retention')))
+    return config.get('prune_schedule', DEFAULT_PRUNE_SCHEDULE) if enabled else None
+
+def forget_args(policy):
+    """restic forget options for a retention policy"""
+    args = []
+    for key, option in RETENTION_OPTIONS.items():
+        if policy.get(key):
+            args += [option, str(policy[key])]
+    return args
+
+def summarize_forget(output):
+    """Snapshot IDs kept and removed, from restic forget --json output"""
+    kept = []
+    removed = []
+    try:
+        groups = json.loads(output) or []
+    except ValueError:
+        return kept, removed
+    for group in groups:
+        kept += [snapshot['id'] for snapshot in group.get('keep') or []]
+        removed += [snapshot['id'] for snapshot in group.get('remove') or []]
+    return kept, removed
+
+def parse_size(value, unit):
+    return int(float(value) * SIZE_UNITS.get(unit, 1))
+
+def parse_prune_output(lines):
+    """Blob counts and sizes from the summary restic prune prints before deleting"""
+    summary = {}
+    for line in lines:
+        line = line.strip()
+        match = PRUNE_LINE_PATTERN.match(line)
+        if match:
+            key = match.group(1).replace(' ', '_')
+            summary[key] = {'blobs': int(match.group(2)), 'bytes': parse_size(match.group(3), match.group(4))}
+            continue
+        match = PRUNE_UNUSED_PATTERN.match(line)
+        if match:
+            summary['unused_after'] = parse_size(match.group(1), match.group(2))
+    return summary
+
+class PruneHistory:
+    """Recent prune runs with what they freed and how long they took"""
+    
+    def __init__(self, path=PRUNE_HISTORY_PATH, limit=PRUNE_HISTORY_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+    
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            logger.error(f"Error loading prune history: {e}")
+            return []
+    
+    def recent(self, limit=None):
+        """Prune runs, newest first"""
+        with self.lock:
+            runs = self._load()
+        return list(reversed(runs))[:limit]
+    
+    def record(self, run):
+        with self.lock:
+            runs = (self._load() + [run])[-self.limit:]
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(runs, f, indent=2)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.error(f"Error saving prune history: {e}")
@@ -0,0 +1,177 @@
+import math
+import threading
+from bisect import bisect_left
+
+# Upper bounds of the job and restic runtime histograms, in seconds
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800)
+
+# Upper bounds of the HTTP request latency histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    """One metric family; samples are keyed by their label values"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels) or 'none'}")
+        return tuple(str(labels[label]) for label in self.labels)
+    
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{escape_label(value)}"' for label, value in pairs) + '}'
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._samples():
+            lines.extend(self._render_sample(key, value))
+        return lines
+    
+    def _samples(self):
+        with self.lock:
+            return sorted(self.values.items())
+    
+    def _render_sample(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {format_value(value)}"]
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters only go up')
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+    
+    def replace(self, samples):
+        """Swap in a new set of samples, given as {label values tuple: value}, dropping the rest"""
+        with self.lock:
+            self.values = {tuple(str(part) for part in key): value for key, value in samples.items()}
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+    
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = self._format_labels(key, [('le', format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {format_value(total)}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+    
+    def _samples(self):
+        with self.lock:
+            return sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+
+class MetricsRegistry:
+    """In-memory metrics, rendered in the Prometheus text format
+    
+    Everything a scrape returns is kept up to date by the code that does the
+    work, so rendering never runs restic or touches the disk. Callbacks
+    added with on_collect may refresh gauges from other in-memory state.
+    """
+    
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.metrics = []
+        self.collectors = []
+    
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(self.prefix + name, description, labels))
+    
+    def gauge(self, name, description, labels=()):
+        return self._add(Gauge(self.prefix + name, description, labels))
+    
+    def histogram(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        return self._add(Histogram(self.prefix + name, description, labels, buckets))
+    
+    def on_collect(self, callback):
+        self.collectors.append(callback)
+    
+    def render(self):
+        for callback in self.collectors:
+            callback()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class BackupMetrics(MetricsRegistry):
+    """The metrics /metrics exports"""
+    
+    def __init__(self):
+        super().__init__(prefix='volumebackups_')
+        self.job_duration = self.histogram('job_duration_seconds', 'Duration of finished jobs',
+                                           ('operation', 'status'))
+        self.jobs_running = self.gauge('jobs_running', 'Jobs running now', ('operation',))
+        self.bytes_processed = self.counter('bytes_processed_total',
+                                            'Bytes read by backups, or written by restores and downloads', ('operation',))
+        self.volume_bytes_processed = self.counter('volume_bytes_processed_total', 'Bytes backups read per volume',
+                                                   ('volume',))
+        self.volume_bytes_added = self.counter('volume_bytes_added_total',
+                                               'Bytes backups added to the repository per volume', ('volume',))
+        self.last_success = self.gauge('volume_last_success_timestamp_seconds',
+                                       'Unix time the last backup of a volume finished that succeeded or found it unchanged',
+                                       ('volume',))
+        self.restic_duration = self.histogram('restic_command_duration_seconds', 'Runtime of restic processes',
+                                              ('command',))
+        self.restic_failures = self.counter('restic_command_failures_total', 'restic processes that exited non-zero',
+                                            ('command',))
+        self.repository_size = self.gauge('repository_size_bytes',
+                                          'Repository size reported by the last prune')
+        self.snapshots = self.gauge('snapshots', 'Snapshots in the catalog per volume', ('volume',))
+        self.catalog_synced = self.gauge('catalog_last_sync_timestamp_seconds',
+                                         'Unix time of the last snapshot catalog sync')
+        self.http_duration = self.histogram('http_request_duration_seconds', 'Latency of HTTP requests per route',
+                                            ('method', 'route', 'status'), buckets=LATENCY_BUCKETS)
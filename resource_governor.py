@@ -0,0 +1,282 @@
+import os
+import shlex
+import subprocess
+import threading
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Profile used outside all windows when resource_profile is not configured; it sets no limits
+DEFAULT_PROFILE = 'unlimited'
+
+# Arguments restic passes to rclone by default; the bandwidth timetable is appended to them
+RCLONE_DEFAULT_ARGS = 'serve restic --stdio --b2-hard-delete'
+
+# ionice scheduling classes by name; 'none' lets the kernel derive it from the nice level
+IONICE_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Longest sleep between checks for a window boundary
+GOVERNOR_CHECK_INTERVAL = 60
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# A Monday, used to lay out the weekly rclone timetable
+_REFERENCE_MONDAY = datetime(2024, 1, 1)
+
+def _parse_minutes(value):
+    hours, minutes = value.split(':')
+    total = int(hours) * 60 + int(minutes)
+    if not 0 <= total <= 24 * 60:
+        raise ValueError(f"time out of range: {value}")
+    return total % (24 * 60)
+
+def parse_windows(windows):
+    """Validate resource_windows entries, dropping (and logging) bad ones"""
+    parsed = []
+    for window in windows or []:
+        try:
+            days = window.get('days')
+            parsed.append({
+                'start': _parse_minutes(window['start']),
+                'end': _parse_minutes(window['end']),
+                'days': {DAY_NAMES.index(day.lower()[:3]) for day in days} if days else set(range(7)),
+                'profile': window['profile']
+            })
+        except (KeyError, ValueError, AttributeError, TypeError) as e:
+            logger.error(f"Ignoring invalid resource window {window}: {e}")
+    return parsed
+
+def _window_matches(window, when):
+    minute = when.hour * 60 + when.minute
+    day = when.weekday()
+    if window['start'] == window['end']:
+        return day in window['days']
+    if window['start'] < window['end']:
+        return day in window['days'] and window['start'] <= minute < window['end']
+    # Window across midnight: the part after midnight belongs to the day it started on
+    return ((minute >= window['start'] and day in window['days'])
+            or (minute < window['end'] and (day - 1) % 7 in window['days']))
+
+def _process_threads(pid):
+    """Thread IDs of a process and all its descendants (restic and the rclone it spawned)"""
+    threads = []
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            tids = os.listdir(f"/proc/{current}/task")
+        except OSError:
+            continue
+        for tid in tids:
+            threads.append(int(tid))
+            try:
+                with open(f"/proc/{current}/task/{tid}/children", 'r') as f:
+                    stack.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+    return threads
+
+class ResourceGovernor:
+    """Resource profiles for restic jobs, switched by time-of-day windows
+    
+    A profile sets CPU niceness, the I/O class, restic's --limit-upload and
+    --limit-download (KiB/s), and an rclone --bwlimit. restic limits are
+    fixed when a process starts. Niceness and I/O class are reapplied to
+    running processes when a window boundary passes. rclone gets a
+    timetable built from the windows, so its limit changes on time too.
+    """
+    
+    def __init__(self, load_config, on_change=None):
+        self.load_config = load_config
+        self.on_change = on_change
+        self.processes = {}
+        self.active = None
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._windows = (None, [])
+    
+    def _settings(self):
+        config = self.load_config()
+        windows = config.get('resource_windows')
+        if windows != self._windows[0]:
+            # Parse (and complain about) each version of the windows once
+            self._windows = (windows, parse_windows(windows))
+        return (config.get('resource_profiles', {}),
+                config.get('resource_profile', DEFAULT_PROFILE),
+                self._windows[1])
+    
+    def _profile(self, profiles, name):
+        if name != DEFAULT_PROFILE and name not in profiles:
+            logger.warning(f"Unknown resource profile {name}, running without limits")
+        return profiles.get(name, {})
+    
+    def profile_at(self, when=None, settings=None):
+        """Name of the profile in effect at a time: the first matching window, else the default"""
+        profiles, default, windows = settings or self._settings()
+        when = when or datetime.now()
+        for window in windows:
+            if _window_matches(window, when):
+                return window['profile']
+        return default
+    
+    def _boundaries(self, when, windows):
+        midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        candidates = set()
+        for window in windows:
+            for offset in range(8):
+                for minute in (window['start'], window['end']):
+                    boundary = midnight + timedelta(days=offset, minutes=minute)
+                    if boundary > when:
+                        candidates.add(boundary)
+        return sorted(candidates)
+    
+    def next_switch(self, when=None, settings=None):
+        """Time of the next window boundary that changes the profile, or None"""
+        settings = settings or self._settings()
+        when = when or datetime.now()
+        current = self.profile_at(when, settings)
+        for boundary in self._boundaries(when, settings[2]):
+            if self.profile_at(boundary, settings) != current:
+                return boundary
+        return None
+    
+    def rclone_timetable(self, settings=None):
+        """rclone --bwlimit value covering all windows, or None when no profile limits rclone"""
+        settings = settings or self._settings()
+        profiles, default, windows = settings
+        names = {default} | {window['profile'] for window in windows}
+        if not any(profiles.get(name, {}).get('rclone_bwlimit') for name in names):
+            return None
+        
+        def rate(when):
+            return profiles.get(self.profile_at(when, settings), {}).get('rclone_bwlimit') or 'off'
+        
+        if not windows:
+            return rate(_REFERENCE_MONDAY)
+        
+        minutes = sorted({0} | {window['start'] for window in windows} | {window['end'] for window in windows})
+        weekly = any(window['days'] != set(range(7)) for window in windows)
+        entries = []
+        previous = None
+        for day in range(7 if weekly else 1):
+            for minute in minutes:
+                current = rate(_REFERENCE_MONDAY + timedelta(days=day, minutes=minute))
+                if current == previous:
+                    continue
+                previous = current
+                prefix = f"{DAY_NAMES[day].capitalize()}-" if weekly else ''
+                entries.append(f"{prefix}{minute // 60:02d}:{minute % 60:02d},{current}")
+        return ' '.join(entries)
+    
+    def command(self, args):
+        """Wrap a restic command line in the active profile
+        
+        Returns the command and the profile name.
+        """
+        settings = self._settings()
+        profiles = settings[0]
+        name = self.profile_at(settings=settings)
+        profile = self._profile(profiles, name)
+        
+        prefix = []
+        if profile.get('nice') is not None:
+            prefix += ['nice', '-n', str(profile['nice'])]
+        if profile.get('ionice_class'):
+            prefix += ['ionice', '-c', str(IONICE_CLASSES.get(profile['ionice_class'], profile['ionice_class']))]
+            if profile.get('ionice_level') is not None:
+                prefix += ['-n', str(profile['ionice_level'])]
+        
+        options = []
+        if profile.get('limit_upload'):
+            options += ['--limit-upload', str(profile['limit_upload'])]
+        if profile.get('limit_download'):
+            options += ['--limit-download', str(profile['limit_download'])]
+        timetable = self.rclone_timetable(settings)
+        if timetable:
+            options += ['-o', f"rclone.args={RCLONE_DEFAULT_ARGS} --bwlimit {shlex.quote(timetable)}"]
+        
+        return prefix + args + options, name
+    
+    def track(self, pid, label):
+        """Follow a running restic process so profile switches reach it"""
+        with self.lock:
+            self.processes[pid] = label
+            if self.active is None:
+                self.active = self.profile_at()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='resource-governor', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+    
+    def untrack(self, pid):
+        with self.lock:
+            self.processes.pop(pid, None)
+    
+    def status(self):
+        """Active profile, its limits and the next scheduled switch"""
+        settings = self._settings()
+        name = self.profile_at(settings=settings)
+        next_switch = self.next_switch(settings=settings)
+        with self.lock:
+            running = len(self.processes)
+        return {
+            'profile': name,
+            'limits': settings[0].get(name, {}),
+            'next_switch': next_switch.timestamp() if next_switch else None,
+            'next_profile': self.profile_at(next_switch, settings) if next_switch else None,
+            'processes': running
+        }
+    
+    def _run(self):
+        while True:
+            next_switch = self.next_switch()
+            timeout = GOVERNOR_CHECK_INTERVAL
+            if next_switch is not None:
+                timeout = min(timeout, max(1, (next_switch - datetime.now()).total_seconds() + 1))
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            try:
+                self._check()
+            except Exception as e:
+                logger.error(f"Error applying resource profile: {e}")
+    
+    def _check(self):
+        settings = self._settings()
+        name = self.profile_at(settings=settings)
+        with self.lock:
+            if name == self.active:
+                return
+            previous = self.active
+            self.active = name
+            processes = dict(self.processes)
+        logger.info(f"Resource profile switched from {previous} to {name}")
+        profile = self._profile(settings[0], name)
+        for pid, label in processes.items():
+            self.apply(pid, profile)
+            logger.info(f"Applied resource profile {name} to {label} (pid {pid})")
+        if self.on_change:
+            self.on_change()
+    
+    def apply(self, pid, profile):
+        """Set niceness and I/O class on every thread of a running process tree"""
+        threads = _process_threads(pid)
+        if not threads:
+            return
+        baseline = os.getpriority(os.PRIO_PROCESS, 0)
+        nice = profile.get('nice')
+        for tid in threads:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, baseline + nice if nice is not None else baseline)
+            except OSError as e:
+                logger.warning(f"Could not renice thread {tid}: {e}")
+        
+        io_class = IONICE_CLASSES.get(profile.get('ionice_class') or 'none', profile.get('ionice_class'))
+        cmd = ['ionice', '-c', str(io_class)]
+        if profile.get('ionice_level') is not None and io_class in (1, 2):
+            cmd += ['-n', str(profile['ionice_level'])]
+        cmd += ['-p'] + [str(tid) for tid in threads]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        if result.returncode != 0:
+            logger.warning(f"ionice failed for pid {pid}: {result.stderr.strip()}")
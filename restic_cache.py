@@ -0,0 +1,149 @@
+import os
+import shutil
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '/data/restic-cache'
+
+# Size limit of the restic cache when restic_cache_max_size_mb is not configured
+DEFAULT_CACHE_MAX_SIZE_MB = 2048
+
+def _walk_files(path):
+    """Yield (path, size, mtime) for every file below a directory"""
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            yield entry.path, stat.st_size, stat.st_mtime
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+class ResticCache:
+    """restic's metadata cache kept under /data, bounded in size
+    
+    restic stores one directory per repository ID. Directories of other
+    repositories are evicted first, least recently used first; if the
+    current repository alone is over the limit its cached data packs go,
+    oldest first. Index and snapshot files are kept, as losing them is
+    what makes the first command after a redeploy slow.
+    """
+    
+    def __init__(self, path=CACHE_DIR, max_size_mb=DEFAULT_CACHE_MAX_SIZE_MB):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self._stats = {'size': None, 'limit': self.max_size, 'repositories': 0,
+                       'hits': None, 'misses': None, 'hit_ratio': None,
+                       'evicted': 0, 'scanned_at': None, 'warmed_at': None}
+    
+    def stats(self):
+        """Last measured size, hit/miss counts and evictions"""
+        with self.lock:
+            return dict(self._stats)
+    
+    def _update(self, **fields):
+        with self.lock:
+            self._stats.update(fields)
+    
+    def repositories(self):
+        """Size and last use of each repository directory in the cache"""
+        repos = {}
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return repos
+        for name in names:
+            repo_path = os.path.join(self.path, name)
+            if not os.path.isdir(repo_path):
+                continue
+            size = 0
+            last_used = os.stat(repo_path).st_mtime
+            for _, file_size, mtime in _walk_files(repo_path):
+                size += file_size
+                last_used = max(last_used, mtime)
+            repos[name] = {'size': size, 'last_used': last_used}
+        return repos
+    
+    def scan(self):
+        """Measure the cache and refresh the size figures"""
+        repos = self.repositories()
+        self._update(size=sum(repo['size'] for repo in repos.values()),
+                     repositories=len(repos), scanned_at=time.time())
+        return repos
+    
+    def measure_coverage(self, repo_id, repository_files):
+        """Count repository index/snapshot files already cached (hits) or not (misses)
+        
+        `repository_files` maps a cache subdirectory to the file IDs the
+        repository currently holds, e.g. from `restic list index`.
+        """
+        hits = 0
+        misses = 0
+        for file_type, ids in repository_files.items():
+            for file_id in ids:
+                if os.path.exists(os.path.join(self.path, repo_id, file_type, file_id[:2], file_id)):
+                    hits += 1
+                else:
+                    misses += 1
+        total = hits + misses
+        self._update(hits=hits, misses=misses, hit_ratio=hits / total if total else None)
+        return hits, misses
+    
+    def mark_warmed(self):
+        self._update(warmed_at=time.time())
+    
+    def enforce_limit(self, current_repo_id):
+        """Evict until the cache fits its size limit; returns the bytes freed
+        
+        Nothing is evicted while the current repository is unknown, since any
+        cache directory might be the one in use.
+        """
+        if self.max_size <= 0 or current_repo_id is None:
+            return 0
+        repos = self.repositories()
+        size = sum(repo['size'] for repo in repos.values())
+        freed = 0
+        
+        # Other repositories, least recently used first
+        for name, repo in sorted(repos.items(), key=lambda item: item[1]['last_used']):
+            if size <= self.max_size:
+                break
+            if name == current_repo_id:
+                continue
+            logger.info(f"Evicting restic cache of repository {name[:8]}")
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            size -= repo['size']
+            freed += repo['size']
+        
+        # Then cached data packs of the current repository, oldest first
+        if size > self.max_size and current_repo_id in repos:
+            packs = sorted(_walk_files(os.path.join(self.path, current_repo_id, 'data')),
+                           key=lambda item: item[2])
+            for pack_path, pack_size, _ in packs:
+                if size <= self.max_size:
+                    break
+                try:
+                    os.unlink(pack_path)
+                    size -= pack_size
+                    freed += pack_size
+                except OSError:
+                    pass
+        
+        with self.lock:
+            self._stats['evicted'] += freed
+            self._stats['size'] = size
+            self._stats['repositories'] = len(os.listdir(self.path)) if os.path.isdir(self.path) else 0
+            self._stats['scanned_at'] = time.time()
+        return freed
@@ -0,0 +1,70 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Concurrent restic restore processes when restore_workers is not configured;
+# 1 restores the whole snapshot with a single process
+DEFAULT_RESTORE_WORKERS = 1
+
+# Directories a snapshot is split into per worker at most; bounds the catch-all shard's --exclude list
+MAX_UNITS_PER_WORKER = 8
+
+def escape_pattern(path):
+    """Quote glob characters so restic matches a path literally in --include/--exclude"""
+    return re.sub(r'([*?\[\\])', r'\\\1', path)
+
+def plan_shards(list_dir, root, total_size, workers, max_units=None):
+    """Split a snapshot's tree into at most `workers` shards of similar size
+    
+    `list_dir(path)` returns the entries of a directory with their total
+    sizes. Directories larger than a shard's share are split into their
+    subdirectories, then the pieces are handed out largest first to the
+    lightest shard. The first shard is the catch-all: it restores
+    everything except the directories given to the other shards, which
+    covers loose files and anything created outside the plan. Returns a
+    list of {'include', 'exclude', 'size'} dicts.
+    """
+    max_units = max_units or workers * MAX_UNITS_PER_WORKER
+    share = total_size / workers
+    units = [dict(entry, size=entry['size'] or 0) for entry in list_dir(root) if entry['type'] == 'dir']
+    leaves = set()
+    
+    while True:
+        candidates = [unit for unit in units if unit['size'] > share and unit['path'] not in leaves]
+        if not candidates:
+            break
+        largest = max(candidates, key=lambda unit: unit['size'])
+        children = [dict(entry, size=entry['size'] or 0) for entry in list_dir(largest['path'])
+                    if entry['type'] == 'dir']
+        loose = largest['size'] - sum(child['size'] for child in children)
+        # Splitting only pays off if the directory's own files are not themselves a big share
+        if not children or loose > share or len(units) - 1 + len(children) > max_units:
+            leaves.add(largest['path'])
+            continue
+        units.remove(largest)
+        units.extend(children)
+    
+    shards = [{'include': [], 'exclude': [], 'size': total_size - sum(unit['size'] for unit in units)}]
+    shards += [{'include': [], 'exclude': [], 'size': 0} for _ in range(workers - 1)]
+    for unit in sorted(units, key=lambda unit: unit['size'], reverse=True):
+        if not unit['size']:
+            # Empty directories are left to the catch-all rather than costing a restic process
+            break
+        shard = min(shards, key=lambda shard: shard['size'])
+        shard['size'] += unit['size']
+        if shard is not shards[0]:
+            shard['include'].append(unit['path'])
+    
+    shards = [shards[0]] + [shard for shard in shards[1:] if shard['include']]
+    shards[0]['exclude'] = [path for shard in shards[1:] for path in shard['include']]
+    return shards
+
+def shard_args(shard):
+    """restic restore filter options for a shard"""
+    args = []
+    for path in shard['include']:
+        args += ['--include', escape_pattern(path)]
+    for path in shard['exclude']:
+        args += ['--exclude', escape_pattern(path)]
+    return args
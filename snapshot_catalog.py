@@ -0,0 +1,236 @@
+import os
+import json
+import re
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = '/data/snapshots.db'
+
+# Seconds between background catalog syncs when catalog_sync_interval is not configured
+DEFAULT_SYNC_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY,
+    short_id TEXT NOT NULL,
+    time TEXT NOT NULL,
+    time_unix REAL NOT NULL,
+    hostname TEXT,
+    username TEXT,
+    tree TEXT,
+    parent TEXT,
+    paths TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time_unix);
+CREATE INDEX IF NOT EXISTS snapshots_host ON snapshots (hostname, time_unix);
+CREATE INDEX IF NOT EXISTS snapshots_short_id ON snapshots (short_id);
+
+CREATE TABLE IF NOT EXISTS snapshot_tags (
+    tag TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, snapshot_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS snapshot_paths (
+    path TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    PRIMARY KEY (path, snapshot_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS catalog_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def parse_restic_time(value):
+    """Convert a restic timestamp (RFC 3339 with nanoseconds) to a unix timestamp"""
+    if not value:
+        return 0.0
+    # Python only understands microseconds
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value.replace('Z', '+00:00'))
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return 0.0
+
+def parse_time_filter(value, end_of_day=False):
+    """Parse a since/until filter given as a date, an ISO timestamp or a unix timestamp"""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    parsed = datetime.fromisoformat(str(value))
+    if end_of_day and len(str(value)) == 10:
+        # A bare date as the upper bound includes that whole day
+        parsed += timedelta(days=1)
+    return parsed.timestamp()
+
+class SnapshotCatalog:
+    """Local SQLite copy of the repository's snapshot list"""
+    
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self._initialized = False
+    
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA foreign_keys = ON')
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def sync(self, snapshots):
+        """Bring the catalog in line with a `restic snapshots --json` listing
+        
+        Only snapshots that were added or removed since the last sync are
+        written. Returns the number of added and removed snapshots.
+        """
+        remote = {snapshot['id']: snapshot for snapshot in snapshots if snapshot.get('id')}
+        now = time.time()
+        
+        with self.lock, self._connect() as conn:
+            known = {row['id'] for row in conn.execute('SELECT id FROM snapshots')}
+            added = [remote[snapshot_id] for snapshot_id in remote.keys() - known]
+            removed = list(known - remote.keys())
+            
+            for snapshot in added:
+                paths = snapshot.get('paths') or []
+                tags = snapshot.get('tags') or []
+                conn.execute(
+                    'INSERT INTO snapshots (id, short_id, time, time_unix, hostname, username, '
+                    'tree, parent, paths, tags, synced_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (snapshot['id'], snapshot.get('short_id', snapshot['id'][:8]),
+                     snapshot.get('time', ''), parse_restic_time(snapshot.get('time')),
+                     snapshot.get('hostname'), snapshot.get('username'),
+                     snapshot.get('tree'), snapshot.get('parent'),
+                     json.dumps(paths), json.dumps(tags), now))
+                conn.executemany('INSERT OR IGNORE INTO snapshot_paths (path, snapshot_id) VALUES (?, ?)',
+                                 [(path, snapshot['id']) for path in paths])
+                conn.executemany('INSERT OR IGNORE INTO snapshot_tags (tag, snapshot_id) VALUES (?, ?)',
+                                 [(tag, snapshot['id']) for tag in tags])
+            
+            conn.executemany('DELETE FROM snapshots WHERE id = ?', [(snapshot_id,) for snapshot_id in removed])
+            conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('synced_at', ?)", (str(now),))
+        
+        return len(added), len(removed)
+    
+    def synced_at(self):
+        """Unix time of the last successful sync, or None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'synced_at'").fetchone()
+            return float(row['value']) if row else None
+    
+    def query(self, tag=None, path=None, host=None, since=None, until=None, page=1, per_page=50):
+        """Page through snapshots, newest first, filtered by tag, path, host and time range"""
+        clauses = []
+        params = []
+        if tag:
+            clauses.append('id IN (SELECT snapshot_id FROM snapshot_tags WHERE tag = ?)')
+            params.append(tag)
+        if path:
+            clauses.append('id IN (SELECT snapshot_id FROM snapshot_paths WHERE path = ?)')
+            params.append(path)
+        if host:
+            clauses.append('hostname = ?')
+            params.append(host)
+        if since is not None:
+            clauses.append('time_unix >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('time_unix < ?')
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        
+        page = max(1, int(page))
+        per_page = max(1, min(500, int(per_page)))
+        
+        with self._connect() as conn:
+            total = conn.execute(f'SELECT COUNT(*) FROM snapshots {where}', params).fetchone()[0]
+            rows = conn.execute(
+                f'SELECT * FROM snapshots {where} ORDER BY time_unix DESC LIMIT ? OFFSET ?',
+                params + [per_page, (page - 1) * per_page]).fetchall()
+        
+        return [self._row_to_dict(row) for row in rows], total
+    
+    def get(self, snapshot_id):
+        """Look up a snapshot by full or short id"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM snapshots WHERE id = ? OR short_id = ?',
+                               (snapshot_id, snapshot_id)).fetchone()
+            return self._row_to_dict(row) if row else None
+    
+    def previous(self, snapshot):
+        """The snapshot a snapshot follows, or None for the first of its volume
+        
+        That is its restic parent if catalogued, else the latest earlier
+        snapshot of the same host and paths.
+        """
+        with self._connect() as conn:
+            if snapshot.get('parent'):
+                row = conn.execute('SELECT * FROM snapshots WHERE id = ?', (snapshot['parent'],)).fetchone()
+                if row is not None:
+                    return self._row_to_dict(row)
+            row = conn.execute(
+                'SELECT * FROM snapshots WHERE hostname IS ? AND paths = ? AND time_unix < ? '
+                'ORDER BY time_unix DESC LIMIT 1',
+                (snapshot['hostname'] if snapshot['hostname'] != 'Unknown' else None,
+                 json.dumps(snapshot['paths']), snapshot['time_unix'])).fetchone()
+            return self._row_to_dict(row) if row else None
+    
+    def ids(self):
+        """Full ids of all catalogued snapshots"""
+        with self._connect() as conn:
+            return {row['id'] for row in conn.execute('SELECT id FROM snapshots')}
+    
+    def volume_counts(self):
+        """Number of snapshots per volume, by their volume:<name> tag"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT substr(tag, 8) AS volume, COUNT(*) AS count FROM snapshot_tags "
+                                "WHERE tag LIKE 'volume:%' GROUP BY tag").fetchall()
+        return {row['volume']: row['count'] for row in rows}
+    
+    def facets(self):
+        """Distinct tags, paths and hosts for filter drop-downs"""
+        with self._connect() as conn:
+            return {
+                'tags': [row[0] for row in conn.execute('SELECT DISTINCT tag FROM snapshot_tags ORDER BY tag')],
+                'paths': [row[0] for row in conn.execute('SELECT DISTINCT path FROM snapshot_paths ORDER BY path')],
+                'hosts': [row[0] for row in conn.execute(
+                    'SELECT DISTINCT hostname FROM snapshots WHERE hostname IS NOT NULL ORDER BY hostname')]
+            }
+    
+    def _row_to_dict(self, row):
+        return {
+            'id': row['short_id'],
+            'full_id': row['id'],
+            'time': row['time'],
+            'time_unix': row['time_unix'],
+            'hostname': row['hostname'] or 'Unknown',
+            'username': row['username'],
+            'tree': row['tree'],
+            'parent': row['parent'],
+            'paths': json.loads(row['paths']),
+            'tags': json.loads(row['tags'])
+        }
@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DIFF_CACHE_PATH = '/data/diffs.db'
+
+# Snapshot pairs kept in the cache when diff_cache_max_pairs is not configured;
+# the least recently viewed are dropped first
+DEFAULT_MAX_DIFFS = 50
+
+# Rows written per executemany call while storing a diff
+DIFF_INSERT_BATCH = 5000
+
+# Largest changes listed with a directory rollup
+DEFAULT_DIFF_LIMIT = 100
+
+# restic diff modifiers grouped into the kinds of change shown ('T': the type changed)
+CHANGE_KINDS = {'+': 'added', '-': 'removed', 'M': 'modified', 'T': 'modified'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diffs (
+    id INTEGER PRIMARY KEY,
+    old_id TEXT NOT NULL,
+    new_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    added_files INTEGER NOT NULL DEFAULT 0,
+    removed_files INTEGER NOT NULL DEFAULT 0,
+    modified_files INTEGER NOT NULL DEFAULT 0,
+    added_bytes INTEGER NOT NULL DEFAULT 0,
+    removed_bytes INTEGER NOT NULL DEFAULT 0,
+    modified_bytes INTEGER NOT NULL DEFAULT 0,
+    data_added INTEGER,
+    data_removed INTEGER,
+    error TEXT,
+    computed_at REAL,
+    duration REAL,
+    used_at REAL,
+    UNIQUE (old_id, new_id)
+);
+
+CREATE TABLE IF NOT EXISTS diff_changes (
+    diff_id INTEGER NOT NULL REFERENCES diffs (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    type TEXT NOT NULL,
+    old_size INTEGER,
+    new_size INTEGER,
+    PRIMARY KEY (diff_id, path)
+) WITHOUT ROWID;
+"""
+
+# Bytes a change accounts for: the size added or removed, or the growth of a modified file
+CHANGE_BYTES = ("CASE kind WHEN 'added' THEN COALESCE(new_size, 0) WHEN 'removed' THEN COALESCE(old_size, 0) "
+                "WHEN 'modified' THEN COALESCE(new_size, 0) - COALESCE(old_size, 0) ELSE 0 END")
+
+def _parent(path):
+    return path.rsplit('/', 1)[0] or '/'
+
+class SnapshotDiffCache:
+    """Differences between snapshot pairs from `restic diff --json`
+    
+    Snapshots never change, so a pair is diffed once and served from the
+    cache until it is evicted: at most max_diffs pairs are kept, the least
+    recently viewed dropped first. Every changed path is stored with its
+    size in both snapshots, which lets any directory be rolled up into
+    per-child totals without running restic again.
+    """
+    
+    def __init__(self, path=DIFF_CACHE_PATH, max_diffs=DEFAULT_MAX_DIFFS):
+        self.path = path
+        self.max_diffs = max_diffs
+        self.lock = threading.Lock()
+        self.computing = set()
+        self._initialized = False
+    
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA foreign_keys = ON')
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def state(self, old_id, new_id):
+        """Cache state of a pair: None, 'computing', 'ready' or 'error' (with the summary or details)"""
+        with self.lock:
+            if (old_id, new_id) in self.computing:
+                return {'status': 'computing'}
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM diffs WHERE old_id = ? AND new_id = ?', (old_id, new_id)).fetchone()
+        # A 'computing' row without a run in this process was interrupted by a restart
+        if row is None or row['status'] == 'computing':
+            return None
+        return dict(row)
+    
+    def claim(self, old_id, new_id):
+        """Mark a pair as being diffed; False if that is already under way"""
+        with self.lock:
+            if (old_id, new_id) in self.computing:
+                return False
+            self.computing.add((old_id, new_id))
+            return True
+    
+    def store(self, old_id, new_id, changes, statistics=None, sizes=None):
+        """Replace a pair's diff with the `restic diff --json` changes
+        
+        `changes` yields (path, modifier) pairs; directories end in '/'.
+        `sizes(paths)` returns {path: (old_size, new_size)} for a batch of
+        file paths. The caller must have claimed the pair.
+        """
+        started = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM diffs WHERE old_id = ? AND new_id = ?', (old_id, new_id))
+                diff_id = conn.execute("INSERT INTO diffs (old_id, new_id, status) VALUES (?, ?, 'computing')",
+                                       (old_id, new_id)).lastrowid
+                
+                def flush(batch):
+                    found = sizes([path for path, _, node_type in batch if node_type != 'dir']) if sizes else {}
+                    conn.executemany('INSERT OR REPLACE INTO diff_changes VALUES (?, ?, ?, ?, ?, ?)',
+                                     [(diff_id, path, kind, node_type) + found.get(path, (None, None))
+                                      for path, kind, node_type in batch])
+                
+                batch = []
+                for path, modifier in changes:
+                    kind = CHANGE_KINDS.get(modifier[:1])
+                    if kind is None:
+                        continue
+                    node_type = 'dir' if path.endswith('/') and path != '/' else 'file'
+                    batch.append((path.rstrip('/') or '/', kind, node_type))
+                    if len(batch) >= DIFF_INSERT_BATCH:
+                        flush(batch)
+                        batch = []
+                flush(batch)
+                
+                totals = conn.execute(
+                    f"SELECT kind, COUNT(*) AS files, SUM({CHANGE_BYTES}) AS bytes FROM diff_changes "
+                    f"WHERE diff_id = ? AND type != 'dir' GROUP BY kind", (diff_id,)).fetchall()
+                summary = {f"{row['kind']}_{field}": row[field] or 0 for row in totals for field in ('files', 'bytes')}
+                statistics = statistics or {}
+                now = time.time()
+                conn.execute(
+                    "UPDATE diffs SET status = 'ready', added_files = ?, removed_files = ?, modified_files = ?, "
+                    "added_bytes = ?, removed_bytes = ?, modified_bytes = ?, data_added = ?, "
+                    "data_removed = ?, computed_at = ?, duration = ?, used_at = ? WHERE id = ?",
+                    (summary.get('added_files', 0), summary.get('removed_files', 0), summary.get('modified_files', 0),
+                     summary.get('added_bytes', 0), summary.get('removed_bytes', 0),
+                     summary.get('modified_bytes', 0), (statistics.get('added') or {}).get('bytes'),
+                     (statistics.get('removed') or {}).get('bytes'), now, now - started, now, diff_id))
+            self._evict()
+        except Exception as e:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM diffs WHERE old_id = ? AND new_id = ?', (old_id, new_id))
+                conn.execute("INSERT INTO diffs (old_id, new_id, status, error, computed_at) "
+                             "VALUES (?, ?, 'error', ?, ?)", (old_id, new_id, str(e), time.time()))
+            raise
+        finally:
+            with self.lock:
+                self.computing.discard((old_id, new_id))
+    
+    def rollup(self, old_id, new_id, path='/', limit=DEFAULT_DIFF_LIMIT):
+        """Changes below a directory: file totals per immediate child and the largest changed files
+        
+        Children are ordered by the bytes they added, removed or grew by;
+        None if the pair has not been diffed.
+        """
+        path = '/' + path.strip('/')
+        prefix = '/' if path == '/' else f"{path}/"
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM diffs WHERE old_id = ? AND new_id = ? AND status = 'ready'",
+                               (old_id, new_id)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE diffs SET used_at = ? WHERE id = ?', (time.time(), row['id']))
+            # Range scan on the primary key: every path that starts with the prefix ('0' sorts right after '/')
+            scope = 'diff_id = ? AND path > ? AND path < ?'
+            params = (row['id'], prefix, f"{prefix[:-1]}0")
+            child = ("CASE instr(substr(path, ?), '/') WHEN 0 THEN substr(path, ?) "
+                     "ELSE substr(path, ?, instr(substr(path, ?), '/') - 1) END")
+            start = len(prefix) + 1
+            children = conn.execute(
+                f"SELECT {child} AS name, MAX(instr(substr(path, ?), '/') > 0) AS is_dir, "
+                f"SUM(kind = 'added') AS added_files, SUM(kind = 'removed') AS removed_files, "
+                f"SUM(kind = 'modified') AS modified_files, "
+                f"SUM(CASE kind WHEN 'added' THEN COALESCE(new_size, 0) ELSE 0 END) AS added_bytes, "
+                f"SUM(CASE kind WHEN 'removed' THEN COALESCE(old_size, 0) ELSE 0 END) AS removed_bytes, "
+                f"SUM(CASE kind WHEN 'modified' THEN COALESCE(new_size, 0) - COALESCE(old_size, 0) ELSE 0 END) "
+                f"AS modified_bytes "
+                f"FROM diff_changes WHERE {scope} AND type != 'dir' "
+                f"GROUP BY name ORDER BY SUM(ABS({CHANGE_BYTES})) DESC, name",
+                (start, start, start, start, start) + params).fetchall()
+            files = conn.execute(
+                f"SELECT path, kind, type, old_size, new_size FROM diff_changes "
+                f"WHERE {scope} AND type != 'dir' ORDER BY ABS({CHANGE_BYTES}) DESC, path LIMIT ?",
+                params + (limit,)).fetchall()
+        
+        entries = []
+        for entry in children:
+            entry = dict(entry)
+            entry['type'] = 'dir' if entry.pop('is_dir') else 'file'
+            entry['path'] = prefix + entry['name']
+            entries.append(entry)
+        return {'path': path, 'parent': _parent(path) if path != '/' else None,
+                'children': entries, 'files': [dict(change) for change in files]}
+    
+    def retain(self, snapshot_ids):
+        """Drop diffs that involve snapshots which no longer exist"""
+        with self._connect() as conn:
+            stale = [(row['id'],) for row in conn.execute('SELECT id, old_id, new_id FROM diffs')
+                     if row['old_id'] not in snapshot_ids or row['new_id'] not in snapshot_ids]
+            conn.executemany('DELETE FROM diffs WHERE id = ?', stale)
+        return len(stale)
+    
+    def _evict(self):
+        """Keep at most max_diffs pairs, dropping the least recently viewed"""
+        if not self.max_diffs:
+            return
+        with self._connect() as conn:
+            conn.execute("DELETE FROM diffs WHERE id IN (SELECT id FROM diffs WHERE status = 'ready' "
+                         "ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_diffs,))
@@ -0,0 +1,38 @@
+import sqlite3
+
+from file_search import FileSearchIndex
+
+PATHS = ['/volumes/app/config.yml', '/volumes/app/data/Config_old.yml', '/volumes/app/data/db.sqlite',
+         '/volumes/web/config.yml']
+
+def build_index(path):
+    index = FileSearchIndex(path)
+    nodes = [{'path': name, 'type': 'file', 'size': 1, 'mtime': '2024-01-01T00:00:00Z'} for name in PATHS]
+    index.add_snapshot({'full_id': 'a' * 64, 'id': 'aaaaaaaa', 'hostname': 'host', 'paths': ['/volumes'],
+                        'time_unix': 1.0}, nodes)
+    return index
+
+def found(index, query):
+    return [result['path'] for result in index.search(query)['results']]
+
+def test_substring_and_glob_queries(tmp_path):
+    index = build_index(str(tmp_path / 'search.db'))
+    
+    assert found(index, 'config') == ['/volumes/app/config.yml', '/volumes/app/data/Config_old.yml',
+                                      '/volumes/web/config.yml']
+    assert found(index, 'g_o') == ['/volumes/app/data/Config_old.yml']
+    assert found(index, 'db') == ['/volumes/app/data/db.sqlite']
+    assert found(index, '*.sqlite') == ['/volumes/app/data/db.sqlite']
+    assert found(index, '/volumes/web/*.yml') == ['/volumes/web/config.yml']
+    assert found(index, 'data/*') == ['/volumes/app/data/Config_old.yml', '/volumes/app/data/db.sqlite']
+
+def test_existing_index_is_added_to_trigram_table(tmp_path):
+    path = str(tmp_path / 'search.db')
+    build_index(path)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO search_paths_fts (search_paths_fts) VALUES ('delete-all')")
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
+    conn.close()
+    
+    assert found(FileSearchIndex(path), 'web/config') == ['/volumes/web/config.yml']
@@ -0,0 +1,20 @@
+from job_history import JobHistory, protected_at
+
+def backup_job(job_id, started_at, volumes):
+    job = {'id': job_id, 'operation': 'backup', 'status': 'success', 'start_time': started_at, 'duration': 60}
+    records = [{'volume': name, 'status': status, 'started_at': started_at, 'duration': 10,
+                'files_processed': None, 'bytes_processed': None, 'bytes_added': None, 'files_new': None,
+                'files_changed': None, 'files_unmodified': None, 'throughput': None, 'upload_rate': None,
+                'snapshot_id': None, 'error': None} for name, status in volumes.items()]
+    return job, records
+
+def test_skipped_volumes_count_as_protected(tmp_path):
+    history = JobHistory(path=str(tmp_path / 'history.db'), retention_days=0)
+    history.record(*backup_job('first', 1000.0, {'quiet': 'success', 'busy': 'success', 'broken': 'success'}))
+    history.record(*backup_job('second', 2000.0, {'quiet': 'skipped', 'busy': 'success', 'broken': 'error'}))
+    
+    assert history.last_success('backup') == {'quiet': 2010.0, 'busy': 2010.0, 'broken': 1010.0}
+
+def test_protected_at():
+    _, records = backup_job('job', 500.0, {'quiet': 'skipped', 'busy': 'success', 'broken': 'error'})
+    assert [protected_at(record) for record in records] == [510.0, 510.0, None]
@@ -0,0 +1,39 @@
+from backup import RestorePhase, TransferProgress, parse_restic_json, restore_phase
+
+# Output of `restic restore --json` 0.17.3; restic leaves out counters that are still zero
+RESTIC_017_OUTPUT = [
+    '{"message_type":"status","seconds_elapsed":1,"percent_done":0,"total_files":3,"total_bytes":6291456}',
+    '{"message_type":"status","seconds_elapsed":2,"percent_done":0.5,"total_files":3,"files_restored":1,'
+    '"total_bytes":6291456,"bytes_restored":3145728}',
+    '{"message_type":"summary","seconds_elapsed":3,"total_files":3,"files_restored":3,"total_bytes":6291456,'
+    '"bytes_restored":6291456}'
+]
+
+def test_status_messages_move_progress_and_phase():
+    transfer = TransferProgress(total_bytes=1024, total_files=1)
+    events = [parse_restic_json(line) for line in RESTIC_017_OUTPUT]
+    
+    transfer.update_restore(events[0], now=100.0)
+    assert restore_phase(events[0]) == RestorePhase.DOWNLOADING_PACKS
+    assert (transfer.bytes_done, transfer.total_bytes, transfer.total_files) == (0, 6291456, 3)
+    
+    transfer.update_restore(events[1], now=101.0)
+    assert restore_phase(events[1]) == RestorePhase.WRITING_FILES
+    assert transfer.percent == 50.0
+    assert transfer.files_done == 1
+    assert transfer.rate == 3145728.0
+    assert transfer.eta == 1.0
+
+def test_summary_reports_restored_totals():
+    transfer = TransferProgress()
+    for now, line in enumerate(RESTIC_017_OUTPUT, 1):
+        transfer.update_restore(parse_restic_json(line), now=float(now))
+    summary = parse_restic_json(RESTIC_017_OUTPUT[-1])
+    
+    assert summary['message_type'] == 'summary'
+    assert (transfer.files_done, transfer.bytes_done) == (summary['files_restored'], summary['bytes_restored'])
+    assert transfer.percent == 100.0
+    assert transfer.rate == 3145728.0
+
+def test_plain_text_lines_are_not_messages():
+    assert parse_restic_json('restoring <Snapshot 1a2b3c4d of [/volumes/app]> to /data/restore') is None
@@ -0,0 +1,281 @@
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Track of spans that belong to the job as a whole rather than to one volume or shard
+JOB_TRACK = 'job'
+
+# Spans kept per job; later spans are counted but dropped
+MAX_SPANS = 2000
+
+# Text lines of `restic backup` that open a phase. With --json restic prints
+# few of them, so backups mostly fall back to the phases read from its
+# status messages.
+BACKUP_MARKERS = (
+    ('open repository', 'open repository'),
+    ('lock repository', 'lock repository'),
+    ('load index', 'load index'),
+    ('start scan', 'chunk and upload'),
+    ('start backup', 'chunk and upload')
+)
+
+# Text lines of `restic prune` that open a phase
+PRUNE_MARKERS = (
+    ('loading indexes', 'load index'),
+    ('loading all snapshots', 'load snapshots'),
+    ('finding data that is still in use', 'find used data'),
+    ('searching used packs', 'search used packs'),
+    ('collecting packs', 'plan repack'),
+    ('repacking packs', 'repack'),
+    ('rebuilding index', 'rebuild index'),
+    ('deleting obsolete index', 'delete old index'),
+    ('removing', 'delete packs'),
+    ('done', 'unlock repository')
+)
+
+class JobTrace:
+    """Timed spans of one job, grouped in tracks (the job, a volume or a restore shard)
+    
+    Spans are closed wall-clock intervals in unix time. A track also has at
+    most one open phase; entering the next phase closes it.
+    """
+    
+    def __init__(self, max_spans=MAX_SPANS):
+        self.max_spans = max_spans
+        self.closed = []
+        self.open = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+    
+    def add(self, name, start, end, track=JOB_TRACK, **attrs):
+        """Record a finished span"""
+        with self.lock:
+            self._add_locked(name, start, end, track, attrs)
+    
+    def _add_locked(self, name, start, end, track, attrs):
+        if len(self.closed) >= self.max_spans:
+            self.dropped += 1
+            return
+        self.closed.append({'name': name, 'track': track, 'start': start, 'end': max(start, end),
+                            'attrs': attrs})
+    
+    @contextmanager
+    def span(self, name, track=JOB_TRACK, **attrs):
+        """Time the enclosed block as a span"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), track, **attrs)
+    
+    def phase(self, name, track=JOB_TRACK, at=None, **attrs):
+        """Close the track's open phase and open `name` at `at` (default now); re-entering it does nothing"""
+        at = time.time() if at is None else at
+        with self.lock:
+            current = self.open.get(track)
+            if current is not None:
+                if current['name'] == name:
+                    return
+                self._add_locked(current['name'], current['start'], at, track, current['attrs'])
+            self.open[track] = {'name': name, 'start': at, 'attrs': attrs}
+    
+    def current(self, track=JOB_TRACK):
+        """Name of the track's open phase, or None"""
+        with self.lock:
+            current = self.open.get(track)
+            return current['name'] if current else None
+    
+    def close(self, track=JOB_TRACK, at=None):
+        """Close the track's open phase"""
+        at = time.time() if at is None else at
+        with self.lock:
+            current = self.open.pop(track, None)
+            if current is not None:
+                self._add_locked(current['name'], current['start'], at, track, current['attrs'])
+    
+    def spans(self, now=None):
+        """All spans ordered by start; open phases end `now` and are marked open"""
+        now = time.time() if now is None else now
+        with self.lock:
+            spans = [dict(span) for span in self.closed]
+            spans += [{'name': current['name'], 'track': track, 'start': current['start'],
+                       'end': max(current['start'], now), 'attrs': dict(current['attrs'], open=True)}
+                      for track, current in self.open.items()]
+        spans.sort(key=lambda span: (span['start'], -span['end']))
+        return spans
+
+class ResticPhases:
+    """Phase spans of one restic process, read from its output
+    
+    The phase from launch to restic's first output is `initial`, by default
+    'startup': starting restic, opening the repository and taking its lock.
+    Text lines that start with one of `markers` open that marker's phase;
+    callers enter phases they read from structured messages themselves.
+    """
+    
+    def __init__(self, trace, track=JOB_TRACK, markers=(), initial='startup'):
+        self.trace = trace
+        self.track = track
+        self.markers = markers
+        self.trace.phase(initial, track)
+    
+    def line(self, text):
+        """Feed a plain-text output line"""
+        text = text.lower()
+        for prefix, phase in self.markers:
+            if text.startswith(prefix):
+                self.enter(phase)
+                return
+    
+    def enter(self, phase, at=None):
+        self.trace.phase(phase, self.track, at)
+    
+    def finish(self):
+        """Close the open phase when the process has exited"""
+        self.trace.close(self.track)
+
+class BackupPhases(ResticPhases):
+    """Phases of `restic backup --json`
+    
+    restic chunks and uploads while it is still scanning, so 'chunk and
+    upload' runs from the first status message to the last, with 'scan'
+    inside it until the scanner's totals stop growing. 'save snapshot' is
+    the time from the last status to the summary, when restic flushes its
+    packs, writes the index and saves the snapshot.
+    """
+    
+    def __init__(self, trace, track=JOB_TRACK):
+        super().__init__(trace, track, BACKUP_MARKERS)
+        self.first_status = None
+        self.last_status = None
+        self.scanned = None
+        self.scan_end = None
+    
+    def line(self, text):
+        if text.lower().startswith('scan finished'):
+            self.scan_end = time.time()
+        super().line(text)
+    
+    def event(self, event):
+        """Feed a JSON message"""
+        now = time.time()
+        message_type = event.get('message_type')
+        if message_type == 'status':
+            if self.first_status is None:
+                self.first_status = now
+                self.enter('chunk and upload', now)
+            self.last_status = now
+            totals = (event.get('total_files'), event.get('total_bytes'))
+            if totals != self.scanned:
+                self.scanned = totals
+                self.scan_end = now
+        elif message_type == 'summary':
+            self.enter('save snapshot', self.last_status or now)
+            self.enter('unlock repository', now)
+    
+    def finish(self):
+        super().finish()
+        if self.first_status is not None and self.scan_end is not None:
+            self.trace.add('scan', self.first_status, self.scan_end, self.track)
+
+def _span_id(*parts):
+    return hashlib.sha256(':'.join(parts).encode()).hexdigest()[:16]
+
+def _tracks(spans):
+    tracks = [JOB_TRACK]
+    for span in spans:
+        if span['track'] not in tracks:
+            tracks.append(span['track'])
+    return tracks
+
+def chrome_trace(traces):
+    """Chrome trace event JSON (chrome://tracing, Perfetto) for one or more job traces
+    
+    Each job is a process and each track a thread. Times are relative to the
+    start of their job, so jobs line up side by side.
+    """
+    events = []
+    for pid, trace in enumerate(traces, 1):
+        origin = trace['start_time']
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': f"{trace['operation']} {trace['id']}"}})
+        tids = {}
+        for tid, track in enumerate(_tracks(trace['spans']), 1):
+            tids[track] = tid
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': track}})
+        events.append({'name': trace['operation'], 'ph': 'X', 'pid': pid, 'tid': tids[JOB_TRACK], 'ts': 0,
+                       'dur': round((trace['end_time'] - origin) * 1e6),
+                       'args': {'job_id': trace['id'], 'status': trace.get('status')}})
+        for span in trace['spans']:
+            events.append({'name': span['name'], 'ph': 'X', 'pid': pid, 'tid': tids[span['track']],
+                           'ts': round((span['start'] - origin) * 1e6),
+                           'dur': round((span['end'] - span['start']) * 1e6),
+                           'args': dict(span['attrs'], track=span['track'])})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def _otel_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otel_attributes(attrs):
+    return [{'key': key, 'value': _otel_value(value)} for key, value in attrs.items() if value is not None]
+
+def _nanos(timestamp):
+    return str(int(timestamp * 1e9))
+
+def otel_trace(traces):
+    """OTLP/JSON trace export for one or more job traces
+    
+    Each job is one trace whose root span covers the job. A span's parent
+    is the narrowest span on its track that encloses it, then the job.
+    """
+    spans = []
+    for trace in traces:
+        trace_id = hashlib.sha256(trace['id'].encode()).hexdigest()[:32]
+        root_id = _span_id(trace['id'], 'job')
+        failed = trace.get('status') == 'error'
+        spans.append({
+            'traceId': trace_id,
+            'spanId': root_id,
+            'name': trace['operation'],
+            'kind': 1,
+            'startTimeUnixNano': _nanos(trace['start_time']),
+            'endTimeUnixNano': _nanos(trace['end_time']),
+            'attributes': _otel_attributes({'job.id': trace['id'], 'job.status': trace.get('status')}),
+            'status': {'code': 2 if failed else 1}
+        })
+        
+        members = trace['spans']
+        ids = [_span_id(trace['id'], str(index)) for index in range(len(members))]
+        for index, span in enumerate(members):
+            parent = root_id
+            narrowest = None
+            for other_index, other in enumerate(members):
+                if (other_index != index and other['track'] == span['track']
+                        and other['start'] <= span['start'] and span['end'] <= other['end']
+                        and (other['start'], -other['end']) < (span['start'], -span['end'])
+                        and (narrowest is None or other['end'] - other['start'] < narrowest)):
+                    parent = ids[other_index]
+                    narrowest = other['end'] - other['start']
+            spans.append({
+                'traceId': trace_id,
+                'spanId': ids[index],
+                'parentSpanId': parent,
+                'name': span['name'],
+                'kind': 1,
+                'startTimeUnixNano': _nanos(span['start']),
+                'endTimeUnixNano': _nanos(span['end']),
+                'attributes': _otel_attributes(dict(span['attrs'], track=span['track']))
+            })
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': _otel_attributes({'service.name': 'volumebackups'})},
+            'scopeSpans': [{'scope': {'name': 'volumebackups.engine'}, 'spans': spans}]
+        }]
+    }
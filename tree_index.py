@@ -0,0 +1,238 @@
+import os
+import posixpath
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from snapshot_catalog import parse_restic_time
+
+logger = logging.getLogger(__name__)
+
+TREE_INDEX_PATH = '/data/trees.db'
+
+# Snapshot trees kept in the index when tree_index_max_snapshots is not configured;
+# the least recently browsed are dropped first
+DEFAULT_MAX_TREES = 20
+
+# Nodes inserted per executemany call while building
+TREE_INSERT_BATCH = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trees (
+    snapshot_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    entries INTEGER NOT NULL DEFAULT 0,
+    total_size INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    built_at REAL,
+    duration REAL,
+    used_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS tree_dirs (
+    id INTEGER PRIMARY KEY,
+    snapshot_id TEXT NOT NULL REFERENCES trees (snapshot_id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    UNIQUE (snapshot_id, path)
+);
+
+CREATE TABLE IF NOT EXISTS tree_nodes (
+    dir_id INTEGER NOT NULL REFERENCES tree_dirs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (dir_id, name)
+) WITHOUT ROWID;
+"""
+
+class TreeIndex:
+    """Directory listings of snapshots, built once from `restic ls --json`
+    
+    Each directory path is stored once per snapshot and its entries are keyed
+    by directory id and name, so listing a directory is a single index range
+    scan however large the snapshot is. Directory sizes are the total size of
+    everything below them.
+    """
+    
+    def __init__(self, path=TREE_INDEX_PATH, max_trees=DEFAULT_MAX_TREES):
+        self.path = path
+        self.max_trees = max_trees
+        self.lock = threading.Lock()
+        self.building = set()
+        self._initialized = False
+    
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA foreign_keys = ON')
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def state(self, snapshot_id):
+        """Index state of a snapshot: None, 'building', 'ready' or 'error' (with details)"""
+        with self.lock:
+            if snapshot_id in self.building:
+                return {'status': 'building'}
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM trees WHERE snapshot_id = ?', (snapshot_id,)).fetchone()
+        # A 'building' row without a build in this process was interrupted by a restart
+        if row is None or row['status'] == 'building':
+            return None
+        return dict(row)
+    
+    def claim(self, snapshot_id):
+        """Mark a snapshot as being built; False if a build is already running"""
+        with self.lock:
+            if snapshot_id in self.building:
+                return False
+            self.building.add(snapshot_id)
+            return True
+    
+    def build(self, snapshot_id, nodes):
+        """Replace a snapshot's tree with the nodes of a `restic ls --json` listing
+        
+        `nodes` yields parsed node objects; the caller must have claimed the
+        snapshot. Returns the number of entries indexed.
+        """
+        started = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM trees WHERE snapshot_id = ?', (snapshot_id,))
+                conn.execute("INSERT INTO trees (snapshot_id, status) VALUES (?, 'building')", (snapshot_id,))
+                dir_ids = {}
+                
+                def dir_id(path):
+                    if path not in dir_ids:
+                        cursor = conn.execute('INSERT INTO tree_dirs (snapshot_id, path) VALUES (?, ?)',
+                                              (snapshot_id, path))
+                        dir_ids[path] = cursor.lastrowid
+                    return dir_ids[path]
+                
+                dir_sizes = {}
+                batch = []
+                entries = 0
+                total_size = 0
+                for node in nodes:
+                    path = node.get('path')
+                    if not path:
+                        continue
+                    parent = posixpath.dirname(path)
+                    size = node.get('size') or 0
+                    if node.get('type') == 'dir':
+                        dir_id(path)
+                        dir_sizes.setdefault(path, 0)
+                    else:
+                        total_size += size
+                        ancestor = parent
+                        while True:
+                            dir_sizes[ancestor] = dir_sizes.get(ancestor, 0) + size
+                            if ancestor in ('/', ''):
+                                break
+                            ancestor = posixpath.dirname(ancestor)
+                    batch.append((dir_id(parent), node.get('name') or posixpath.basename(path), node.get('type', 'file'),
+                                  size, parse_restic_time(node.get('mtime')) or None))
+                    entries += 1
+                    if len(batch) >= TREE_INSERT_BATCH:
+                        conn.executemany('INSERT OR REPLACE INTO tree_nodes (dir_id, name, type, size, mtime) '
+                                         'VALUES (?, ?, ?, ?, ?)', batch)
+                        batch = []
+                conn.executemany('INSERT OR REPLACE INTO tree_nodes (dir_id, name, type, size, mtime) '
+                                 'VALUES (?, ?, ?, ?, ?)', batch)
+                
+                # Directory nodes carry the total size below them
+                conn.executemany('UPDATE tree_nodes SET size = ? WHERE dir_id = ? AND name = ?',
+                                 [(size, dir_ids[posixpath.dirname(path)], posixpath.basename(path))
+                                  for path, size in dir_sizes.items()
+                                  if path != '/' and posixpath.dirname(path) in dir_ids])
+                
+                now = time.time()
+                conn.execute("UPDATE trees SET status = 'ready', entries = ?, total_size = ?, built_at = ?, "
+                             "duration = ?, used_at = ? WHERE snapshot_id = ?",
+                             (entries, total_size, now, now - started, now, snapshot_id))
+            self._evict()
+            return entries
+        except Exception as e:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM trees WHERE snapshot_id = ?', (snapshot_id,))
+                conn.execute("INSERT INTO trees (snapshot_id, status, error, built_at) VALUES (?, 'error', ?, ?)",
+                             (snapshot_id, str(e), time.time()))
+            raise
+        finally:
+            with self.lock:
+                self.building.discard(snapshot_id)
+    
+    def list_dir(self, snapshot_id, path, page=1, per_page=500):
+        """Entries of one directory, directories first; None if the directory is not in the tree"""
+        page = max(1, int(page))
+        per_page = max(1, min(5000, int(per_page)))
+        with self._connect() as conn:
+            row = conn.execute('SELECT id FROM tree_dirs WHERE snapshot_id = ? AND path = ?',
+                               (snapshot_id, path)).fetchone()
+            if row is None:
+                return None
+            total = conn.execute('SELECT COUNT(*) FROM tree_nodes WHERE dir_id = ?', (row['id'],)).fetchone()[0]
+            nodes = conn.execute(
+                "SELECT name, type, size, mtime FROM tree_nodes WHERE dir_id = ? "
+                "ORDER BY type != 'dir', name LIMIT ? OFFSET ?",
+                (row['id'], per_page, (page - 1) * per_page)).fetchall()
+            conn.execute('UPDATE trees SET used_at = ? WHERE snapshot_id = ?', (time.time(), snapshot_id))
+        entries = [dict(node, path=posixpath.join(path, node['name'])) for node in nodes]
+        return entries, total
+    
+    def node(self, snapshot_id, path):
+        """A single entry by path, or None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT n.name, n.type, n.size, n.mtime FROM tree_nodes n JOIN tree_dirs d ON d.id = n.dir_id '
+                'WHERE d.snapshot_id = ? AND d.path = ? AND n.name = ?',
+                (snapshot_id, posixpath.dirname(path), posixpath.basename(path))).fetchone()
+        return dict(row, path=path) if row else None
+    
+    def sizes(self, snapshot_id, paths):
+        """Sizes of many entries by path, as {path: size}; paths not in the tree are left out"""
+        found = {}
+        with self._connect() as conn:
+            for path in paths:
+                row = conn.execute(
+                    'SELECT n.size FROM tree_nodes n JOIN tree_dirs d ON d.id = n.dir_id '
+                    'WHERE d.snapshot_id = ? AND d.path = ? AND n.name = ?',
+                    (snapshot_id, posixpath.dirname(path), posixpath.basename(path))).fetchone()
+                if row is not None:
+                    found[path] = row['size']
+        return found
+    
+    def files(self, snapshot_id):
+        """Yield (path, size) of every regular file in a snapshot's tree"""
+        with self._connect() as conn:
+            for row in conn.execute(
+                    "SELECT d.path, n.name, n.size FROM tree_nodes n JOIN tree_dirs d ON d.id = n.dir_id "
+                    "WHERE d.snapshot_id = ? AND n.type = 'file'", (snapshot_id,)):
+                yield posixpath.join(row['path'], row['name']), row['size']
+    
+    def retain(self, snapshot_ids):
+        """Drop trees of snapshots that no longer exist"""
+        with self._connect() as conn:
+            stale = [row['snapshot_id'] for row in conn.execute('SELECT snapshot_id FROM trees')
+                     if row['snapshot_id'] not in snapshot_ids]
+            conn.executemany('DELETE FROM trees WHERE snapshot_id = ?', [(snapshot_id,) for snapshot_id in stale])
+        return len(stale)
+    
+    def _evict(self):
+        """Keep at most max_trees trees, dropping the least recently browsed"""
+        if not self.max_trees:
+            return
+        with self._connect() as conn:
+            conn.execute("DELETE FROM trees WHERE snapshot_id IN (SELECT snapshot_id FROM trees "
+                         "WHERE status = 'ready' ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_trees,))
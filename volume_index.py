@@ -0,0 +1,233 @@
+import os
+import json
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+INDEX_PATH = '/data/volume_index.json'
+VOLUMES_DIR = '/volumes'
+
+# Seconds between background rescans when volume_scan_interval is not configured
+DEFAULT_SCAN_INTERVAL = 900
+
+# Volumes scanned at the same time when volume_scan_workers is not configured
+DEFAULT_SCAN_WORKERS = 4
+
+# Every this many passes, every file is statted again to catch files that grew in place
+DEFAULT_FULL_SCAN_PASSES = 8
+
+def _scan_directory(path, mtime):
+    """Totals of the files directly inside one directory, and the names of its subdirectories"""
+    node = {'mtime': mtime, 'size': 0, 'files': 0, 'newest': None, 'subdirs': [], 'errors': 0}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    node['subdirs'].append(entry.name)
+                    continue
+                
+                stat = entry.stat(follow_symlinks=False)
+                node['size'] += stat.st_size
+                node['files'] += 1
+                if node['newest'] is None or stat.st_mtime > node['newest']:
+                    node['newest'] = stat.st_mtime
+            except OSError:
+                node['errors'] += 1
+    return node
+
+def scan_volume(path, previous=None):
+    """Walk a volume with os.scandir and total its size, file count and newest mtime
+    
+    `previous` is the directory map of an earlier scan of the same volume.
+    A directory whose mtime has not changed still has the same entries, so
+    its file totals are reused and only its subdirectories are visited.
+    Files that grew in place are picked up by the next scan without one.
+    Returns the totals and the directory map for the next scan.
+    """
+    previous = previous or {}
+    directories = {}
+    size = 0
+    file_count = 0
+    dir_count = 0
+    newest_mtime = None
+    errors = 0
+    reused = 0
+    
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            mtime = os.lstat(current).st_mtime_ns
+            node = previous.get(current)
+            if node is not None and node['mtime'] == mtime and not node['errors']:
+                reused += 1
+            else:
+                node = _scan_directory(current, mtime)
+        except OSError:
+            errors += 1
+            continue
+        
+        directories[current] = node
+        size += node['size']
+        file_count += node['files']
+        dir_count += len(node['subdirs'])
+        errors += node['errors']
+        if node['newest'] is not None and (newest_mtime is None or node['newest'] > newest_mtime):
+            newest_mtime = node['newest']
+        stack.extend(os.path.join(current, name) for name in node['subdirs'])
+    
+    return {
+        'size': size,
+        'file_count': file_count,
+        'dir_count': dir_count,
+        'newest_mtime': newest_mtime,
+        'errors': errors,
+        'dirs_reused': reused
+    }, directories
+
+def load_volume_index(index_path=INDEX_PATH):
+    """Load the persisted volume index, keyed by volume name"""
+    try:
+        with open(index_path, 'r') as f:
+            return json.load(f).get('volumes', {})
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Error loading volume index: {e}")
+        return {}
+
+class VolumeIndex:
+    """Keeps per-volume sizes up to date in the background so requests never walk the disk
+    
+    Directory maps of the last scan are kept in memory, so a rescan only
+    lists directories that changed. The first pass after startup, every
+    full_scan_passes-th pass and rescans requested by users stat every file.
+    """
+    
+    def __init__(self, volumes_dir=VOLUMES_DIR, index_path=INDEX_PATH,
+                 interval=DEFAULT_SCAN_INTERVAL, workers=DEFAULT_SCAN_WORKERS,
+                 full_scan_passes=DEFAULT_FULL_SCAN_PASSES):
+        self.volumes_dir = volumes_dir
+        self.index_path = index_path
+        self.interval = interval
+        self.workers = max(1, workers)
+        self.full_scan_passes = max(1, full_scan_passes)
+        self.entries = load_volume_index(index_path)
+        self.directories = {}
+        self.passes = 0
+        self._full_requested = False
+        self.scanning = set()
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start the background scanner thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='volume-index', daemon=True)
+            self._thread.start()
+    
+    def request_refresh(self):
+        """Ask the scanner to start a full pass now"""
+        self._full_requested = True
+        self._wakeup.set()
+    
+    def get(self, name):
+        """Get the cached entry for a volume, or None if it has not been scanned yet"""
+        with self.lock:
+            entry = self.entries.get(name)
+            return dict(entry) if entry else None
+    
+    def is_scanning(self, name):
+        with self.lock:
+            return name in self.scanning
+    
+    def total_size(self):
+        with self.lock:
+            return sum(entry.get('size', 0) for entry in self.entries.values())
+    
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Volume index refresh failed: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+    
+    def refresh(self, full=False):
+        """Rescan every volume, saving each result as soon as it completes"""
+        full = full or self._full_requested or self.passes % self.full_scan_passes == 0
+        self._full_requested = False
+        self.passes += 1
+        names = []
+        if os.path.exists(self.volumes_dir):
+            names = sorted(item for item in os.listdir(self.volumes_dir)
+                           if os.path.isdir(os.path.join(self.volumes_dir, item)))
+        
+        with self.lock:
+            # Forget volumes that are no longer mounted
+            for name in list(self.entries):
+                if name not in names:
+                    del self.entries[name]
+            for name in list(self.directories):
+                if name not in names:
+                    del self.directories[name]
+            self.scanning = set(names)
+        
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='volume-scan') as pool:
+            futures = {pool.submit(self._scan, name, full): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    result, directories = future.result()
+                    with self.lock:
+                        self.directories[name] = directories
+                    self._store(name, result)
+                except Exception as e:
+                    logger.error(f"Error scanning volume {name}: {e}")
+                finally:
+                    with self.lock:
+                        self.scanning.discard(name)
+    
+    def _scan(self, name, full):
+        started = time.time()
+        with self.lock:
+            previous = None if full else self.directories.get(name)
+        result, directories = scan_volume(os.path.join(self.volumes_dir, name), previous)
+        result['full_scan'] = previous is None
+        result['scanned_at'] = time.time()
+        result['scan_duration'] = result['scanned_at'] - started
+        return result, directories
+    
+    def _store(self, name, result):
+        with self.lock:
+            previous = self.entries.get(name)
+            if previous:
+                result['previous_size'] = previous.get('size', 0)
+                result['previous_scanned_at'] = previous.get('scanned_at')
+                result['growth'] = result['size'] - result['previous_size']
+            else:
+                result['previous_size'] = None
+                result['previous_scanned_at'] = None
+                result['growth'] = None
+            result['name'] = name
+            result['path'] = os.path.join(self.volumes_dir, name)
+            self.entries[name] = result
+            data = {'updated_at': time.time(), 'volumes': dict(self.entries)}
+        
+        self._save(data)
+    
+    def _save(self, data):
+        """Persist the index atomically so readers never see a partial file"""
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.error(f"Error saving volume index: {e}")